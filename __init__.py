@@ -5,6 +5,9 @@ import os.path
 import util.logger
 import webserver
 
+import dispatcher
+import geocoder
+import migrations
 import routes
 import swagger_specs
 
@@ -1,3 +1,32 @@
-"""Run the PAKET routing server."""
+"""
+Run the PAKET routing server, or its notification dispatcher if called with `dispatcher`.
+Called with `dev`, run the flask development server instead of the production server.
+Called with `migrate`, create the database tables if needed, apply pending schema migrations and exit.
+Called with `backfill`, store the country codes of packages missing them and exit.
+Called with `fetch_countries`, download the country boundaries used to geocode locations offline and exit.
+Called with `rebuild_state`, regenerate the package state projection from the events and exit.
+Called with `compact_tokens`, fold the notification tokens history into the current tokens state, then delete it
+(unless PAKET_NOTIFICATION_TOKEN_HISTORY is set) and exit.
+"""
+import sys
+
 import router
-router.APP.run('0.0.0.0', router.routes.PORT, router.webserver.validation.DEBUG)
+
+if sys.argv[1:] == ['dispatcher']:
+    router.dispatcher.run()
+elif sys.argv[1:] == ['migrate']:
+    router.migrations.init_db()
+elif sys.argv[1:] == ['backfill']:
+    router.migrations.backfill_country_codes()
+elif sys.argv[1:] == ['fetch_countries']:
+    router.geocoder.fetch()
+elif sys.argv[1:] == ['rebuild_state']:
+    router.migrations.rebuild_package_state()
+elif sys.argv[1:] == ['compact_tokens']:
+    router.migrations.compact_notification_tokens()
+elif sys.argv[1:] == ['dev']:
+    router.APP.run('0.0.0.0', router.routes.PORT, router.webserver.validation.DEBUG)
+else:
+    # Imported only here, so the other commands do not need gunicorn.
+    import router.server  # pylint: disable=ungrouped-imports
+    router.server.run(router.APP)
@@ -0,0 +1,62 @@
+"""Concurrent and cached BUL balance lookups."""
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+import paket_stellar
+
+import metrics
+
+LOGGER = logging.getLogger('pkt.balances')
+MAX_WORKERS = int(os.environ.get('PAKET_STELLAR_WORKERS', 8))
+CACHE_TTL = float(os.environ.get('PAKET_BALANCE_CACHE_TTL', 5))
+CACHE_MAX_SIZE = 10000
+CACHE = {}
+CACHE_LOCK = threading.Lock()
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(MAX_WORKERS)
+
+
+def get_bul_balance(pubkey):
+    """Get the BUL balance of an account, or None if the account does not exist or does not trust BUL."""
+    with CACHE_LOCK:
+        expiration, balance = CACHE.get(pubkey, (0, None))
+    if expiration > time.time():
+        return balance
+    # Raised for accounts which have no BUL balance - an answer, not a failure of the lookup.
+    no_balance_exceptions = (paket_stellar.TrustError, paket_stellar.StellarAccountNotExists)
+    try:
+        with metrics.timed_call('stellar', 'get_bul_account', no_balance_exceptions):
+            balance = paket_stellar.get_bul_account(pubkey)['bul_balance']
+    except no_balance_exceptions:
+        balance = None
+    with CACHE_LOCK:
+        if len(CACHE) >= CACHE_MAX_SIZE:
+            now = time.time()
+            for expired_pubkey in [key for key, (expiration, _) in CACHE.items() if expiration <= now]:
+                del CACHE[expired_pubkey]
+        CACHE[pubkey] = (time.time() + CACHE_TTL, balance)
+    return balance
+
+
+def get_bul_balances(pubkeys):
+    """Get the BUL balances of several accounts, looking up each distinct account once and concurrently."""
+    pubkeys = list(set(pubkeys))
+    if len(pubkeys) < 2:
+        return {pubkey: get_bul_balance(pubkey) for pubkey in pubkeys}
+    LOGGER.debug("looking up %s balances", len(pubkeys))
+    return dict(zip(pubkeys, EXECUTOR.map(get_bul_balance, pubkeys)))
+
+
+def clear_cache():
+    """Forget all cached balances."""
+    with CACHE_LOCK:
+        CACHE.clear()
+
+
+def reset():
+    """Replace the executor and lock inherited by a forked child process, whose threads did not survive the fork."""
+    global EXECUTOR, CACHE_LOCK  # pylint: disable=global-statement
+    EXECUTOR = concurrent.futures.ThreadPoolExecutor(MAX_WORKERS)
+    CACHE_LOCK = threading.Lock()
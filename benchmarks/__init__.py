@@ -0,0 +1 @@
+"""Benchmarks of the PAKET routing server, run from the repository root with `python -m benchmarks.<name>`."""
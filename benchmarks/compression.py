@@ -0,0 +1,68 @@
+"""Compare response sizes and compression time of the supported encodings, for representative payloads."""
+import argparse
+import functools
+import json
+import random
+import string
+import time
+import zlib
+
+import compression
+
+
+def get_pubkey(generator):
+    """Get a random stellar-like pubkey."""
+    return 'G' + ''.join(generator.choice(string.ascii_uppercase + '234567') for _ in range(55))
+
+
+def get_payloads(count, seed):
+    """Get JSON payloads shaped like the events and packages list responses."""
+    generator = random.Random(seed)
+    pubkeys = [get_pubkey(generator) for _ in range(max(count // 4, 4))]
+    event_list = [{
+        'escrow_pubkey': generator.choice(pubkeys), 'user_pubkey': generator.choice(pubkeys),
+        'event_type': generator.choice(('launched', 'couriered', 'location changed', 'received')),
+        'location': "{:.6f},{:.6f}".format(generator.uniform(-90, 90), generator.uniform(-180, 180)),
+        'timestamp': 'Wed, 02 Jan 2019 03:04:05 GMT', 'kwargs': None, 'photo_id': None} for _ in range(count)]
+    package_list = [{
+        'escrow_pubkey': get_pubkey(generator), 'launcher_pubkey': generator.choice(pubkeys),
+        'recipient_pubkey': generator.choice(pubkeys), 'payment': 50000000, 'collateral': 100000000,
+        'deadline': 1546398245, 'description': 'Package description', 'status': 'in transit',
+        'from_location': '12.970686,77.595590', 'to_location': '41.156193,-8.637541',
+        'events': event_list[:5]} for _ in range(count // 5)]
+    return {
+        'events': json.dumps({'status': 200, 'events': event_list}).encode(),
+        'packages': json.dumps({'status': 200, 'packages': package_list}).encode()}
+
+
+def measure(compress, data, repeats):
+    """Get the compressed size, and the average compression time in milliseconds."""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        compressed = compress(data)
+    return len(compressed), (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=1000, help='events in a payload')
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    compressors = {"gzip-{}".format(level): functools.partial(zlib.compress, level=level) for level in (1, 6, 9)}
+    if compression.brotli is not None:
+        compressors.update({
+            "br-{}".format(quality): functools.partial(compression.brotli.compress, quality=quality)
+            for quality in (1, 5, 11)})
+    for name, data in get_payloads(args.count, args.seed).items():
+        print("{}: {} bytes".format(name, len(data)))
+        for compressor_name, compress in compressors.items():
+            size, milliseconds = measure(compress, data, args.repeats)
+            print("  {:8} {:9} bytes ({:5.1%}) {:8.2f} ms".format(
+                compressor_name, size, size / len(data), milliseconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Time the main db functions on synthetic datasets of several sizes, and write the results as JSON.
+Runs against the database configured by the PAKET_DB_* variables, which name must start with 'test'.
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+
+import benchmarks.dataset
+import benchmarks.fakes
+import db
+import events
+import pagination
+
+
+def get_commit():
+    """Get the current git commit, if any."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(function, repeats):
+    """Call function repeats times, returning timing statistics in milliseconds."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        'repeats': repeats, 'min': timings[0], 'median': statistics.median(timings),
+        'mean': statistics.mean(timings), 'p95': timings[min(repeats - 1, int(repeats * .95))], 'max': timings[-1]}
+
+
+def get_operations(dataset, generator):
+    """Get the timed operations, by name, choosing their arguments from the dataset."""
+    def get_packages():
+        """Get the packages of a random user."""
+        return pagination.get_packages(generator.choice(dataset['users']))
+
+    def get_available_packages():
+        """Get the packages available near a random city."""
+        return db.get_available_packages(benchmarks.dataset.get_location(generator, generator.choice(
+            dataset['cities'])))
+
+    def get_package():
+        """Get a random package."""
+        return db.get_package(generator.choice(dataset['packages']))
+
+    def get_events():
+        """Get the most recent events."""
+        return db.get_events(None, None)
+
+    def add_event():
+        """Add a location change to a random package."""
+        return db.add_event(
+            generator.choice(dataset['users']), events.LOCATION_CHANGED,
+            benchmarks.dataset.get_location(generator, generator.choice(dataset['cities'])),
+            generator.choice(dataset['packages']))
+
+    return {function.__name__: function for function in (
+        get_packages, get_available_packages, get_package, get_events, add_event)}
+
+
+def run(sizes, events_per_package, repeats, seed):
+    """Fill the database with each size of dataset in turn, and time all operations on it."""
+    results = []
+    for size in sizes:
+        benchmarks.dataset.clear()
+        start = time.perf_counter()
+        dataset = benchmarks.dataset.generate(size, events_per_package, seed=seed)
+        result = {'packages': size, 'events_per_package': events_per_package,
+                  'generate_seconds': time.perf_counter() - start, 'operations': {}}
+        generator = random.Random(seed)
+        for name, operation in get_operations(dataset, generator).items():
+            result['operations'][name] = measure(operation, repeats)
+            print("{:>8} packages {:>24}: median {:8.2f}ms, p95 {:8.2f}ms".format(
+                size, name, result['operations'][name]['median'], result['operations'][name]['p95']))
+        results.append(result)
+    return results
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='100,1000,5000', help='comma separated numbers of packages')
+    parser.add_argument('--events-per-package', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stellar-latency', type=float, default=0, help='seconds added to each balance lookup')
+    parser.add_argument('--output', default='benchmark-db.json')
+    args = parser.parse_args()
+
+    benchmarks.fakes.install_stellar(args.stellar_latency)
+    benchmarks.fakes.install_geodecoding()
+    results = run([int(size) for size in args.sizes.split(',')], args.events_per_package, args.repeats, args.seed)
+    with open(args.output, 'w') as output:
+        json.dump({
+            'commit': get_commit(), 'timestamp': int(time.time()), 'python': platform.python_version(),
+            'seed': args.seed, 'stellar_latency': args.stellar_latency, 'results': results}, output, indent=2)
+    print("results written to {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Fill a test database with a reproducible synthetic dataset of packages, events, photos and tokens."""
+import argparse
+import io
+import logging
+import random
+import string
+import time
+
+import PIL.Image
+
+import benchmarks.fakes
+import db
+import events
+
+LOGGER = logging.getLogger('pkt.benchmarks.dataset')
+# Package origins are spread around a few cities, so that nearby package searches find candidates.
+CITIES = ((12.970686, 77.595590), (41.156193, -8.637541), (32.085300, 34.781768), (40.712776, -74.005974))
+# Events following the launch, in the order they happen to a package which is delivered.
+LIFECYCLE = (events.COURIER_CONFIRMED, events.COURIERED, events.RECEIVED)
+
+
+def get_photo(width=640, height=480):
+    """Get a JPEG photo of a gradient, which thumbnails can actually be generated from."""
+    photo = io.BytesIO()
+    PIL.Image.radial_gradient('L').resize((width, height)).convert('RGB').save(photo, 'JPEG', quality=85)
+    return photo.getvalue()
+
+
+# Stored as the photo of events, generated once.
+PHOTO = get_photo()
+
+
+def get_pubkey(generator):
+    """Get a random stellar-like pubkey."""
+    return 'G' + ''.join(generator.choice(string.ascii_uppercase + '234567') for _ in range(55))
+
+
+def get_location(generator, center, spread=0.05):
+    """Get a random location near a center."""
+    return "{:.6f},{:.6f}".format(center[0] + generator.uniform(-spread, spread),
+                                  center[1] + generator.uniform(-spread, spread))
+
+
+def get_event_types(generator, count):
+    """Get the types of count events following a launch: part of the lifecycle, with location changes."""
+    steps = list(LIFECYCLE[:generator.randrange(min(count, len(LIFECYCLE)) + 1)])
+    changes = [events.LOCATION_CHANGED] * (count - len(steps))
+    # Location changes are reported on the way, before the package is received.
+    if steps[-1:] == [events.RECEIVED]:
+        return steps[:-1] + changes + steps[-1:]
+    return steps + changes
+
+
+def check_db_name():
+    """Refuse to fill any database other than a test one."""
+    assert db.DB_NAME.startswith('test'), "refusing to fill db named {}".format(db.DB_NAME)
+
+
+def clear():
+    """Clear all tables of the test database."""
+    check_db_name()
+    db.util.db.clear_tables(db.SQL_CONNECTION, db.DB_NAME)
+
+
+# pylint: disable=too-many-locals
+def generate(packages, events_per_package=4, users=None, photo_ratio=0.2, token_ratio=0.5, seed=0):
+    """
+    Add packages, each with up to events_per_package events following its launch, to the database.
+    Packages are exchanged between users (a quarter of the packages count by default), a photo_ratio of events
+    have a photo, and a token_ratio of users have a notification token. Returns the dataset's users and packages.
+    """
+    check_db_name()
+    generator = random.Random(seed)
+    users = [get_pubkey(generator) for _ in range(users or max(packages // 4, 3))]
+    for user in users:
+        if generator.random() < token_ratio:
+            db.set_notification_token(user, 'token-' + user)
+    now = int(time.time())
+    escrows = []
+    for _ in range(packages):
+        escrow, (launcher, courier, recipient) = get_pubkey(generator), generator.sample(users, 3)
+        origin, destination = generator.sample(CITIES, 2)
+        from_location = get_location(generator, origin)
+        db.create_package(
+            escrow, launcher, recipient, '+490857461783', '+4904597863891', generator.randrange(1, 10) * 10000000,
+            generator.randrange(1, 20) * 10000000, now + generator.randrange(-86400, 7 * 86400),
+            'Package description', from_location, get_location(generator, destination), 'From address',
+            'To address', from_location, PHOTO if generator.random() < photo_ratio else None)
+        for event_type in get_event_types(generator, events_per_package - 1):
+            user = recipient if event_type == events.RECEIVED else courier
+            db.add_event(
+                user, event_type, get_location(generator, origin), escrow,
+                photo=PHOTO if generator.random() < photo_ratio else None)
+        escrows.append(escrow)
+    LOGGER.info("generated %s packages of %s users", len(escrows), len(users))
+    return {'users': users, 'packages': escrows, 'cities': CITIES}
+# pylint: enable=too-many-locals
+
+
+def main():
+    """Fill the database."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('packages', type=int)
+    parser.add_argument('--events-per-package', type=int, default=4)
+    parser.add_argument('--photo-ratio', type=float, default=0.2)
+    parser.add_argument('--token-ratio', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--clear', action='store_true', help='clear the database first')
+    args = parser.parse_args()
+    benchmarks.fakes.install_geodecoding()
+    if args.clear:
+        clear()
+    generate(args.packages, args.events_per_package, None, args.photo_ratio, args.token_ratio, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Local stand-ins for the external services, so benchmarks run offline and measure only the router."""
+import collections
+import sys
+import time
+import types
+
+import paket_stellar
+import util.geodecoding
+
+# Balance of every fake account, in stroops - enough for any generated package to be solvent.
+BALANCE = 10 ** 12
+
+
+def install_stellar(latency=0.0):
+    """Answer balance lookups locally, after latency seconds, instead of querying Horizon."""
+    def get_bul_account(pubkey, accept_untrusted=False):  # pylint: disable=unused-argument
+        """Get a fake BUL account."""
+        if latency:
+            time.sleep(latency)
+        return {'bul_balance': BALANCE, 'sequence': 1, 'balances': [], 'signers': [], 'thresholds': {}}
+    paket_stellar.get_bul_account = get_bul_account
+
+
+def install_geodecoding(country_code='XX', latency=0.0):
+    """Resolve every location to country_code, after latency seconds, instead of querying the service."""
+    def gps_to_country_code(location):  # pylint: disable=unused-argument
+        """Get a fake country code."""
+        if latency:
+            time.sleep(latency)
+        return country_code
+    util.geodecoding.gps_to_country_code = gps_to_country_code
+
+
+def install_firebase(latency=0.0):
+    """
+    Replace the firebase_admin package with one sending nothing, after latency seconds per multicast.
+    Must be called before notifications is first imported, since it initializes its app on import.
+    """
+    response = collections.namedtuple('SendResponse', 'success exception')(True, None)
+    batch_response = collections.namedtuple('BatchResponse', 'success_count responses')
+
+    def send_multicast(message, app=None):  # pylint: disable=unused-argument
+        """Pretend to send a message to all its tokens."""
+        if latency:
+            time.sleep(latency)
+        return batch_response(len(message.tokens), [response] * len(message.tokens))
+
+    firebase_admin = types.ModuleType('firebase_admin')
+    firebase_admin.credentials = types.ModuleType('firebase_admin.credentials')
+    firebase_admin.credentials.Certificate = lambda path: path
+    firebase_admin.initialize_app = lambda credentials=None, options=None, name='[DEFAULT]': object()
+    firebase_admin.delete_app = lambda app: None
+    firebase_admin.messaging = types.ModuleType('firebase_admin.messaging')
+    firebase_admin.messaging.Notification = types.SimpleNamespace
+    firebase_admin.messaging.MulticastMessage = types.SimpleNamespace
+    firebase_admin.messaging.send_multicast = send_multicast
+    sys.modules.update({
+        'firebase_admin': firebase_admin, 'firebase_admin.credentials': firebase_admin.credentials,
+        'firebase_admin.messaging': firebase_admin.messaging})
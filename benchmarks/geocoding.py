@@ -0,0 +1,53 @@
+"""Compare the throughput of offline country code lookups with the geodecoding service."""
+import argparse
+import random
+import time
+
+import util.geodecoding
+
+import geocoder
+
+
+def get_points(count, seed):
+    """Get random points between the southernmost and northernmost inhabited latitudes."""
+    generator = random.Random(seed)
+    return [(generator.uniform(-56, 72), generator.uniform(-180, 180)) for _ in range(count)]
+
+
+def measure(lookup, points):
+    """Look up all points, returning lookups per second and the number of points resolved to a country."""
+    start = time.perf_counter()
+    found = sum(1 for latitude, longitude in points if lookup(latitude, longitude))
+    return len(points) / (time.perf_counter() - start), found
+
+
+def lookup_service(latitude, longitude):
+    """Look up a point with the geodecoding service."""
+    try:
+        return util.geodecoding.gps_to_country_code("{},{}".format(latitude, longitude))
+    except util.geodecoding.GeodecodingError:
+        return None
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('countries', help='GeoJSON file of country boundaries')
+    parser.add_argument('--points', type=int, default=100000, help='points looked up offline')
+    parser.add_argument('--service-points', type=int, default=20, help='points looked up with the service')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index = geocoder.load(args.countries)
+    print("index built in {:.2f}s".format(time.perf_counter() - start))
+    points = get_points(args.points, args.seed)
+    rate, found = measure(index.lookup, points)
+    print("offline: {:.0f} lookups/s, {} of {} points in a country".format(rate, found, len(points)))
+    if args.service_points:
+        rate, found = measure(lookup_service, points[:args.service_points])
+        print("service: {:.1f} lookups/s, {} of {} points in a country".format(rate, found, args.service_points))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""
+Replay the package lifecycle against the routes with concurrent virtual users, and report latency per endpoint.
+Runs against the app in process by default, with balance lookups and notifications answered by local fakes and
+the database configured by the PAKET_DB_* variables (which name must start with 'test'), or against a running
+server with --url.
+"""
+import argparse
+import collections
+import functools
+import json
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import paket_stellar
+import webserver.validation
+
+import benchmarks.fakes
+import benchmarks.throughput
+
+LOCATION = '12.970686,77.595590'
+PACKAGE_DETAILS = {
+    'launcher_phone_number': '+380659731849', 'recipient_phone_number': '+380671976311',
+    'payment_buls': 50000000, 'collateral_buls': 100000000, 'description': 'Package description',
+    'from_location': LOCATION, 'to_location': '41.156193,-8.637541', 'from_address': 'India Bengaluru',
+    'to_address': 'Spain Porto', 'event_location': LOCATION}
+
+
+class LifecycleFailed(Exception):
+    """A lifecycle call did not succeed."""
+
+
+class InProcessClient:
+    """Post to the app without a server."""
+
+    def __init__(self, app):
+        self.host = 'http://localhost'
+        self.client = app.test_client()
+
+    def post(self, path, data, headers):
+        """Post form data, returning the status code and body."""
+        response = self.client.post(path, data=data, headers=headers)
+        return response.status_code, response.data
+
+
+class HttpClient:
+    """Post to a running server."""
+
+    def __init__(self, url):
+        self.host = url.rstrip('/')
+
+    def post(self, path, data, headers):
+        """Post form data, returning the status code and body."""
+        request = urllib.request.Request(
+            self.host + path, data=urllib.parse.urlencode(data).encode(), headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.read()
+
+
+class Recorder:
+    """Collect the latencies and failures of calls, by endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.lifecycles = 0
+
+    def record(self, endpoint, latency, success):
+        """Record a call."""
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            if not success:
+                self.errors[endpoint] += 1
+
+    def get_report(self, elapsed):
+        """Get call counts, errors and latency percentiles in milliseconds, by endpoint."""
+        report = {'seconds': elapsed, 'lifecycles': self.lifecycles, 'endpoints': {}}
+        for endpoint, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            report['endpoints'][endpoint] = dict(calls=len(latencies), errors=self.errors[endpoint], **{
+                "p{}".format(percentile): benchmarks.throughput.get_percentile(latencies, percentile) * 1000
+                for percentile in (50, 95, 99)})
+        return report
+
+
+def get_keypair():
+    """Get a new pubkey and seed."""
+    keypair = paket_stellar.get_keypair()
+    return keypair.address().decode(), keypair.seed().decode()
+
+
+class VirtualUser:
+    """A launcher, courier and recipient, sending packages to each other one at a time."""
+
+    def __init__(self, client, recorder, version, location_updates):
+        self.client = client
+        self.recorder = recorder
+        self.version = version
+        self.location_updates = location_updates
+        self.launcher, self.courier, self.recipient = get_keypair(), get_keypair(), get_keypair()
+
+    def call(self, endpoint, seed, **kwargs):
+        """Make a signed call, recording its latency."""
+        path = "/v{}/{}".format(self.version, endpoint)
+        fingerprint = webserver.validation.generate_fingerprint(self.client.host + path, kwargs)
+        headers = {
+            'Pubkey': paket_stellar.get_keypair(seed=seed).address().decode(), 'Fingerprint': fingerprint,
+            'Signature': webserver.validation.sign_fingerprint(fingerprint, seed)}
+        start = time.perf_counter()
+        status, body = self.client.post(path, kwargs, headers)
+        self.recorder.record(endpoint, time.perf_counter() - start, status < 400)
+        if status >= 400:
+            raise LifecycleFailed("{} failed with {}: {}".format(endpoint, status, body[:200]))
+
+    def run_lifecycle(self):
+        """Create a package and follow it until it is received."""
+        escrow_pubkey = get_keypair()[0]
+        self.call(
+            'create_package', self.launcher[1], escrow_pubkey=escrow_pubkey, recipient_pubkey=self.recipient[0],
+            deadline_timestamp=int(time.time()) + 86400, **PACKAGE_DETAILS)
+        self.call('confirm_couriering', self.courier[1], escrow_pubkey=escrow_pubkey, location=LOCATION)
+        self.call(
+            'assign_xdrs', self.launcher[1], escrow_pubkey=escrow_pubkey, location=LOCATION, kwargs=json.dumps({
+                'escrow_xdrs': {'set_options_transaction': 'AAAA', 'refund_transaction': 'AAAA',
+                                'merge_transaction': 'AAAA', 'payment_transaction': 'AAAA'}}))
+        for _ in range(self.location_updates):
+            self.call('changed_location', self.courier[1], escrow_pubkey=escrow_pubkey, location=LOCATION)
+        self.call('accept_package', self.courier[1], escrow_pubkey=escrow_pubkey, location=LOCATION)
+        self.call('accept_package', self.recipient[1], escrow_pubkey=escrow_pubkey, location=LOCATION)
+        with self.recorder.lock:
+            self.recorder.lifecycles += 1
+
+    def run(self, lifecycles):
+        """Run lifecycles one after the other, abandoning any which fails."""
+        for _ in range(lifecycles):
+            try:
+                self.run_lifecycle()
+            except LifecycleFailed as exc:
+                print(exc)
+
+
+def get_app(dispatch, stellar_latency, firebase_latency):
+    """Get the app, with the external services replaced by fakes, optionally dispatching notifications too."""
+    benchmarks.fakes.install_firebase(firebase_latency)
+    benchmarks.fakes.install_stellar(stellar_latency)
+    benchmarks.fakes.install_geodecoding()
+    # Imported only now, since notifications connects to firebase on import.
+    import dispatcher  # pylint: disable=import-outside-toplevel
+    import routes  # pylint: disable=import-outside-toplevel
+    import swagger_specs  # pylint: disable=import-outside-toplevel
+    assert routes.db.DB_NAME.startswith('test'), "refusing to load db named {}".format(routes.db.DB_NAME)
+    if dispatch:
+        threading.Thread(target=dispatcher.run, daemon=True).start()
+    return webserver.setup(routes.BLUEPRINT, swagger_specs.CONFIG)
+
+
+def main():
+    """Run the load test."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', help='base url of a running server, instead of running the app in process')
+    parser.add_argument('--users', type=int, default=10, help='concurrent virtual users')
+    parser.add_argument('--lifecycles', type=int, default=10, help='packages sent by each virtual user')
+    parser.add_argument('--location-updates', type=int, default=2, help='location changes of each package')
+    parser.add_argument('--version', type=int, default=3, help='API version')
+    parser.add_argument('--stellar-latency', type=float, default=0, help='seconds added to each balance lookup')
+    parser.add_argument('--firebase-latency', type=float, default=0, help='seconds added to each notification')
+    parser.add_argument('--dispatch', action='store_true', help='dispatch notifications in process while loading')
+    parser.add_argument('--output', help='file to write the report to, as JSON')
+    args = parser.parse_args()
+
+    if args.url:
+        make_client = functools.partial(HttpClient, args.url)
+    else:
+        make_client = functools.partial(
+            InProcessClient, get_app(args.dispatch, args.stellar_latency, args.firebase_latency))
+    recorder = Recorder()
+    users = [VirtualUser(make_client(), recorder, args.version, args.location_updates) for _ in range(args.users)]
+    threads = [threading.Thread(target=user.run, args=(args.lifecycles,)) for user in users]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = recorder.get_report(time.perf_counter() - start)
+
+    print("{} lifecycles in {:.1f}s ({:.1f}/s) by {} users".format(
+        report['lifecycles'], report['seconds'], report['lifecycles'] / report['seconds'], args.users))
+    for endpoint, stats in report['endpoints'].items():
+        print("{:>20}: {:6} calls, {:4} errors, p50 {:8.2f}ms, p95 {:8.2f}ms, p99 {:8.2f}ms".format(
+            endpoint, stats['calls'], stats['errors'], stats['p50'], stats['p95'], stats['p99']))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Measure the request throughput and latency of a running router server."""
+import argparse
+import concurrent.futures
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+def request(url, data):
+    """Make a single request, returning its latency in seconds, or None if it failed."""
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, data=data, timeout=30) as response:
+            response.read()
+    except (urllib.error.URLError, OSError):
+        return None
+    return time.perf_counter() - start
+
+
+def get_percentile(latencies, percentile):
+    """Get a percentile of sorted latencies."""
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default='http://127.0.0.1:8000/v3/debug/pool')
+    parser.add_argument('--data', default='', help='urlencoded form data to post, e.g. escrow_pubkey=G...')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    data = args.data.encode()
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(lambda _: request(args.url, data), range(args.requests)))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for latency in results if latency is not None)
+    print("{} requests, {} failed, {:.1f} requests/s".format(
+        len(results), len(results) - len(latencies), len(latencies) / elapsed))
+    if latencies:
+        print("latency ms: p50 {:.1f}, p95 {:.1f}, p99 {:.1f}".format(
+            *(get_percentile(latencies, percentile) * 1000 for percentile in (50, 95, 99))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Negotiated gzip and brotli compression of responses."""
+import os
+import zlib
+
+import flask
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this (in bytes) are not worth compressing.
+THRESHOLD = int(os.environ.get('PAKET_COMPRESSION_THRESHOLD', 1024))
+GZIP_LEVEL = int(os.environ.get('PAKET_COMPRESSION_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('PAKET_COMPRESSION_BROTLI_QUALITY', 5))
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript')
+# Configured once, and copied for each response.
+GZIP_COMPRESSOR = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip_compress(data):
+    """Compress data to the gzip format."""
+    compressor = GZIP_COMPRESSOR.copy()
+    return compressor.compress(data) + compressor.flush()
+
+
+def brotli_compress(data):
+    """Compress data to the brotli format."""
+    return brotli.compress(data, quality=BROTLI_QUALITY)
+
+
+COMPRESSORS = {'gzip': gzip_compress}
+if brotli is not None:
+    COMPRESSORS['br'] = brotli_compress
+# Encodings in order of preference, for clients accepting several equally.
+ENCODINGS = [encoding for encoding in ('br', 'gzip') if encoding in COMPRESSORS]
+
+
+def is_compressible(response):
+    """Check if a response may be compressed at all."""
+    return (
+        200 <= response.status_code < 300 and response.status_code not in (204, 206) and
+        not response.direct_passthrough and 'Content-Encoding' not in response.headers and
+        response.mimetype in COMPRESSIBLE_MIMETYPES)
+
+
+def compress_response(response):
+    """Compress the response with the best encoding accepted by the client, if it is large enough."""
+    if not is_compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = flask.request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None or response.content_length is None or response.content_length < THRESHOLD:
+        return response
+    response.set_data(COMPRESSORS[encoding](response.get_data()))
+    response.headers['Content-Encoding'] = encoding
+    # The compressed response is a different representation, so a strong ETag would no longer be valid.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
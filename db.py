@@ -1,18 +1,27 @@
 """PAKET database interface."""
-import base64
+import contextlib
 import functools
 import json
 import logging
+import math
 import os
+import random
+import threading
 import time
 
-import paket_stellar
+import flask
+import mysql.connector
 import util.db
-import util.distance
 import util.geodecoding
 
+import balances
 import events
+import geocoder
+import metrics
 import notifications
+import photos
+import pool
+import proximity
 
 LOGGER = logging.getLogger('pkt.db')
 DB_HOST = os.environ.get('PAKET_DB_HOST', '127.0.0.1')
@@ -20,7 +29,287 @@ DB_PORT = int(os.environ.get('PAKET_DB_PORT', 3306))
 DB_USER = os.environ.get('PAKET_DB_USER', 'root')
 DB_PASSWORD = os.environ.get('PAKET_DB_PASSWORD')
 DB_NAME = os.environ.get('PAKET_DB_NAME', 'paket')
-SQL_CONNECTION = util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME)
+DB_POOL_SIZE = int(os.environ.get('PAKET_DB_POOL_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('PAKET_DB_POOL_TIMEOUT', 10))
+DB_POOL_PING_INTERVAL = float(os.environ.get('PAKET_DB_POOL_PING_INTERVAL', 30))
+POOL = pool.ConnectionPool(functools.partial(
+    mysql.connector.connect, host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASSWORD, database=DB_NAME),
+                           DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_PING_INTERVAL)
+# Comma separated host[:port] list of read replicas, which read-only functions are routed to.
+DB_REPLICA_HOSTS = [host for host in os.environ.get('PAKET_DB_REPLICA_HOSTS', '').split(',') if host]
+# Replicas lagging more than this (in seconds) behind the primary are not read from.
+DB_REPLICA_MAX_LAG = float(os.environ.get('PAKET_DB_REPLICA_MAX_LAG', 5))
+DB_REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('PAKET_DB_REPLICA_LAG_CHECK_INTERVAL', 5))
+# Reads stick to the primary for this long (in seconds) after a write, so they see their own writes.
+STICKY_PRIMARY_SECONDS = float(os.environ.get('PAKET_DB_STICKY_PRIMARY_SECONDS', 10))
+REPLICA_POOLS = [
+    pool.ConnectionPool(functools.partial(
+        mysql.connector.connect, host=host.partition(':')[0], port=int(host.partition(':')[2] or DB_PORT),
+        user=DB_USER, password=DB_PASSWORD, database=DB_NAME), DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_PING_INTERVAL)
+    for host in DB_REPLICA_HOSTS]
+REPLICA_LAGS = {}
+ROUTING_LOCK = threading.Lock()
+ROUTING_COUNTERS = {'primary': 0, 'replica': 0, 'sticky': 0, 'lagging': 0}
+# Connections to other databases are not pooled.
+UNPOOLED_SQL_CONNECTION = util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME)
+# Holds the connection of threads running outside of a flask app context.
+THREAD_CONNECTION = threading.local()
+
+
+class DictCursor:
+    """
+    Cursor returning rows as dicts keyed by column name.
+    Column names are decoded once per query, working around mysql-connector returning some of them as bytes.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def get_column_names(self):
+        """Get the column names of the current result."""
+        return [
+            name.decode('utf8') if isinstance(name, bytes) else name for name in self.cursor.column_names]
+
+    def execute(self, operation, params=None, multi=False):
+        """Execute an operation, recording its duration."""
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(operation, params, multi)
+        finally:
+            metrics.observe_query(time.perf_counter() - start)
+
+    def executemany(self, operation, seq_params):
+        """Execute an operation with each of a sequence of parameters, recording its duration."""
+        start = time.perf_counter()
+        try:
+            return self.cursor.executemany(operation, seq_params)
+        finally:
+            metrics.observe_query(time.perf_counter() - start)
+
+    def fetchall(self):
+        """Fetch all remaining rows."""
+        rows = self.cursor.fetchall()
+        if not rows:
+            return []
+        column_names = self.get_column_names()
+        return [dict(zip(column_names, row)) for row in rows]
+
+    def fetchone(self):
+        """Fetch the next row, None if there are no more."""
+        row = self.cursor.fetchone()
+        return None if row is None else dict(zip(self.get_column_names(), row))
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def get_connection_holder():
+    """Get the holder of the current connections - the flask app context if there is one, the thread otherwise."""
+    return flask.g if flask.has_app_context() else THREAD_CONNECTION
+
+
+class HeldConnection:
+    """A connection checked out of a pool, with the depth of the blocks using it."""
+
+    def __init__(self, connection_pool):
+        self.pool = connection_pool
+        self.connection = connection_pool.get()
+        self.depth = 0
+        self.broken = False
+
+
+def get_held_connections():
+    """Get the connections held by the current holder, by pool."""
+    holder = get_connection_holder()
+    if getattr(holder, 'sql_connections', None) is None:
+        holder.sql_connections = {}
+    return holder.sql_connections
+
+
+def in_transaction():
+    """Check if a block of the current holder is still open, so its changes are not committed yet."""
+    return any(held.depth for held in get_held_connections().values())
+
+
+def release_connection(_=None):
+    """Return the held connections to their pools, unless they are still in use."""
+    held_connections = get_held_connections()
+    for connection_pool, held in list(held_connections.items()):
+        if not held.depth:
+            connection_pool.put(held.connection, held.broken)
+            del held_connections[connection_pool]
+
+
+def read_only(function):
+    """Allow a function which only reads to be routed to a replica."""
+    @functools.wraps(function)
+    def read_only_function(*args, **kwargs):
+        """Run the function with reads routed to replicas."""
+        holder = get_connection_holder()
+        holder.sql_read_only = getattr(holder, 'sql_read_only', 0) + 1
+        try:
+            return function(*args, **kwargs)
+        finally:
+            holder.sql_read_only -= 1
+    return read_only_function
+
+
+def primary(function):
+    """Route all reads of a function to the primary, even within read-only functions - for reads validating writes."""
+    @functools.wraps(function)
+    def primary_function(*args, **kwargs):
+        """Run the function with all reads going to the primary."""
+        holder = get_connection_holder()
+        holder.sql_primary = getattr(holder, 'sql_primary', 0) + 1
+        try:
+            return function(*args, **kwargs)
+        finally:
+            holder.sql_primary -= 1
+    return primary_function
+
+
+def stick_to_primary(until):
+    """Route all reads to the primary until the given time."""
+    holder = get_connection_holder()
+    holder.sql_primary_until = max(getattr(holder, 'sql_primary_until', 0), until)
+
+
+def get_primary_until():
+    """Get the time until which reads stick to the primary, because of recent writes."""
+    return getattr(get_connection_holder(), 'sql_primary_until', 0)
+
+
+def get_replica_lag(replica_pool):
+    """Get the replication lag (in seconds) of a replica, None if it is not replicating, checked periodically."""
+    with ROUTING_LOCK:
+        checked, lag = REPLICA_LAGS.get(replica_pool, (0, None))
+    if time.time() - checked < DB_REPLICA_LAG_CHECK_INTERVAL:
+        return lag
+    try:
+        connection = replica_pool.get()
+    except (pool.PoolTimeout, mysql.connector.Error):
+        LOGGER.exception("can not connect to replica")
+        lag = None
+    else:
+        broken = False
+        try:
+            cursor = DictCursor(connection.cursor())
+            cursor.execute('SHOW SLAVE STATUS')
+            status = cursor.fetchall()
+            cursor.close()
+            lag = status[0]['Seconds_Behind_Master'] if status else 0
+        except mysql.connector.Error:
+            LOGGER.exception("can not check replica lag")
+            broken, lag = True, None
+        replica_pool.put(connection, broken)
+    with ROUTING_LOCK:
+        REPLICA_LAGS[replica_pool] = time.time(), lag
+    return lag
+
+
+def count_route(route):
+    """Count the routing of a block."""
+    with ROUTING_LOCK:
+        ROUTING_COUNTERS[route] += 1
+
+
+def get_pool():
+    """
+    Get the pool the next block should use.
+    Read-only blocks go to a replica that is not lagging, unless the holder wrote recently, is in a transaction,
+    or is within a function reading from the primary.
+    """
+    held_connections = get_held_connections()
+    holder = get_connection_holder()
+    if not REPLICA_POOLS or not getattr(holder, 'sql_read_only', 0) or getattr(holder, 'sql_primary', 0):
+        return POOL
+    if POOL in held_connections and held_connections[POOL].depth:
+        return POOL
+    if get_primary_until() > time.time():
+        count_route('sticky')
+        return POOL
+    # Replicas are tried in random order to spread the load, preferring one already held.
+    replica_pools = random.sample(REPLICA_POOLS, len(REPLICA_POOLS))
+    for replica_pool in sorted(replica_pools, key=lambda replica_pool: replica_pool not in held_connections):
+        lag = get_replica_lag(replica_pool)
+        if lag is not None and lag <= DB_REPLICA_MAX_LAG:
+            count_route('replica')
+            return replica_pool
+    count_route('lagging')
+    return POOL
+
+
+@contextlib.contextmanager
+def sql_connection(db_name=None):
+    """
+    Get a cursor of a pooled connection.
+    Nested blocks share a single connection, and so do all blocks within a flask app context,
+    until it is released on teardown. The outermost block commits, or rolls back on error.
+    Blocks within read-only functions may be routed to a replica, all others go to the primary.
+    """
+    if db_name not in (None, DB_NAME):
+        with UNPOOLED_SQL_CONNECTION(db_name) as sql:
+            yield sql
+        return
+    connection_pool = get_pool()
+    held_connections = get_held_connections()
+    if connection_pool not in held_connections:
+        held_connections[connection_pool] = HeldConnection(connection_pool)
+    held = held_connections[connection_pool]
+    if connection_pool is POOL:
+        count_route('primary')
+        if not getattr(get_connection_holder(), 'sql_read_only', 0):
+            stick_to_primary(time.time() + STICKY_PRIMARY_SECONDS)
+    held.depth += 1
+    cursor = DictCursor(held.connection.cursor())
+    try:
+        yield cursor
+        if held.depth == 1:
+            held.connection.commit()
+    except BaseException:
+        if held.depth == 1:
+            forget_packages()
+            try:
+                held.connection.rollback()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("rollback failed")
+                held.broken = True
+        raise
+    finally:
+        try:
+            cursor.close()
+        except Exception:  # pylint: disable=broad-except
+            held.broken = True
+        held.depth -= 1
+        if get_connection_holder() is THREAD_CONNECTION or held.broken:
+            release_connection()
+
+
+def reset_connections():
+    """Forget the connections inherited by a forked child process, which belong to its parent."""
+    global THREAD_CONNECTION, ROUTING_LOCK, NEW_EVENTS  # pylint: disable=global-statement
+    for connection_pool in [POOL] + REPLICA_POOLS:
+        connection_pool.reset()
+    THREAD_CONNECTION = threading.local()
+    ROUTING_LOCK = threading.Lock()
+    REPLICA_LAGS.clear()
+    NEW_EVENTS = threading.Condition()
+
+
+def get_routing_stats():
+    """Get connection pool, replica lag and routing metrics."""
+    with ROUTING_LOCK:
+        counters = dict(ROUTING_COUNTERS)
+        lags = {replica_pool: lag for replica_pool, (_, lag) in REPLICA_LAGS.items()}
+    return {
+        'pool': POOL.stats(),
+        'replicas': [
+            dict(replica_pool.stats(), host=host, lag=lags.get(replica_pool))
+            for host, replica_pool in zip(DB_REPLICA_HOSTS, REPLICA_POOLS)],
+        'routing': counters}
+
+
+SQL_CONNECTION = sql_connection
 
 notifications.NOTIFICATION_CODES[events.LAUNCHED] = 100
 notifications.NOTIFICATION_CODES[events.COURIER_CONFIRMED] = 101
@@ -30,66 +319,54 @@ notifications.NOTIFICATION_CODES[events.RECEIVED] = 104
 notifications.NOTIFICATION_CODES[events.LOCATION_CHANGED] = 105
 notifications.NOTIFICATION_CODES[events.ESCROW_XDRS_ASSIGNED] = 110
 notifications.NOTIFICATION_CODES[events.RELAY_XDRS_ASSIGNED] = 111
+NOTIFIED_EVENT_TYPES = (events.LAUNCHED, events.COURIER_CONFIRMED, events.COURIERED, events.RECEIVED)
+# Keep an append-only history of notification token changes, in addition to their current state.
+TOKEN_HISTORY = os.environ.get('PAKET_NOTIFICATION_TOKEN_HISTORY', '').lower() in ('1', 'true', 'yes')
 
 
-class UnknownPackage(Exception):
-    """Unknown package ID."""
+# Package statuses in order of precedence, and the events which set them.
+PACKAGE_STATUSES = ('unknown', 'waiting pickup', 'in transit', 'delivered')
+STATUS_BY_EVENT_TYPE = {events.LAUNCHED: 'waiting pickup', events.COURIERED: 'in transit', events.RECEIVED: 'delivered'}
 
+# Notified whenever this process adds an event, to wake up waiting syncs.
+NEW_EVENTS = threading.Condition()
 
-def jsonable(list_of_dicts):
-    """Fix for mysql-connector bug which makes sql.fetchall() return some keys as (unjsonable) bytes."""
-    return [{
-        key.decode('utf8') if isinstance(key, bytes) else key: val for key, val in dict_.items()
-    } for dict_ in list_of_dicts]
+# Package rows along with their materialized state.
+PACKAGES_SELECT = """
+    SELECT packages.*, package_state.status, package_state.custodian_pubkey, package_state.launch_date
+    FROM packages LEFT JOIN package_state ON package_state.escrow_pubkey = packages.escrow_pubkey"""
 
 
-def init_db():
-    """Initialize the database."""
-    with SQL_CONNECTION() as sql:
-        sql.execute('''
-            CREATE TABLE packages(
-                escrow_pubkey VARCHAR(56) UNIQUE,
-                launcher_pubkey VARCHAR(56),
-                recipient_pubkey VARCHAR(56),
-                launcher_contact VARCHAR(32),
-                recipient_contact VARCHAR(32),
-                payment BIGINT,
-                collateral BIGINT,
-                deadline INTEGER,
-                description VARCHAR(300),
-                from_location VARCHAR(24),
-                to_location VARCHAR(24),
-                from_address VARCHAR(200),
-                to_address VARCHAR(200))''')
-        LOGGER.debug('packages table created')
-        sql.execute('''
-            CREATE TABLE events(
-                idx INTEGER AUTO_INCREMENT,
-                timestamp TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
-                user_pubkey VARCHAR(56) NOT NULL,
-                event_type VARCHAR(20) NOT NULL,
-                location VARCHAR(24) NOT NULL,
-                escrow_pubkey VARCHAR(56) NULL,
-                kwargs LONGTEXT NULL,
-                photo_id INTEGER NULL,
-                FOREIGN KEY(escrow_pubkey) REFERENCES packages(escrow_pubkey))''')
-        LOGGER.debug('events table created')
-        sql.execute('''
-            CREATE TABLE photos(
-                photo_id INTEGER NOT NULL AUTO_INCREMENT PRIMARY KEY,
-                escrow_pubkey VARCHAR(56) NOT NULL,
-                event_type VARCHAR(20) NOT NULL,
-                photo LONGTEXT NOT NULL)''')
-        LOGGER.debug('photos table created')
-        sql.execute('''
-            CREATE TABLE notification_tokens(
-                user_pubkey VARCHAR(56),
-                token VARCHAR(200),
-                active BOOLEAN,
-                timestamp TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6))''')
-        LOGGER.debug('notification_tokens table created')
+class UnknownPackage(Exception):
+    """Unknown package ID."""
 
 
+def parse_location(location):
+    """Parse a "latitude,longitude" string into a pair of floats."""
+    try:
+        latitude, longitude = (float(coordinate) for coordinate in location.split(','))
+    except (AttributeError, ValueError):
+        raise ValueError("invalid GPS location {}".format(location))
+    return latitude, longitude
+
+
+def get_bounding_box(location, radius):
+    """
+    Get the (min_latitude, max_latitude, min_longitude, max_longitude) box containing all points within radius.
+    Longitudes are not normalized, so min_longitude may be below -180 and max_longitude may be above 180.
+    """
+    latitude, longitude = parse_location(location)
+    angular_radius = radius / proximity.EARTH_RADIUS_KM
+    latitude_delta = math.degrees(angular_radius)
+    min_latitude, max_latitude = latitude - latitude_delta, latitude + latitude_delta
+    if min_latitude <= -90 or max_latitude >= 90 or angular_radius >= math.pi / 2:
+        # The circle contains a pole, so every longitude is in range.
+        return max(min_latitude, -90), min(max_latitude, 90), -180, 180
+    longitude_delta = math.degrees(math.asin(math.sin(angular_radius) / math.cos(math.radians(latitude))))
+    return min_latitude, max_latitude, longitude - longitude_delta, longitude + longitude_delta
+
+
+@primary
 def accept_package(user_pubkey, escrow_pubkey, location, kwargs=None, photo=None):
     """Accept a package."""
     package = get_package(escrow_pubkey)
@@ -102,64 +379,7 @@ def confirm_couriering(user_pubkey, escrow_pubkey, location, kwargs=None, photo=
     add_event(user_pubkey, events.COURIER_CONFIRMED, location, escrow_pubkey, kwargs=kwargs, photo=photo)
 
 
-def send_notification(event_type, escrow_pubkey):
-    """Send notification to users."""
-    if not escrow_pubkey or event_type not in (
-            events.LAUNCHED, events.COURIER_CONFIRMED, events.COURIERED, events.RECEIVED):
-        return
-
-    package = get_package(escrow_pubkey)
-    notification_body = 'Please check your Packages archive for more details'
-    notification_code = notifications.NOTIFICATION_CODES.get(event_type, 0)
-    if event_type == events.LAUNCHED:
-        notifications.send_notifications(
-            tokens=get_active_tokens(package['recipient_pubkey']),
-            title="You have new package {}".format(package['short_package_id']),
-            body=notification_body,
-            notification_code=notification_code,
-            short_package_id=package['short_package_id'])
-    elif event_type == events.COURIER_CONFIRMED:
-        notifications.send_notifications(
-            tokens=get_active_tokens(package['launcher_pubkey']),
-            title="Courier confirmed for package {}".format(package['short_package_id']),
-            body=notification_body,
-            notification_code=notification_code,
-            short_package_id=package['short_package_id'])
-    elif event_type == events.COURIERED:
-        notifications.send_notifications(
-            tokens=get_active_tokens(package['recipient_pubkey']),
-            title="Your package {} in transit".format(package['short_package_id']),
-            body=notification_body,
-            notification_code=notification_code,
-            short_package_id=package['short_package_id'])
-    elif event_type == events.RECEIVED:
-        notifications.send_notifications(
-            tokens=get_active_tokens(package['launcher_pubkey']),
-            title="Your package {} delivered".format(package['short_package_id']),
-            body=notification_body,
-            notification_code=notification_code,
-            short_package_id=package['short_package_id'])
-
-
-def add_event(user_pubkey, event_type, location, escrow_pubkey=None, kwargs=None, photo=None):
-    """Add a package event."""
-    with SQL_CONNECTION() as sql:
-        photo_id = None
-        if photo is not None:
-            photo = base64.b64encode(photo)
-            sql.execute("""
-                INSERT INTO photos (escrow_pubkey, event_type, photo)
-                VALUES (%s, %s, %s)""", (escrow_pubkey, event_type, photo))
-            sql.execute('SELECT photo_id FROM photos ORDER BY photo_id DESC LIMIT 1')
-            photo_id = sql.fetchone()['photo_id']
-
-        sql.execute("""
-            INSERT INTO events (user_pubkey, event_type, location, escrow_pubkey, kwargs, photo_id)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, (user_pubkey, event_type, location, escrow_pubkey, kwargs, photo_id))
-    send_notification(event_type, escrow_pubkey)
-
-
+@primary
 def assign_xdrs(escrow_pubkey, user_pubkey, location, kwargs, photo=None):
     """Assign XDR transactions to package."""
     package = get_package(escrow_pubkey)
@@ -174,6 +394,7 @@ def assign_xdrs(escrow_pubkey, user_pubkey, location, kwargs, photo=None):
         raise AssertionError('user unauthorized to assign XDRs')
 
 
+@primary
 def request_relay(user_pubkey, escrow_pubkey, location, kwargs, photo=None):
     """Add `relay required` event."""
     # check if package exist
@@ -181,6 +402,151 @@ def request_relay(user_pubkey, escrow_pubkey, location, kwargs, photo=None):
     add_event(user_pubkey, events.RELAY_REQUIRED, location, escrow_pubkey, kwargs=kwargs, photo=photo)
 
 
+def send_notification(event_type, escrow_pubkey, job_id=None):
+    """
+    Send notification to users.
+    Tokens notified by an earlier attempt of the outbox job are skipped, and the tokens notified by this attempt
+    are recorded batch by batch. Raises NotificationsFailed if some tokens should be notified again later.
+    """
+    if not escrow_pubkey or event_type not in NOTIFIED_EVENT_TYPES:
+        return
+
+    package = get_package(escrow_pubkey)
+    user_pubkey, title = {
+        events.LAUNCHED: (package['recipient_pubkey'], "You have new package {}"),
+        events.COURIER_CONFIRMED: (package['launcher_pubkey'], "Courier confirmed for package {}"),
+        events.COURIERED: (package['recipient_pubkey'], "Your package {} in transit"),
+        events.RECEIVED: (package['launcher_pubkey'], "Your package {} delivered")}[event_type]
+    tokens = get_active_tokens(user_pubkey)
+    if job_id is not None:
+        delivered_tokens = get_delivered_tokens(job_id)
+        tokens = [token for token in tokens if token not in delivered_tokens]
+
+    def record_batch(done_tokens, dead_tokens):
+        for token in dead_tokens:
+            remove_notification_token(user_pubkey, token)
+        if job_id is not None:
+            add_delivered_tokens(job_id, done_tokens)
+
+    _, retry_tokens = notifications.send_notifications(
+        tokens=tokens,
+        title=title.format(package['short_package_id']),
+        body='Please check your Packages archive for more details',
+        notification_code=notifications.NOTIFICATION_CODES.get(event_type, 0),
+        short_package_id=package['short_package_id'],
+        on_batch=record_batch)
+    if retry_tokens:
+        raise notifications.NotificationsFailed("{} of {} notifications failed temporarily".format(
+            len(retry_tokens), len(tokens)))
+
+
+def add_event(user_pubkey, event_type, location, escrow_pubkey=None, kwargs=None, photo=None):
+    """Add a package event."""
+    with SQL_CONNECTION() as sql:
+        photo_id = None
+        if photo is not None:
+            # Only photo metadata goes into the database, the content itself is kept in the photo store.
+            content_hash = photos.STORE.put(photo)
+            photos.generate_thumbnails(content_hash, photo)
+            sql.execute("""
+                INSERT INTO photos (escrow_pubkey, event_type, content_hash, content_type, size)
+                VALUES (%s, %s, %s, %s, %s)""", (
+                    escrow_pubkey, event_type, content_hash, photos.get_content_type(photo), len(photo)))
+            photo_id = sql.lastrowid
+
+        sql.execute("""
+            INSERT INTO events (user_pubkey, event_type, location, escrow_pubkey, kwargs, photo_id)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (user_pubkey, event_type, location, escrow_pubkey, kwargs, photo_id))
+        if escrow_pubkey is not None:
+            event, state = update_package_state(sql, sql.lastrowid)
+            if event_type in NOTIFIED_EVENT_TYPES:
+                # Notifications are sent by the dispatcher, once this transaction is committed.
+                sql.execute("""
+                    INSERT INTO notification_outbox (event_type, escrow_pubkey)
+                    VALUES (%s, %s)""", (event_type, escrow_pubkey))
+    if escrow_pubkey is not None:
+        remember_event(escrow_pubkey, dict(
+            timestamp=event['timestamp'], user_pubkey=user_pubkey, event_type=event_type, location=location,
+            kwargs=kwargs, photo_id=photo_id), state)
+    with NEW_EVENTS:
+        NEW_EVENTS.notify_all()
+
+
+def get_package_cache():
+    """Get the packages loaded in this request by escrow pubkey, or None outside of a flask app context."""
+    if not flask.has_app_context():
+        return None
+    if 'packages' not in flask.g:
+        flask.g.packages = {}
+    return flask.g.packages
+
+
+def forget_packages(*escrow_pubkeys):
+    """Drop packages (all of them if none are given) from the packages loaded in this request."""
+    cache = get_package_cache()
+    if cache is not None:
+        for escrow_pubkey in escrow_pubkeys or list(cache):
+            cache.pop(escrow_pubkey, None)
+
+
+def remember_event(escrow_pubkey, event, state):
+    """Apply a committed event to the package, if it was loaded in this request."""
+    cache = get_package_cache()
+    if cache is None or escrow_pubkey not in cache:
+        return
+    if in_transaction():
+        # The event is not committed yet, so it may still be rolled back.
+        forget_packages(escrow_pubkey)
+        return
+    package, package_events = cache[escrow_pubkey]
+    package_events.append(event)
+    package.update(
+        status=state['status'], custodian_pubkey=state['custodian_pubkey'], launch_date=state['launch_date'])
+
+
+def fold_package_state(state, event):
+    """Apply an event to a package state (None for a package without events), returning the new state."""
+    state = dict(state or {
+        'status': PACKAGE_STATUSES[0], 'custodian_pubkey': None, 'launch_date': None,
+        'last_event_type': None, 'last_idx': 0})
+    new_status = STATUS_BY_EVENT_TYPE.get(event['event_type'])
+    if new_status and PACKAGE_STATUSES.index(new_status) > PACKAGE_STATUSES.index(state['status']):
+        state['status'] = new_status
+    if event['event_type'] == events.LAUNCHED and state['launch_date'] is None:
+        state['launch_date'] = event['timestamp']
+    # Concurrent writers may fold events out of order, the latest event always wins.
+    if event['idx'] > state['last_idx']:
+        state['custodian_pubkey'] = event['user_pubkey']
+        state['last_idx'] = event['idx']
+        if event['event_type'] != events.LOCATION_CHANGED:
+            state['last_event_type'] = event['event_type']
+    return state
+
+
+def update_package_state(sql, event_idx):
+    """Fold a newly added event into the state of its package, within the transaction that added it."""
+    sql.execute("""
+        SELECT idx, timestamp, user_pubkey, event_type, escrow_pubkey FROM events
+        WHERE idx = %s""", (event_idx,))
+    event = sql.fetchall()[0]
+    sql.execute("""
+        SELECT status, custodian_pubkey, launch_date, last_event_type, last_idx FROM package_state
+        WHERE escrow_pubkey = %s FOR UPDATE""", (event['escrow_pubkey'],))
+    states = sql.fetchall()
+    state = fold_package_state(states[0] if states else None, event)
+    sql.execute("""
+        INSERT INTO package_state (escrow_pubkey, status, custodian_pubkey, launch_date, last_event_type, last_idx)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            status = VALUES(status), custodian_pubkey = VALUES(custodian_pubkey), launch_date = VALUES(launch_date),
+            last_event_type = VALUES(last_event_type), last_idx = VALUES(last_idx)""", (
+                event['escrow_pubkey'], state['status'], state['custodian_pubkey'], state['launch_date'],
+                state['last_event_type'], state['last_idx']))
+    return event, state
+
+
+@read_only
 def get_events(from_time, till_time):
     """Get all user and package events up to a limit."""
     with SQL_CONNECTION() as sql:
@@ -191,49 +557,67 @@ def get_events(from_time, till_time):
                 ORDER BY idx DESC LIMIT 50
             ''')
             recent_package_events = sql.fetchall()
-            from_time = from_time or recent_package_events[-1][b'timestamp']
-            till_time = till_time or recent_package_events[0][b'timestamp']
+            from_time = from_time or recent_package_events[-1]['timestamp']
+            till_time = till_time or recent_package_events[0]['timestamp']
         sql.execute("""
             SELECT * FROM events
             WHERE timestamp BETWEEN FROM_UNIXTIME(%s) AND FROM_UNIXTIME(%s)
             ORDER BY idx DESC""", (
                 from_time, till_time))
-        return jsonable(sql.fetchall())
+        return sql.fetchall()
 
 
+@read_only
 def get_package_events(escrow_pubkey):
     """Get a list of events relating to a package."""
+    return get_packages_events([escrow_pubkey])[escrow_pubkey]
+
+
+@read_only
+def get_packages_events(escrow_pubkeys):
+    """Get lists of events relating to several packages in a single query, keyed by escrow pubkey."""
+    events_by_package = {escrow_pubkey: [] for escrow_pubkey in escrow_pubkeys}
+    if not events_by_package:
+        return events_by_package
     with SQL_CONNECTION() as sql:
         sql.execute("""
-            SELECT timestamp, user_pubkey, event_type, location, kwargs, photo_id
+            SELECT escrow_pubkey, timestamp, user_pubkey, event_type, location, kwargs, photo_id
             FROM events
-            WHERE escrow_pubkey = %s
-            ORDER BY timestamp ASC""", (escrow_pubkey,))
-        return jsonable(sql.fetchall())
-
-
-def set_package_status(package, event_types):
-    """Set package status depending on package events."""
-    if events.RECEIVED in event_types:
-        package['status'] = 'delivered'
-    elif events.COURIERED in event_types:
-        package['status'] = 'in transit'
-    elif events.LAUNCHED in event_types:
-        package['status'] = 'waiting pickup'
-    else:
-        package['status'] = 'unknown'
+            WHERE escrow_pubkey IN ({})
+            ORDER BY timestamp ASC""".format(', '.join(['%s'] * len(events_by_package))), tuple(events_by_package))
+        for event in sql.fetchall():
+            events_by_package[event.pop('escrow_pubkey')].append(event)
+    return events_by_package
+
+
+def get_country_code(location):
+    """
+    Get the country code of a location, None if it can not be found.
+    The offline geocoder is tried first, the geodecoding service only for locations it can not resolve.
+    """
+    try:
+        country_code = geocoder.lookup(*parse_location(location))
+    except ValueError:
+        country_code = None
+    if country_code:
+        return country_code
+    try:
+        with metrics.timed_call('geodecoding', 'gps_to_country_code'):
+            return util.geodecoding.gps_to_country_code(location) or None
+    except util.geodecoding.GeodecodingError as exc:
+        LOGGER.error(str(exc))
+        return None
+
+
+def format_short_package_id(escrow_pubkey, country_code):
+    """Format short package id from country code of destination and last three letters of package id."""
+    return "{}-{}".format(country_code or 'XX', escrow_pubkey[-3:])
 
 
 @functools.lru_cache()
 def get_short_package_id(escrow_pubkey, to_location):
-    """Set short package id, based on country code of destination and last three letters of package id."""
-    try:
-        country_code = util.geodecoding.gps_to_country_code(to_location)
-    except util.geodecoding.GeodecodingError as exc:
-        LOGGER.error(str(exc))
-        country_code = ''
-    three_letters_code = escrow_pubkey[-3:]
-    return "{}-{}".format(country_code or 'XX', three_letters_code)
+    """Get short package id of a package stored before short package ids were."""
+    return format_short_package_id(escrow_pubkey, get_country_code(to_location))
 
 
 def set_user_role(package, user_role, user_pubkey):
@@ -263,124 +647,183 @@ def extract_xdrs(package):
     package['relays_xdrs'] = relay_xdrs_events
 
 
-def enrich_package(package, user_role=None, user_pubkey=None, check_solvency=False, check_escrow=False):
+def get_balance_pubkeys(packages, check_solvency=False, check_escrow=False):
+    """Get the pubkeys of accounts which balances are required for enriching packages."""
+    return [package['launcher_pubkey'] for package in packages if check_solvency] + [
+        package['escrow_pubkey'] for package in packages if check_escrow]
+
+
+def enrich_package(
+        package, user_role=None, user_pubkey=None, check_solvency=False, check_escrow=False, package_events=None,
+        bul_balances=None):
     """Add some periferal data to the package object."""
-    package['short_package_id'] = get_short_package_id(package['escrow_pubkey'], package['to_location'])
+    package['short_package_id'] = package.get('short_package_id') or get_short_package_id(
+        package['escrow_pubkey'], package['to_location'])
     package['blockchain_url'] = "https://testnet.steexp.com/account/{}#signing".format(package['escrow_pubkey'])
     package['paket_url'] = "https://paket.global/paket/{}".format(package['escrow_pubkey'])
-    package['events'] = get_package_events(package['escrow_pubkey'])
-    event_types = {event['event_type'] for event in package['events']}
-    if package['events']:
-        package['custodian_pubkey'] = package['events'][-1]['user_pubkey']
-        launch_event = next((event for event in package['events'] if event['event_type'] == events.LAUNCHED), None)
-        package['launch_date'] = launch_event['timestamp'] if launch_event is not None else None
-    else:
-        package['custodian_pubkey'] = None
-        package['launch_date'] = None
+    package['events'] = get_package_events(
+        package['escrow_pubkey']) if package_events is None else package_events
+    # Status, custodian and launch date come from the package state joined to the package row.
+    package['status'] = package.get('status') or PACKAGE_STATUSES[0]
+    package['custodian_pubkey'] = package.get('custodian_pubkey')
+    package['launch_date'] = package.get('launch_date')
+    if not package['events']:
         LOGGER.warning("eventless package: %s", package)
 
     extract_xdrs(package)
-    set_package_status(package, event_types)
     set_user_role(package, user_role, user_pubkey)
 
+    if bul_balances is None:
+        bul_balances = balances.get_bul_balances(get_balance_pubkeys([package], check_solvency, check_escrow))
+
     if check_solvency:
-        try:
-            launcher_account = paket_stellar.get_bul_account(package['launcher_pubkey'])
-        except (paket_stellar.TrustError, paket_stellar.StellarAccountNotExists):
-            package['launcher_solvency'] = False
-        else:
-            package['launcher_solvency'] = launcher_account['bul_balance'] >= package['payment']
+        launcher_balance = bul_balances[package['launcher_pubkey']]
+        package['launcher_solvency'] = launcher_balance is not None and launcher_balance >= package['payment']
 
     if check_escrow:
-        try:
-            escrow_account = paket_stellar.get_bul_account(package['escrow_pubkey'])
-        except (paket_stellar.TrustError, paket_stellar.StellarAccountNotExists):
+        escrow_balance = bul_balances[package['escrow_pubkey']]
+        if escrow_balance is None:
             package['payment_deposited'] = package['collateral_deposited'] = package['correctly_deposited'] = False
         else:
-            package['payment_deposited'] = escrow_account['bul_balance'] >= package['payment']
-            package['collateral_deposited'] = (
-                escrow_account['bul_balance'] >= package['payment'] + package['collateral'])
-            package['correctly_deposited'] = (
-                escrow_account['bul_balance'] == package['payment'] + package['collateral'])
+            package['payment_deposited'] = escrow_balance >= package['payment']
+            package['collateral_deposited'] = escrow_balance >= package['payment'] + package['collateral']
+            package['correctly_deposited'] = escrow_balance == package['payment'] + package['collateral']
 
     return package
 
 
+def enrich_packages(
+        packages, user_role=None, user_pubkey=None, check_solvency=False, check_escrow=False, user_roles=None,
+        events_by_package=None):
+    """
+    Add some periferal data to a list of package objects.
+    Events of all packages are loaded in a single query (unless given), and account balances are looked up
+    concurrently. A separate role for each package can be given in user_roles.
+    """
+    if events_by_package is None:
+        events_by_package = get_packages_events([package['escrow_pubkey'] for package in packages])
+    bul_balances = balances.get_bul_balances(get_balance_pubkeys(packages, check_solvency, check_escrow))
+    return [
+        enrich_package(
+            package, package_role, user_pubkey, check_solvency, check_escrow,
+            events_by_package[package['escrow_pubkey']], bul_balances)
+        for package, package_role in zip(packages, user_roles or [user_role] * len(packages))]
+
+
 # pylint: disable=too-many-locals
 def create_package(
         escrow_pubkey, launcher_pubkey, recipient_pubkey, launcher_contact, recipient_contact, payment, collateral,
         deadline, description, from_location, to_location, from_address, to_address, event_location, photo=None):
     """Create a new package row."""
+    try:
+        from_latitude, from_longitude = parse_location(from_location)
+    except ValueError:
+        LOGGER.warning("package %s created with invalid from_location %s", escrow_pubkey, from_location)
+        from_latitude = from_longitude = None
+    # Packages which country code can not be found now are retried by backfill_country_codes.
+    country_code = get_country_code(to_location)
     with SQL_CONNECTION() as sql:
         sql.execute("""
             INSERT INTO packages (
                 escrow_pubkey, launcher_pubkey, recipient_pubkey, launcher_contact, recipient_contact, payment,
-                collateral, deadline, description, from_location, to_location, from_address, to_address
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""", (
+                collateral, deadline, description, from_location, to_location, from_address, to_address,
+                from_latitude, from_longitude, country_code, short_package_id
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""", (
                 escrow_pubkey, launcher_pubkey, recipient_pubkey, launcher_contact, recipient_contact, payment,
-                collateral, deadline, description, from_location, to_location, from_address, to_address))
+                collateral, deadline, description, from_location, to_location, from_address, to_address,
+                from_latitude, from_longitude, country_code, format_short_package_id(escrow_pubkey, country_code)))
     add_event(launcher_pubkey, events.LAUNCHED, event_location, escrow_pubkey, photo=photo)
     return get_package(escrow_pubkey)
 # pylint: enable=too-many-locals
 
 
+@read_only
 def get_package(escrow_pubkey, check_escrow=False):
-    """Get package details."""
-    with SQL_CONNECTION() as sql:
-        sql.execute("SELECT * FROM packages WHERE escrow_pubkey = %s", (escrow_pubkey,))
-        try:
-            return enrich_package(sql.fetchone(), check_escrow=check_escrow)
-        except TypeError:
+    """
+    Get package details.
+    Within a request, the package row and events are loaded once, and kept up to date by add_event.
+    """
+    cache = get_package_cache()
+    if cache is None or escrow_pubkey not in cache:
+        with SQL_CONNECTION() as sql:
+            sql.execute(PACKAGES_SELECT + " WHERE packages.escrow_pubkey = %s", (escrow_pubkey,))
+            packages = sql.fetchall()
+        if not packages:
             raise UnknownPackage("package {} is not valid".format(escrow_pubkey))
+        package_events = get_packages_events([escrow_pubkey])[escrow_pubkey]
+        if cache is not None:
+            cache[escrow_pubkey] = packages[0], package_events
+    else:
+        packages, package_events = [cache[escrow_pubkey][0]], cache[escrow_pubkey][1]
+    # Enrichment modifies the package and may be given to callers, so it works on copies.
+    return enrich_packages(
+        [dict(packages[0])], check_escrow=check_escrow,
+        events_by_package={escrow_pubkey: [dict(event) for event in package_events]})[0]
+
+
+@read_only
+def get_package_etag(escrow_pubkey, check_escrow=False):
+    """
+    Get a tag which changes whenever get_package would return something else, None for an unknown package.
+    Any new event changes the last event idx of the package, the short package id and country code are included
+    since backfill_country_codes changes them without an event, and with check_escrow the balance is included too.
+    """
+    with SQL_CONNECTION() as sql:
+        sql.execute('''
+            SELECT package_state.last_idx, packages.short_package_id, packages.country_code FROM package_state
+            JOIN packages ON packages.escrow_pubkey = package_state.escrow_pubkey
+            WHERE package_state.escrow_pubkey = %s''', (escrow_pubkey,))
+        states = sql.fetchall()
+    if not states:
+        return None
+    etag = "{}-{}-{}-{}".format(
+        escrow_pubkey, states[0]['last_idx'], states[0]['short_package_id'], states[0]['country_code'])
+    if check_escrow:
+        return "{}-{}".format(etag, balances.get_bul_balance(escrow_pubkey))
+    return etag
 
 
-def get_available_packages(location, radius=5):
-    """Get available packages with acceptable deadline."""
-    with SQL_CONNECTION() as sql:
-        current_time = int(time.time())
-        sql.execute("""
-            SELECT escrow_pubkey as package_escrow_pubkey, packages.* FROM packages
-            HAVING ((
-                SELECT event_type FROM events
-                WHERE escrow_pubkey = package_escrow_pubkey AND event_type != %s
-                ORDER BY timestamp DESC LIMIT 1)
-                IN (%s, %s))
-            AND deadline > %s""", (events.LOCATION_CHANGED, events.LAUNCHED, events.RELAY_REQUIRED, current_time))
-        packages = [enrich_package(row, check_solvency=True) for row in sql.fetchall()]
-        filtered_by_location = [package for package in packages if util.distance.haversine(
-            location, package['from_location']) <= radius]
-        return filtered_by_location
-
-
-def get_packages(user_pubkey=None):
-    """Get a list of packages."""
+@read_only
+def get_packages_by_short_id(short_package_id):
+    """Get packages by short package id (which is not necessarily unique)."""
     with SQL_CONNECTION() as sql:
-        if user_pubkey:
-            sql.execute("""
-            SELECT * FROM packages
-            WHERE launcher_pubkey = %s""", (user_pubkey,))
-            launched = [enrich_package(row, user_role='launcher') for row in sql.fetchall()]
-            sql.execute("""
-            SELECT * FROM packages
-            WHERE recipient_pubkey = %s""", (user_pubkey,))
-            received = [enrich_package(row, user_role='recipient') for row in sql.fetchall()]
-            sql.execute("""
-            SELECT * FROM packages
-            WHERE escrow_pubkey IN (
-                SELECT escrow_pubkey FROM events
-                WHERE event_type IN(%s, %s) AND user_pubkey = %s)""",
-                        (events.COURIERED, events.COURIER_CONFIRMED, user_pubkey))
-            couriered = [enrich_package(row, user_role='courier') for row in sql.fetchall()]
-            return launched + received + couriered
-        sql.execute('SELECT * FROM packages')
-        return [enrich_package(row) for row in sql.fetchall()]
+        sql.execute(PACKAGES_SELECT + """
+        WHERE packages.short_package_id = %s
+        ORDER BY packages.escrow_pubkey""", (short_package_id,))
+        return enrich_packages(sql.fetchall())
 
 
+@read_only
+def get_available_packages(location, radius=5):
+    """Get available packages with acceptable deadline, nearest first."""
+    min_latitude, max_latitude, min_longitude, max_longitude = get_bounding_box(location, radius)
+    if min_longitude < -180 or max_longitude > 180:
+        # The box crosses the antimeridian, so it wraps around into two longitude ranges.
+        longitude_condition = 'from_longitude >= %s OR from_longitude <= %s'
+        longitude_range = ((min_longitude + 180) % 360 - 180, (max_longitude + 180) % 360 - 180)
+    else:
+        longitude_condition = 'from_longitude BETWEEN %s AND %s'
+        longitude_range = (min_longitude, max_longitude)
+    with SQL_CONNECTION() as sql:
+        current_time = int(time.time())
+        sql.execute(PACKAGES_SELECT + """
+            WHERE package_state.last_event_type IN (%s, %s) AND deadline > %s
+            AND from_latitude BETWEEN %s AND %s AND ({})""".format(longitude_condition), (
+                events.LAUNCHED, events.RELAY_REQUIRED, current_time, min_latitude, max_latitude) + longitude_range)
+        candidates = sql.fetchall()
+    latitude, longitude = parse_location(location)
+    _, order, _ = proximity.get_nearby(
+        latitude, longitude, [package['from_latitude'] for package in candidates],
+        [package['from_longitude'] for package in candidates], radius)
+    return enrich_packages([candidates[index] for index in order], check_solvency=True)
+
+
+@read_only
 def get_event_photo_by_id(photo_id):
-    """Get event photo by photo id."""
+    """Get event photo metadata by photo id."""
     with SQL_CONNECTION() as sql:
         sql.execute('''
-            SELECT * FROM photos
+            SELECT photo_id, escrow_pubkey, event_type, content_hash, content_type, size FROM photos
             WHERE photo_id = %s''', (photo_id,))
         try:
             return sql.fetchall()[0]
@@ -388,15 +831,18 @@ def get_event_photo_by_id(photo_id):
             return None
 
 
+@read_only
 def get_event_photos(escrow_pubkey, event_type):
-    """Get event photos."""
+    """Get event photos metadata."""
     with SQL_CONNECTION() as sql:
         sql.execute('''
-            SELECT * FROM photos
-            WHERE escrow_pubkey = %s AND event_type = %s''', (escrow_pubkey, event_type))
+            SELECT photo_id, escrow_pubkey, event_type, content_hash, content_type, size FROM photos
+            WHERE escrow_pubkey = %s AND event_type = %s
+            ORDER BY photo_id ASC''', (escrow_pubkey, event_type))
         return sql.fetchall()
 
 
+@read_only
 def get_package_photo(escrow_pubkey):
     """Get package photo."""
     event_photos = get_event_photos(escrow_pubkey, 'launched')
@@ -410,63 +856,110 @@ def changed_location(user_pubkey, location, escrow_pubkey, kwargs=None, photo=No
 
 def set_notification_token(user_pubkey, notification_token):
     """Set notification token."""
-    short_token = notification_token[-7:]
     with SQL_CONNECTION() as sql:
         sql.execute('''
-            SELECT active FROM notification_tokens
-            WHERE user_pubkey = %s AND token = %s
-            ORDER BY timestamp DESC LIMIT 1''', (user_pubkey, notification_token))
-        try:
-            last_token = sql.fetchall()[-1]
-        except IndexError:
-            LOGGER.info("user %s has not token %s yet", user_pubkey, short_token)
-        else:
-            if last_token['active']:
-                LOGGER.info("token %s already active and no need to be updated", short_token)
-                return
-            LOGGER.info("token %s is inactive and will be updated", short_token)
+            INSERT INTO notification_token_state (user_pubkey, token, active)
+            VALUES (%s, %s, TRUE)
+            ON DUPLICATE KEY UPDATE
+                updated = IF(active, updated, CURRENT_TIMESTAMP(6)), active = TRUE''', (
+                    user_pubkey, notification_token))
+        if TOKEN_HISTORY:
+            sql.execute('''
+                INSERT INTO notification_tokens (user_pubkey, token, active)
+                VALUES (%s, %s, %s)''', (user_pubkey, notification_token, True))
+    LOGGER.info("token %s set for %s", notification_token[-7:], user_pubkey)
+
 
+def remove_notification_token(user_pubkey, notification_token):
+    """Remove notification token."""
     with SQL_CONNECTION() as sql:
         sql.execute('''
-            INSERT INTO notification_tokens (user_pubkey, token, active)
-            VALUES (%s, %s, %s)''', (user_pubkey, notification_token, True))
-    LOGGER.info("token %s added for %s", short_token, user_pubkey)
+            UPDATE notification_token_state SET updated = CURRENT_TIMESTAMP(6), active = FALSE
+            WHERE user_pubkey = %s AND token = %s AND active''', (user_pubkey, notification_token))
+        if TOKEN_HISTORY:
+            sql.execute('''
+                INSERT INTO notification_tokens (user_pubkey, token, active)
+                VALUES (%s, %s, %s)''', (user_pubkey, notification_token, False))
+    LOGGER.info("token %s removed for %s", notification_token[-7:], user_pubkey)
 
 
-def remove_notification_token(user_pubkey, notification_token):
-    """Remove notification token."""
-    short_token = notification_token[-7:]
+@read_only
+def get_active_tokens(user_pubkey):
+    """Get all active user notification tokens."""
     with SQL_CONNECTION() as sql:
         sql.execute('''
-            SELECT active FROM notification_tokens
-            WHERE user_pubkey = %s AND token = %s
-            ORDER BY timestamp DESC LIMIT 1''', (user_pubkey, notification_token))
-        try:
-            last_token = sql.fetchall()[-1]
-        except IndexError:
-            LOGGER.info("user %s has not token %s yet", user_pubkey, short_token)
-            return
-        else:
-            if not last_token['active']:
-                LOGGER.info("token %s already inactive and no need to be updated", short_token)
-                return
-            LOGGER.info("token %s is active and will be updated", short_token)
+            SELECT token AS notification_token FROM notification_token_state
+            WHERE user_pubkey = %s AND active''', (user_pubkey,))
+        return [row['notification_token'] for row in sql.fetchall()]
 
+
+def claim_notification_jobs(limit, max_attempts, lease):
+    """
+    Claim due notification jobs from the outbox.
+    Claimed jobs are hidden from other dispatchers for `lease` seconds, after which they are retried,
+    unless they have already been attempted `max_attempts` times - these are moved to the dead letters.
+    """
     with SQL_CONNECTION() as sql:
         sql.execute('''
-            INSERT INTO notification_tokens (user_pubkey, token, active)
-            VALUES (%s, %s, %s)''', (user_pubkey, notification_token, False))
+            SELECT job_id, event_type, escrow_pubkey, attempts FROM notification_outbox
+            WHERE next_attempt <= CURRENT_TIMESTAMP(6)
+            ORDER BY next_attempt ASC LIMIT %s FOR UPDATE''', (limit,))
+        jobs = sql.fetchall()
+        # Jobs which lease expired on their last attempt are not retried.
+        exhausted_job_ids = [job['job_id'] for job in jobs if job['attempts'] >= max_attempts]
+        if exhausted_job_ids:
+            move_to_dead_letters(sql, exhausted_job_ids)
+            jobs = [job for job in jobs if job['attempts'] < max_attempts]
+        if jobs:
+            sql.execute('''
+                UPDATE notification_outbox
+                SET attempts = attempts + 1, next_attempt = CURRENT_TIMESTAMP(6) + INTERVAL %s SECOND
+                WHERE job_id IN ({})'''.format(', '.join(['%s'] * len(jobs))), (
+                    lease,) + tuple(job['job_id'] for job in jobs))
+    return jobs
 
 
-def get_active_tokens(user_pubkey):
-    """Get all active user notification tokens."""
+def get_delivered_tokens(job_id):
+    """Get the tokens an outbox job already notified (or failed to notify for good)."""
+    with SQL_CONNECTION() as sql:
+        sql.execute('SELECT token FROM notification_deliveries WHERE job_id = %s', (job_id,))
+        return {row['token'] for row in sql.fetchall()}
+
+
+def add_delivered_tokens(job_id, tokens):
+    """Record tokens an outbox job notified, so they are not notified again if the job is retried."""
+    with SQL_CONNECTION() as sql:
+        sql.executemany('''
+            INSERT IGNORE INTO notification_deliveries (job_id, token)
+            VALUES (%s, %s)''', [(job_id, token) for token in tokens])
+
+
+def complete_notification_job(job_id):
+    """Remove a sent notification job from the outbox."""
+    with SQL_CONNECTION() as sql:
+        sql.execute('DELETE FROM notification_outbox WHERE job_id = %s', (job_id,))
+
+
+def fail_notification_job(job_id, retry_delay, error):
+    """Schedule a failed notification job for another attempt."""
     with SQL_CONNECTION() as sql:
         sql.execute('''
-            SELECT DISTINCT token AS notification_token FROM notification_tokens
-            WHERE user_pubkey = %s
-            HAVING ((
-                SELECT active FROM notification_tokens
-                WHERE user_pubkey = %s
-                AND token = notification_token
-                ORDER BY timestamp DESC LIMIT 1) = TRUE)''', (user_pubkey, user_pubkey))
-        return [row['notification_token'] for row in sql.fetchall()]
+            UPDATE notification_outbox
+            SET next_attempt = CURRENT_TIMESTAMP(6) + INTERVAL %s SECOND, last_error = %s
+            WHERE job_id = %s''', (retry_delay, error[:300], job_id))
+
+
+def move_to_dead_letters(sql, job_ids, error=None):
+    """Move notification jobs from the outbox to the dead letters, where dispatchers no longer look for them."""
+    placeholders = ', '.join(['%s'] * len(job_ids))
+    sql.execute('''
+        INSERT INTO notification_dead_letters (job_id, event_type, escrow_pubkey, attempts, last_error)
+        SELECT job_id, event_type, escrow_pubkey, attempts, COALESCE(%s, last_error) FROM notification_outbox
+        WHERE job_id IN ({})'''.format(placeholders), (error,) + tuple(job_ids))
+    sql.execute('DELETE FROM notification_outbox WHERE job_id IN ({})'.format(placeholders), tuple(job_ids))
+
+
+def bury_notification_job(job_id, error):
+    """Give up on a failed notification job, moving it to the dead letters."""
+    with SQL_CONNECTION() as sql:
+        move_to_dead_letters(sql, [job_id], error[:300])
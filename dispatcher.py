@@ -0,0 +1,51 @@
+"""Deliver the notifications queued in the outbox."""
+import logging
+import os
+import time
+
+import db
+
+LOGGER = logging.getLogger('pkt.dispatcher')
+POLL_INTERVAL = float(os.environ.get('PAKET_DISPATCHER_POLL_INTERVAL', 1))
+BATCH_SIZE = int(os.environ.get('PAKET_DISPATCHER_BATCH_SIZE', 50))
+MAX_ATTEMPTS = int(os.environ.get('PAKET_DISPATCHER_MAX_ATTEMPTS', 8))
+LEASE = 300
+BASE_BACKOFF = 2
+MAX_BACKOFF = 600
+
+
+def get_backoff(attempts):
+    """Get the delay in seconds before retrying a job that failed `attempts` times."""
+    return min(BASE_BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF)
+
+
+def dispatch_pending():
+    """Send all due notifications and return the number of jobs handled."""
+    jobs = db.claim_notification_jobs(BATCH_SIZE, MAX_ATTEMPTS, LEASE)
+    for job in jobs:
+        attempts = job['attempts'] + 1
+        try:
+            db.send_notification(job['event_type'], job['escrow_pubkey'], job['job_id'])
+        except Exception as exc:  # pylint: disable=broad-except
+            if attempts >= MAX_ATTEMPTS:
+                LOGGER.error("giving up on notification job %s after %s attempts: %s", job['job_id'], attempts, exc)
+                db.bury_notification_job(job['job_id'], str(exc))
+            else:
+                LOGGER.warning("notification job %s failed (attempt %s): %s", job['job_id'], attempts, exc)
+                db.fail_notification_job(job['job_id'], get_backoff(attempts), str(exc))
+        else:
+            db.complete_notification_job(job['job_id'])
+    return len(jobs)
+
+
+def run():
+    """Drain the outbox forever."""
+    LOGGER.info('notification dispatcher started')
+    while True:
+        try:
+            handled = dispatch_pending()
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('failed to dispatch notifications')
+            handled = 0
+        if handled < BATCH_SIZE:
+            time.sleep(POLL_INTERVAL)
@@ -0,0 +1,156 @@
+"""Offline reverse geocoding of locations to country codes."""
+import collections
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import urllib.request
+
+LOGGER = logging.getLogger('pkt.geocoder')
+# GeoJSON feature collection of country boundaries, fetched from COUNTRIES_URL with `python -m router fetch_countries`.
+# Set to an empty value to resolve all locations with the geodecoding service.
+COUNTRIES_PATH = os.environ.get(
+    'PAKET_COUNTRIES_GEOJSON', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'countries.geojson'))
+COUNTRIES_URL = os.environ.get(
+    'PAKET_COUNTRIES_URL',
+    'https://raw.githubusercontent.com/nvkelso/natural-earth-vector/master/geojson/ne_50m_admin_0_countries.geojson')
+# Feature properties holding the country code, in order of preference - Natural Earth sets ISO_A2 to -99 for some
+# countries (France and Norway among them) and keeps their code in ISO_A2_EH.
+CODE_PROPERTIES = os.environ.get('PAKET_COUNTRIES_CODE_PROPERTIES', 'ISO_A2,ISO_A2_EH').split(',')
+# Size (in degrees) of the grid cells the world is divided into.
+CELL_SIZE = 1
+
+
+def get_band(coordinate, limit):
+    """Get the grid band of a coordinate, the coordinate at the limit belonging to the last band."""
+    return min(int(math.floor(coordinate / CELL_SIZE)), int(math.ceil(limit / CELL_SIZE)) - 1)
+
+
+def get_code(properties):
+    """Get the country code of a feature from its properties, None if it has no usable one."""
+    for code_property in CODE_PROPERTIES:
+        code = (properties or {}).get(code_property)
+        if code and not code.startswith('-'):
+            return code
+    return None
+
+
+def get_polygons(geometry):
+    """Get the rings of each polygon of a Polygon or MultiPolygon geometry."""
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    return []
+
+
+class CountryIndex:
+    """
+    Grid index of country polygons.
+    Cells crossed by no boundary resolve directly to their country. Otherwise, the point is tested against
+    the polygons crossing its cell, using only the polygon edges in its latitude band.
+    """
+
+    def __init__(self, features):
+        self.codes = []
+        self.edges_by_band = []
+        cell_polygons = collections.defaultdict(set)
+        for feature in features:
+            code = get_code(feature.get('properties'))
+            if code is None or not feature.get('geometry'):
+                continue
+            for rings in get_polygons(feature['geometry']):
+                polygon_id = len(self.codes)
+                self.codes.append(code)
+                self.edges_by_band.append(collections.defaultdict(list))
+                for ring in rings:
+                    for (x_1, y_1), (x_2, y_2) in zip(ring, ring[1:] + ring[:1]):
+                        edge = (x_1, y_1, x_2, y_2)
+                        for lat_band in range(get_band(min(y_1, y_2), 90), get_band(max(y_1, y_2), 90) + 1):
+                            self.edges_by_band[polygon_id][lat_band].append(edge)
+                            for lon_band in range(get_band(min(x_1, x_2), 180), get_band(max(x_1, x_2), 180) + 1):
+                                cell_polygons[lat_band, lon_band].add(polygon_id)
+        self.cells = {cell: tuple(polygon_ids) for cell, polygon_ids in cell_polygons.items()}
+        self.fill_inner_cells()
+        LOGGER.info("indexed %s polygons of %s countries", len(self.codes), len(set(self.codes)))
+
+    def fill_inner_cells(self):
+        """Resolve the cells crossed by no boundary to the country containing them, if any."""
+        for polygon_id, edges_by_band in enumerate(self.edges_by_band):
+            lat_bands = sorted(edges_by_band)
+            for lat_band in range(lat_bands[0], lat_bands[-1] + 1):
+                longitudes = [
+                    longitude for edge in edges_by_band.get(lat_band, ()) for longitude in (edge[0], edge[2])]
+                if not longitudes:
+                    continue
+                for lon_band in range(get_band(min(longitudes), 180), get_band(max(longitudes), 180) + 1):
+                    if (lat_band, lon_band) not in self.cells and self.contains(
+                            polygon_id, (lat_band + .5) * CELL_SIZE, (lon_band + .5) * CELL_SIZE):
+                        self.cells[lat_band, lon_band] = self.codes[polygon_id]
+
+    def contains(self, polygon_id, latitude, longitude):
+        """Check if a polygon contains a point, by casting a ray from the point eastwards."""
+        inside = False
+        for x_1, y_1, x_2, y_2 in self.edges_by_band[polygon_id].get(get_band(latitude, 90), ()):
+            if (y_1 > latitude) != (y_2 > latitude) and longitude < x_1 + (latitude - y_1) * (x_2 - x_1) / (y_2 - y_1):
+                inside = not inside
+        return inside
+
+    def lookup(self, latitude, longitude):
+        """Get the country code of a point, None if it is in no country."""
+        cell = self.cells.get((get_band(latitude, 90), get_band(longitude, 180)))
+        if cell is None or isinstance(cell, str):
+            return cell
+        return next((self.codes[polygon_id] for polygon_id in cell if self.contains(
+            polygon_id, latitude, longitude)), None)
+
+
+def load(path):
+    """Load a country index from a GeoJSON file."""
+    with open(path) as countries_file:
+        return CountryIndex(json.load(countries_file)['features'])
+
+
+def fetch(url=None, path=None):
+    """Download the countries file, replacing the current one only once the new one loads."""
+    url, path = url or COUNTRIES_URL, path or COUNTRIES_PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    download_path = "{}.download".format(path)
+    LOGGER.info("fetching countries from %s", url)
+    with urllib.request.urlopen(url, timeout=300) as response, open(download_path, 'wb') as countries_file:
+        shutil.copyfileobj(response, countries_file)
+    load(download_path)
+    os.replace(download_path, path)
+    LOGGER.info("countries saved to %s", path)
+
+
+INDEX = None
+INDEX_MISSING = False
+INDEX_LOCK = threading.Lock()
+
+
+def get_index():
+    """
+    Get the country index, loading it on first use.
+    None if no countries file is configured, or if it is missing - which is logged as an error once.
+    """
+    global INDEX, INDEX_MISSING  # pylint: disable=global-statement
+    if INDEX is None and COUNTRIES_PATH and not INDEX_MISSING:
+        with INDEX_LOCK:
+            if INDEX is None and not INDEX_MISSING:
+                if os.path.exists(COUNTRIES_PATH):
+                    INDEX = load(COUNTRIES_PATH)
+                else:
+                    INDEX_MISSING = True
+                    LOGGER.error(
+                        "countries file %s is missing, all locations are resolved by the geodecoding service - "
+                        "run `python -m router fetch_countries` to fetch it", COUNTRIES_PATH)
+    return INDEX
+
+
+def lookup(latitude, longitude):
+    """Get the country code of a point, None if it is in no country or no countries file is configured."""
+    index = get_index()
+    return index.lookup(latitude, longitude) if index is not None else None
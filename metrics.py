@@ -0,0 +1,347 @@
+"""
+Request latency, SQL and external call metrics, exposed in the Prometheus text format.
+Server workers write snapshots of their metrics to a shared directory, and a scrape of any worker merges them all.
+"""
+import bisect
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import flask
+
+LOGGER = logging.getLogger('pkt.metrics')
+ENABLED = os.environ.get('PAKET_METRICS', '1').lower() in ('1', 'true', 'yes')
+# Directory of the worker snapshots - the server makes a temporary one if not set, single processes use none.
+MULTIPROCESS_DIR = os.environ.get('PAKET_METRICS_DIR')
+# Workers write their snapshot at this interval (in seconds), so scrapes lag behind other workers by up to this much.
+SNAPSHOT_INTERVAL = float(os.environ.get('PAKET_METRICS_SNAPSHOT_INTERVAL', 5))
+# Metrics of exited workers, kept so counters and histograms do not go back when workers are replaced.
+ARCHIVE_NAME = 'archive.json'
+LOCK_NAME = 'lock'
+# Metrics merged across workers by taking their highest value - all others are summed.
+MAX_MERGED = ('pkt_db_replica_lag_seconds',)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Bucket upper bounds of durations, in seconds.
+DURATION_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def format_labels(names, values):
+    """Format label names and values as a Prometheus label set."""
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')) for name, value in zip(names, values))
+
+
+def get_sample_key(name, labels):
+    """Get the name and label set of a sample, as in its Prometheus text line."""
+    return "{}{{{}}}".format(name, labels) if labels else name
+
+
+def get_family(metric_type, description, samples):
+    """Get a metric family - its type, description and sample values by sample key, which can be stored as JSON."""
+    return {'type': metric_type, 'help': description, 'samples': samples}
+
+
+class Counter:
+    """A counter for each combination of label values."""
+
+    def __init__(self, name, description, label_names):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        """Increment the counter of label values."""
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def collect(self):
+        """Get the counters as a metric family."""
+        with self.lock:
+            values = list(self.values.items())
+        return get_family('counter', self.description, {
+            get_sample_key(self.name, format_labels(self.label_names, label_values)): value
+            for label_values, value in values})
+
+
+class Histogram:
+    """A histogram of observed values for each combination of label values."""
+
+    def __init__(self, name, description, label_names, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # Non cumulative bucket counts (the last one for values above all bounds) and sum, by label values.
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        """Add an observed value to the histogram of label values."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def collect(self):
+        """Get the histograms as a metric family."""
+        with self.lock:
+            series = [(label_values, list(counts), total) for label_values, (counts, total) in self.series.items()]
+        samples = {}
+        for label_values, counts, total in series:
+            labels = format_labels(self.label_names, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples[get_sample_key("{}_bucket".format(self.name), format_labels(
+                    self.label_names + ('le',), label_values + (bound,)))] = cumulative
+            samples[get_sample_key("{}_sum".format(self.name), labels)] = total
+            samples[get_sample_key("{}_count".format(self.name), labels)] = cumulative
+        return get_family('histogram', self.description, samples)
+
+
+REQUEST_DURATION = Histogram(
+    'pkt_request_duration_seconds', 'Time to handle requests.', ('route', 'method', 'status'))
+REQUEST_QUERIES = Histogram(
+    'pkt_request_sql_queries', 'SQL queries made by each request.', ('route',), QUERY_COUNT_BUCKETS)
+REQUEST_SQL_DURATION = Histogram(
+    'pkt_request_sql_duration_seconds', 'Time spent in SQL queries by each request.', ('route',))
+QUERY_DURATION = Histogram(
+    'pkt_sql_query_duration_seconds', 'Time to execute SQL queries, by calling function.', ('function',))
+EXTERNAL_CALL_DURATION = Histogram(
+    'pkt_external_call_duration_seconds', 'Time of calls to external services.', ('service', 'operation'))
+EXTERNAL_CALL_ERRORS = Counter(
+    'pkt_external_call_errors_total', 'Calls to external services which raised.', ('service', 'operation'))
+METRICS = (
+    REQUEST_DURATION, REQUEST_QUERIES, REQUEST_SQL_DURATION, QUERY_DURATION, EXTERNAL_CALL_DURATION,
+    EXTERNAL_CALL_ERRORS)
+
+
+class RequestMetrics:
+    """The start time and SQL queries of a request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_duration = 0.0
+
+
+def observe_query(duration, depth=2):
+    """Record the duration of an SQL query, made by the function depth frames up the stack."""
+    if not ENABLED:
+        return
+    QUERY_DURATION.observe(duration, sys._getframe(depth).f_code.co_name)  # pylint: disable=protected-access
+    request_metrics = flask.g.get('metrics') if flask.has_app_context() else None
+    if request_metrics is not None:
+        request_metrics.queries += 1
+        request_metrics.sql_duration += duration
+
+
+@contextlib.contextmanager
+def timed_call(service, operation, expected_exceptions=()):
+    """
+    Record the duration of a call to an external service, and whether it raised.
+    Expected exceptions are answers of the service rather than failures, so they are not counted as errors.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except expected_exceptions:
+        raise
+    except Exception:
+        if ENABLED:
+            EXTERNAL_CALL_ERRORS.inc(service, operation)
+        raise
+    finally:
+        if ENABLED:
+            EXTERNAL_CALL_DURATION.observe(time.perf_counter() - start, service, operation)
+
+
+def start_request():
+    """Start timing a request - to be registered as a before_request function."""
+    flask.g.metrics = RequestMetrics()
+
+
+def finish_request(response):
+    """Record the duration and SQL queries of a request - to be registered as an after_request function."""
+    request_metrics = flask.g.get('metrics')
+    if request_metrics is not None:
+        request = flask.request._get_current_object()  # pylint: disable=protected-access
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_DURATION.observe(
+            time.perf_counter() - request_metrics.start, route, request.method, response.status_code)
+        REQUEST_QUERIES.observe(request_metrics.queries, route)
+        REQUEST_SQL_DURATION.observe(request_metrics.sql_duration, route)
+    return response
+
+
+def collect_routing(stats):
+    """Get database pool, replica and read routing stats, as returned by db.get_routing_stats, as metric families."""
+    pools = dict({'primary': stats['pool']}, **{replica['host']: replica for replica in stats['replicas']})
+    families = {}
+    for key, metric_type, description in (
+            ('opened', 'gauge', 'Open database connections.'),
+            ('in_use', 'gauge', 'Database connections in use.'),
+            ('idle', 'gauge', 'Idle database connections.'),
+            ('checkouts', 'counter', 'Database connections checked out.'),
+            ('timeouts', 'counter', 'Database connection checkouts which timed out.'),
+            ('discarded', 'counter', 'Broken database connections discarded.')):
+        name = "pkt_db_pool_{}{}".format(key, '_total' if metric_type == 'counter' else '')
+        families[name] = get_family(metric_type, description, {
+            get_sample_key(name, format_labels(('pool',), (pool_name,))): pool_stats[key]
+            for pool_name, pool_stats in pools.items()})
+    families['pkt_db_replica_lag_seconds'] = get_family('gauge', 'Last measured replication lag of replicas.', {
+        get_sample_key('pkt_db_replica_lag_seconds', format_labels(('pool',), (replica['host'],))): replica['lag']
+        for replica in stats['replicas']})
+    families['pkt_db_reads_total'] = get_family('counter', 'Reads by routing decision.', {
+        get_sample_key('pkt_db_reads_total', format_labels(('decision',), (decision,))): value
+        for decision, value in stats['routing'].items()})
+    return families
+
+
+def collect(routing_stats=None):
+    """Get all metrics of this process as metric families by name."""
+    families = {metric.name: metric.collect() for metric in METRICS}
+    if routing_stats is not None:
+        families.update(collect_routing(routing_stats))
+    return families
+
+
+def merge(snapshots):
+    """Merge metric families of several processes - summing their values, or taking the highest for some gauges."""
+    merged = {}
+    for families in snapshots:
+        for name, family in families.items():
+            samples = merged.setdefault(name, get_family(family['type'], family['help'], {}))['samples']
+            for key, value in family['samples'].items():
+                if samples.get(key) is None:
+                    samples[key] = value
+                elif value is not None:
+                    samples[key] = max(samples[key], value) if name in MAX_MERGED else samples[key] + value
+    return merged
+
+
+def render_families(families):
+    """Get metric families as Prometheus text lines."""
+    for name, family in families.items():
+        yield "# HELP {} {}".format(name, family['help'])
+        yield "# TYPE {} {}".format(name, family['type'])
+        for key, value in family['samples'].items():
+            yield "{} {}".format(key, 'NaN' if value is None else value)
+
+
+@contextlib.contextmanager
+def locked_directory(exclusive=False):
+    """Lock the snapshot directory - exclusively to archive snapshots, shared to read them."""
+    with open(os.path.join(MULTIPROCESS_DIR, LOCK_NAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_snapshot_path(pid=None):
+    """Get the snapshot path of a worker, this process by default."""
+    return os.path.join(MULTIPROCESS_DIR, "worker-{}.json".format(pid or os.getpid()))
+
+
+def write_json(path, families):
+    """Replace a snapshot file atomically, so it is never read half written."""
+    temporary_path = "{}.{}.tmp".format(path, threading.get_ident())
+    with open(temporary_path, 'w') as snapshot_file:
+        json.dump(families, snapshot_file)
+    os.replace(temporary_path, path)
+
+
+def read_snapshots():
+    """Read the snapshots of all workers, and the archive of exited ones."""
+    snapshots = []
+    for file_name in sorted(os.listdir(MULTIPROCESS_DIR)):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(MULTIPROCESS_DIR, file_name)) as snapshot_file:
+                snapshots.append(json.load(snapshot_file))
+        except FileNotFoundError:
+            continue
+    return snapshots
+
+
+def setup_directory():
+    """Prepare the snapshot directory for workers about to be forked, dropping snapshots of an earlier server."""
+    global MULTIPROCESS_DIR  # pylint: disable=global-statement
+    if not ENABLED:
+        return
+    if MULTIPROCESS_DIR is None:
+        MULTIPROCESS_DIR = tempfile.mkdtemp(prefix='pkt-metrics-')
+    os.makedirs(MULTIPROCESS_DIR, exist_ok=True)
+    for file_name in os.listdir(MULTIPROCESS_DIR):
+        if file_name.endswith(('.json', '.tmp')):
+            os.remove(os.path.join(MULTIPROCESS_DIR, file_name))
+    LOGGER.info("metrics snapshots in %s", MULTIPROCESS_DIR)
+
+
+def write_snapshot(get_routing_stats):
+    """Write the snapshot of this worker."""
+    if ENABLED and MULTIPROCESS_DIR is not None:
+        write_json(get_snapshot_path(), collect(get_routing_stats()))
+
+
+def start_snapshots(get_routing_stats):
+    """Keep writing the snapshot of this worker in the background - to be called in each forked worker."""
+    if not ENABLED or MULTIPROCESS_DIR is None:
+        return
+
+    def write_snapshots():
+        """Write the snapshot at every interval."""
+        while True:
+            try:
+                write_snapshot(get_routing_stats)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('could not write metrics snapshot')
+            time.sleep(SNAPSHOT_INTERVAL)
+
+    threading.Thread(target=write_snapshots, name='metrics-snapshots', daemon=True).start()
+
+
+def archive_worker(pid):
+    """Move the counters and histograms of an exited worker to the archive, dropping its gauges."""
+    if not ENABLED or MULTIPROCESS_DIR is None:
+        return
+    snapshot_path, archive_path = get_snapshot_path(pid), os.path.join(MULTIPROCESS_DIR, ARCHIVE_NAME)
+    with locked_directory(exclusive=True):
+        try:
+            with open(snapshot_path) as snapshot_file:
+                families = json.load(snapshot_file)
+        except FileNotFoundError:
+            return
+        try:
+            with open(archive_path) as archive_file:
+                archive = json.load(archive_file)
+        except FileNotFoundError:
+            archive = {}
+        write_json(archive_path, merge([archive, {
+            name: family for name, family in families.items() if family['type'] != 'gauge'}]))
+        os.remove(snapshot_path)
+
+
+def render(routing_stats=None):
+    """Get all metrics in the Prometheus text format - merged across server workers if they share a directory."""
+    families = collect(routing_stats)
+    if ENABLED and MULTIPROCESS_DIR is not None:
+        write_json(get_snapshot_path(), families)
+        with locked_directory():
+            families = merge(read_snapshots())
+    return '\n'.join(render_families(families)) + '\n'
@@ -0,0 +1,364 @@
+"""Versioned migrations of the database schema, and the maintenance of derived data."""
+import base64
+import concurrent.futures
+import logging
+import os
+
+import db
+import photos
+
+LOGGER = logging.getLogger('pkt.migrations')
+# Serializes migrations of several servers starting at once.
+LOCK_NAME = 'paket_router_migrations'
+LOCK_TIMEOUT = 600
+# Concurrent geodecoding lookups, and packages updated at once, when backfilling country codes.
+BACKFILL_WORKERS = int(os.environ.get('PAKET_BACKFILL_WORKERS', 8))
+BACKFILL_BATCH_SIZE = int(os.environ.get('PAKET_BACKFILL_BATCH_SIZE', 100))
+
+
+class MigrationLockTimeout(Exception):
+    """Another process is still migrating the database."""
+
+
+def get_version(sql):
+    """Get the schema version of the database, creating the version table if needed."""
+    sql.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version(
+            version INTEGER NOT NULL PRIMARY KEY,
+            description VARCHAR(100) NOT NULL,
+            applied TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6))''')
+    sql.execute('SELECT version FROM schema_version ORDER BY version DESC LIMIT 1')
+    versions = sql.fetchall()
+    return versions[0]['version'] if versions else 0
+
+
+def migrate(sql_connection, migrations):
+    """
+    Apply pending migrations and return the resulting schema version.
+    Each migration is a (description, steps) pair, its version being its position in the list, counting from one.
+    A step is either an SQL statement or a callable receiving the cursor.
+    MySQL commits schema changes implicitly, so a migration that fails midway may need manual cleanup.
+    """
+    with sql_connection() as sql:
+        sql.execute('SELECT GET_LOCK(%s, %s) AS locked', (LOCK_NAME, LOCK_TIMEOUT))
+        if not sql.fetchall()[0]['locked']:
+            raise MigrationLockTimeout("could not acquire lock {}".format(LOCK_NAME))
+        try:
+            version = get_version(sql)
+            for new_version, (description, steps) in enumerate(migrations, 1):
+                if new_version <= version:
+                    continue
+                LOGGER.info("migrating database to version %s: %s", new_version, description)
+                for step in steps:
+                    if callable(step):
+                        step(sql)
+                    else:
+                        sql.execute(step)
+                sql.execute('INSERT INTO schema_version (version, description) VALUES (%s, %s)', (
+                    new_version, description))
+                sql.execute('COMMIT')
+                version = new_version
+        finally:
+            sql.execute('SELECT RELEASE_LOCK(%s)', (LOCK_NAME,))
+            sql.fetchall()
+    LOGGER.info("database schema is at version %s", version)
+    return version
+
+
+def find_full_scans(sql, query, params=()):
+    """
+    Get the tables a query reads with a full table scan because no index can serve it.
+    Full scans the optimizer picks although an index is available (common on tiny tables) are not reported,
+    and neither are scans of derived tables.
+    """
+    sql.execute('EXPLAIN ' + query, params)
+    return [
+        row['table'] for row in sql.fetchall()
+        if row['type'] == 'ALL' and not row['possible_keys'] and not str(row['table']).startswith('<')]
+
+
+def fill_package_coordinates(sql):
+    """Fill the parsed coordinates of packages created before they were stored."""
+    sql.execute("""
+        SELECT escrow_pubkey, from_location FROM packages
+        WHERE from_latitude IS NULL AND from_location IS NOT NULL""")
+    coordinates = []
+    for package in sql.fetchall():
+        try:
+            coordinates.append(db.parse_location(package['from_location']) + (package['escrow_pubkey'],))
+        except ValueError:
+            LOGGER.warning(
+                "package %s has invalid from_location %s", package['escrow_pubkey'], package['from_location'])
+    sql.executemany("""
+        UPDATE packages SET from_latitude = %s, from_longitude = %s
+        WHERE escrow_pubkey = %s""", coordinates)
+    LOGGER.info("coordinates filled for %s packages", len(coordinates))
+
+
+def fill_package_state(sql):
+    """
+    Regenerate the state of all packages from the events table.
+    The events are read with a shared lock, which waits for events in flight and holds back new ones until the
+    transaction ends, so no event is folded into a state that is then overwritten.
+    """
+    states = {}
+    sql.execute("""
+        SELECT idx, timestamp, user_pubkey, event_type, escrow_pubkey FROM events
+        WHERE escrow_pubkey IS NOT NULL
+        ORDER BY idx ASC
+        LOCK IN SHARE MODE""")
+    for event in sql.fetchall():
+        states[event['escrow_pubkey']] = db.fold_package_state(states.get(event['escrow_pubkey']), event)
+    sql.execute('DELETE FROM package_state')
+    sql.executemany("""
+        INSERT INTO package_state (escrow_pubkey, status, custodian_pubkey, launch_date, last_event_type, last_idx)
+        VALUES (%s, %s, %s, %s, %s, %s)""", [(
+            escrow_pubkey, state['status'], state['custodian_pubkey'], state['launch_date'],
+            state['last_event_type'], state['last_idx']) for escrow_pubkey, state in states.items()])
+    LOGGER.info("state rebuilt for %s packages", len(states))
+
+
+def rebuild_package_state():
+    """Regenerate the state of all packages from the events table, in a single transaction."""
+    with db.SQL_CONNECTION() as sql:
+        fill_package_state(sql)
+
+
+def move_photos_to_store(sql):
+    """Move photos stored in the database before the photo store existed into the photo store."""
+    sql.execute('SELECT photo_id FROM photos WHERE content_hash IS NULL')
+    photo_ids = [row['photo_id'] for row in sql.fetchall()]
+    for photo_id in photo_ids:
+        sql.execute('SELECT photo FROM photos WHERE photo_id = %s', (photo_id,))
+        photo = base64.b64decode(sql.fetchall()[0]['photo'])
+        content_hash = photos.STORE.put(photo)
+        photos.generate_thumbnails(content_hash, photo)
+        sql.execute('''
+            UPDATE photos SET photo = NULL, content_hash = %s, content_type = %s, size = %s
+            WHERE photo_id = %s''', (content_hash, photos.get_content_type(photo), len(photo), photo_id))
+    LOGGER.info("%s photos moved to the photo store", len(photo_ids))
+
+
+def fold_notification_tokens(sql):
+    """
+    Fold the notification tokens history into the current token state, leaving the history in place.
+    Returns the timestamp of the latest folded history row, None if there is no history.
+    """
+    sql.execute('SELECT MAX(timestamp) AS cutoff FROM notification_tokens')
+    cutoff = sql.fetchall()[0]['cutoff']
+    if cutoff is None:
+        return None
+    sql.execute('''
+        INSERT INTO notification_token_state (user_pubkey, token, active, updated)
+        SELECT user_pubkey, token, active, timestamp FROM notification_tokens AS history
+        WHERE timestamp = (
+            SELECT MAX(timestamp) FROM notification_tokens
+            WHERE user_pubkey = history.user_pubkey AND token = history.token AND timestamp <= %s)
+        AND user_pubkey IS NOT NULL AND token IS NOT NULL
+        ON DUPLICATE KEY UPDATE
+            active = IF(VALUES(updated) > updated, VALUES(active), active),
+            updated = GREATEST(updated, VALUES(updated))''', (cutoff,))
+    LOGGER.info("notification tokens history folded up to %s", cutoff)
+    return cutoff
+
+
+def compact_notification_tokens():
+    """
+    Fold the notification tokens history into the current token state, in a single transaction.
+    Folded history rows are then deleted, unless the history is being kept.
+    """
+    with db.SQL_CONNECTION() as sql:
+        cutoff = fold_notification_tokens(sql)
+        if cutoff is not None and not db.TOKEN_HISTORY:
+            sql.execute('DELETE FROM notification_tokens WHERE timestamp <= %s', (cutoff,))
+            LOGGER.info("%s notification tokens history rows deleted", sql.rowcount)
+
+
+# Schema changes since the original tables, in order. Never edit a released migration, add a new one.
+MIGRATIONS = [
+    ('store parsed package coordinates', [
+        '''
+            ALTER TABLE packages
+            ADD COLUMN from_latitude DOUBLE NULL,
+            ADD COLUMN from_longitude DOUBLE NULL,
+            ADD INDEX from_coordinates (from_latitude, from_longitude)''',
+        fill_package_coordinates]),
+    ('materialize package state', [
+        '''
+            CREATE TABLE package_state(
+                escrow_pubkey VARCHAR(56) NOT NULL PRIMARY KEY,
+                status VARCHAR(20) NOT NULL,
+                custodian_pubkey VARCHAR(56) NOT NULL,
+                launch_date TIMESTAMP(6) NULL,
+                last_event_type VARCHAR(20) NULL,
+                last_idx INTEGER NOT NULL,
+                INDEX last_event_type (last_event_type),
+                FOREIGN KEY(escrow_pubkey) REFERENCES packages(escrow_pubkey))''',
+        fill_package_state]),
+    ('add notification outbox', [
+        '''
+            CREATE TABLE notification_outbox(
+                job_id INTEGER NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                event_type VARCHAR(20) NOT NULL,
+                escrow_pubkey VARCHAR(56) NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+                last_error VARCHAR(300) NULL,
+                INDEX next_attempt (next_attempt))''']),
+    ('move photo content to the photo store', [
+        '''
+            ALTER TABLE photos
+            MODIFY photo LONGTEXT NULL,
+            ADD COLUMN content_hash CHAR(64) NULL,
+            ADD COLUMN content_type VARCHAR(50) NULL,
+            ADD COLUMN size INTEGER NULL''',
+        move_photos_to_store]),
+    # get_packages_events orders events of packages by time.
+    ('index events by package and time', [
+        'ALTER TABLE events ADD INDEX escrow_timestamp (escrow_pubkey, timestamp)']),
+    # get_packages finds the packages a user couriered.
+    ('index events by user and type', [
+        'ALTER TABLE events ADD INDEX user_event_type (user_pubkey, event_type)']),
+    # get_events selects events within a time window.
+    ('index events by time', [
+        'ALTER TABLE events ADD INDEX timestamp (timestamp)']),
+    # get_packages finds the packages a user launched or receives.
+    ('index packages by launcher and recipient', [
+        '''
+            ALTER TABLE packages
+            ADD INDEX launcher_pubkey (launcher_pubkey),
+            ADD INDEX recipient_pubkey (recipient_pubkey)''']),
+    # get_event_photos finds the photos of package events by type.
+    ('index photos by package and event type', [
+        'ALTER TABLE photos ADD INDEX escrow_event_type (escrow_pubkey, event_type)']),
+    # The notification token functions look for the latest row of each user token.
+    ('index notification tokens by user, token and time', [
+        'ALTER TABLE notification_tokens ADD INDEX user_token_timestamp (user_pubkey, token, timestamp)']),
+    ('keep the current state of notification tokens', [
+        '''
+            CREATE TABLE notification_token_state(
+                user_pubkey VARCHAR(56) NOT NULL,
+                token VARCHAR(200) NOT NULL,
+                active BOOLEAN NOT NULL,
+                updated TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+                PRIMARY KEY (user_pubkey, token))''',
+        fold_notification_tokens]),
+    # Pagination reads the packages of each user role in escrow pubkey order.
+    ('index packages by user and escrow pubkey', [
+        'ALTER TABLE packages ADD INDEX launcher_escrow (launcher_pubkey, escrow_pubkey)',
+        'ALTER TABLE packages ADD INDEX recipient_escrow (recipient_pubkey, escrow_pubkey)',
+        'ALTER TABLE events ADD INDEX user_escrow_event_type (user_pubkey, escrow_pubkey, event_type)']),
+    # Country codes are looked up once, backfill_country_codes fills them for existing packages.
+    ('store country codes and short package ids', [
+        '''
+            ALTER TABLE packages
+            ADD COLUMN country_code VARCHAR(8) NULL,
+            ADD COLUMN short_package_id VARCHAR(16) NULL,
+            ADD INDEX country_code (country_code),
+            ADD INDEX short_package_id (short_package_id)''']),
+    # Notification jobs which failed too many times are kept apart, out of the way of the dispatchers.
+    ('add notification dead letters', [
+        '''
+            CREATE TABLE notification_dead_letters(
+                job_id INTEGER NOT NULL PRIMARY KEY,
+                event_type VARCHAR(20) NOT NULL,
+                escrow_pubkey VARCHAR(56) NOT NULL,
+                attempts INTEGER NOT NULL,
+                last_error VARCHAR(300) NULL,
+                buried TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6))''']),
+    # Retried notification jobs skip the tokens an earlier attempt already notified.
+    ('record notified tokens of notification jobs', [
+        '''
+            CREATE TABLE notification_deliveries(
+                job_id INTEGER NOT NULL,
+                token VARCHAR(200) NOT NULL,
+                PRIMARY KEY (job_id, token),
+                FOREIGN KEY(job_id) REFERENCES notification_outbox(job_id) ON DELETE CASCADE)'''])]
+
+
+def init_db():
+    """
+    Initialize the database: create the original tables if missing and bring them up to date with the migrations.
+    Safe to run on an existing database, returns the resulting schema version.
+    """
+    with db.SQL_CONNECTION() as sql:
+        sql.execute('''
+            CREATE TABLE IF NOT EXISTS packages(
+                escrow_pubkey VARCHAR(56) UNIQUE,
+                launcher_pubkey VARCHAR(56),
+                recipient_pubkey VARCHAR(56),
+                launcher_contact VARCHAR(32),
+                recipient_contact VARCHAR(32),
+                payment BIGINT,
+                collateral BIGINT,
+                deadline INTEGER,
+                description VARCHAR(300),
+                from_location VARCHAR(24),
+                to_location VARCHAR(24),
+                from_address VARCHAR(200),
+                to_address VARCHAR(200))''')
+        LOGGER.debug('packages table created')
+        sql.execute('''
+            CREATE TABLE IF NOT EXISTS events(
+                idx INTEGER AUTO_INCREMENT,
+                timestamp TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+                user_pubkey VARCHAR(56) NOT NULL,
+                event_type VARCHAR(20) NOT NULL,
+                location VARCHAR(24) NOT NULL,
+                escrow_pubkey VARCHAR(56) NULL,
+                kwargs LONGTEXT NULL,
+                photo_id INTEGER NULL,
+                FOREIGN KEY(escrow_pubkey) REFERENCES packages(escrow_pubkey))''')
+        LOGGER.debug('events table created')
+        sql.execute('''
+            CREATE TABLE IF NOT EXISTS photos(
+                photo_id INTEGER NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                escrow_pubkey VARCHAR(56) NOT NULL,
+                event_type VARCHAR(20) NOT NULL,
+                photo LONGTEXT NOT NULL)''')
+        LOGGER.debug('photos table created')
+        sql.execute('''
+            CREATE TABLE IF NOT EXISTS notification_tokens(
+                user_pubkey VARCHAR(56),
+                token VARCHAR(200),
+                active BOOLEAN,
+                timestamp TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6))''')
+        LOGGER.debug('notification_tokens table created')
+    return migrate_db()
+
+
+def migrate_db():
+    """Apply all pending schema migrations."""
+    return migrate(db.SQL_CONNECTION, MIGRATIONS)
+
+
+def backfill_country_codes():
+    """
+    Store country codes and short package ids of packages missing them, looking up country codes concurrently.
+    Returns the number of packages which country code was found.
+    """
+    filled = 0
+    last_escrow_pubkey = ''
+    with concurrent.futures.ThreadPoolExecutor(BACKFILL_WORKERS) as executor:
+        while True:
+            with db.SQL_CONNECTION() as sql:
+                sql.execute("""
+                    SELECT escrow_pubkey, to_location FROM packages
+                    WHERE country_code IS NULL AND escrow_pubkey > %s
+                    ORDER BY escrow_pubkey LIMIT %s""", (last_escrow_pubkey, BACKFILL_BATCH_SIZE))
+                packages = sql.fetchall()
+            if not packages:
+                break
+            last_escrow_pubkey = packages[-1]['escrow_pubkey']
+            country_codes = executor.map(db.get_country_code, [package['to_location'] for package in packages])
+            updates = [
+                (country_code, db.format_short_package_id(package['escrow_pubkey'], country_code),
+                 package['escrow_pubkey'])
+                for package, country_code in zip(packages, country_codes) if country_code]
+            with db.SQL_CONNECTION() as sql:
+                sql.executemany("""
+                    UPDATE packages SET country_code = %s, short_package_id = %s
+                    WHERE escrow_pubkey = %s""", updates)
+            filled += len(updates)
+            LOGGER.info("country codes filled for %s of %s packages", len(updates), len(packages))
+    return filled
@@ -5,28 +5,69 @@ import os
 import firebase_admin
 from firebase_admin import messaging
 
+import metrics
+
 LOGGER = logging.getLogger('pkt.notification')
 PATH_TO_FIREBASE_CERT = os.environ.get('PAKET_PATH_TO_FIREBASE_CERT')
 
 
 CREDENTIALS = firebase_admin.credentials.Certificate(PATH_TO_FIREBASE_CERT)
+# All sends go through this app, which keeps a single pooled HTTP session to the messaging service per process.
 FIREBASE_APP = firebase_admin.initialize_app(CREDENTIALS)
 
 
 # internal notification codes
 NOTIFICATION_CODES = {}
 
+# Firebase refuses batch requests with more messages than this.
+MAX_BATCH_SIZE = 100
+# Error codes meaning a token will never be valid again.
+DEAD_TOKEN_ERROR_CODES = ('registration-token-not-registered',)
+# Error codes meaning sending to a token may succeed later.
+RETRYABLE_ERROR_CODES = ('internal-error', 'server-unavailable', 'message-rate-exceeded')
+
+
+class NotificationsFailed(Exception):
+    """Some notifications failed with errors worth retrying."""
+
+
+def send_notifications(tokens, title, body, notification_code, short_package_id, on_batch=None):
+    """
+    Send notification to all devices which tokens was provided, batching them into as few requests as possible.
+    After each batch, on_batch is called with the tokens not to send to again (those sent, and those which failed
+    for good) and the tokens which are no longer registered, so progress can be recorded before the next batch.
+    Return the tokens which are no longer registered, and the tokens which failed with errors worth retrying.
+    """
+    notification = messaging.Notification(title=title, body=body)
+    data = {
+        'notification_code': str(notification_code),
+        'short_package_id': str(short_package_id)}
+    dead_tokens, retry_tokens = [], []
+    for batch_start in range(0, len(tokens), MAX_BATCH_SIZE):
+        batch_tokens = tokens[batch_start:batch_start + MAX_BATCH_SIZE]
+        message = messaging.MulticastMessage(tokens=batch_tokens, data=data, notification=notification)
+        with metrics.timed_call('firebase', 'send_multicast'):
+            batch_response = messaging.send_multicast(message, app=FIREBASE_APP)
+        LOGGER.info("%s of %s notifications sent", batch_response.success_count, len(batch_tokens))
+        done_tokens, batch_dead_tokens = [], []
+        for token, response in zip(batch_tokens, batch_response.responses):
+            if not response.success:
+                LOGGER.error("notification to token %s failed: %s", token[-7:], response.exception)
+                error_code = getattr(response.exception, 'code', None)
+                if error_code in RETRYABLE_ERROR_CODES:
+                    retry_tokens.append(token)
+                    continue
+                if error_code in DEAD_TOKEN_ERROR_CODES:
+                    batch_dead_tokens.append(token)
+            done_tokens.append(token)
+        dead_tokens.extend(batch_dead_tokens)
+        if on_batch is not None:
+            on_batch(done_tokens, batch_dead_tokens)
+    return dead_tokens, retry_tokens
+
 
-def send_notifications(tokens, title, body, notification_code, short_package_id):
-    """Send notification to all devices which tokens was provided."""
-    for token in tokens:
-        notification = messaging.Notification(title=title, body=body)
-        data = {
-            'notification_code': str(notification_code),
-            'short_package_id': str(short_package_id)}
-        message = messaging.Message(data=data, notification=notification, token=token)
-        try:
-            response = messaging.send(message, app=FIREBASE_APP)
-            LOGGER.info(response)
-        except messaging.ApiCallError as exc:
-            LOGGER.error(str(exc))
+def reset_app():
+    """Initialize a new firebase app in a forked child process, instead of sharing the connections of its parent."""
+    global FIREBASE_APP  # pylint: disable=global-statement
+    firebase_admin.delete_app(FIREBASE_APP)
+    FIREBASE_APP = firebase_admin.initialize_app(CREDENTIALS)
@@ -0,0 +1,99 @@
+"""Paginated reads of packages."""
+import base64
+import json
+import os
+
+import db
+import events
+
+# Default and maximal number of packages returned in a single page.
+PAGE_SIZE = int(os.environ.get('PAKET_PACKAGES_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('PAKET_PACKAGES_MAX_PAGE_SIZE', 500))
+
+
+class InvalidCursor(Exception):
+    """Invalid pagination cursor."""
+
+
+def encode_cursor(escrow_pubkey, user_role):
+    """Encode the position after which the next page starts as an opaque token."""
+    return base64.urlsafe_b64encode(json.dumps([escrow_pubkey, user_role]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a token created by encode_cursor."""
+    try:
+        escrow_pubkey, user_role = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if not isinstance(escrow_pubkey, str) or not isinstance(user_role, str):
+            raise ValueError('cursor values must be strings')
+    except (ValueError, TypeError, UnicodeError) as exception:
+        raise InvalidCursor("invalid cursor {}".format(cursor)) from exception
+    return escrow_pubkey, user_role
+
+
+def get_user_package_roles(sql, user_pubkey, after, limit):
+    """
+    Get the (escrow_pubkey, user_role) pairs of a user, ordered by both, following the pair after.
+    Each role is read from its own index range in escrow_pubkey order, so only limit rows are read for each.
+    """
+    sql.execute('''
+        SELECT escrow_pubkey, user_role FROM (
+            (SELECT escrow_pubkey, 'launcher' AS user_role FROM packages
+            WHERE launcher_pubkey = %s AND escrow_pubkey >= %s
+            ORDER BY escrow_pubkey LIMIT %s)
+            UNION ALL
+            (SELECT escrow_pubkey, 'recipient' AS user_role FROM packages
+            WHERE recipient_pubkey = %s AND escrow_pubkey >= %s
+            ORDER BY escrow_pubkey LIMIT %s)
+            UNION ALL
+            (SELECT DISTINCT escrow_pubkey, 'courier' AS user_role FROM events
+            WHERE user_pubkey = %s AND escrow_pubkey >= %s AND event_type IN (%s, %s)
+            ORDER BY escrow_pubkey LIMIT %s)) AS user_packages
+        WHERE (escrow_pubkey, user_role) > (%s, %s)
+        ORDER BY escrow_pubkey, user_role
+        LIMIT %s''', (
+            user_pubkey, after[0], limit + 1, user_pubkey, after[0], limit + 1,
+            user_pubkey, after[0], events.COURIERED, events.COURIER_CONFIRMED, limit + 1,
+            after[0], after[1], limit))
+    return [(row['escrow_pubkey'], row['user_role']) for row in sql.fetchall()]
+
+
+@db.read_only
+def get_packages_page(user_pubkey=None, page_size=PAGE_SIZE, cursor=None):
+    """
+    Get a page of packages, ordered by escrow pubkey (and user role, for user packages).
+    Returns the packages and a cursor for the next page, which is None on the last page.
+    """
+    page_size = max(1, min(page_size or PAGE_SIZE, MAX_PAGE_SIZE))
+    after = decode_cursor(cursor) if cursor else ('', '')
+    with db.SQL_CONNECTION() as sql:
+        if user_pubkey:
+            roles = get_user_package_roles(sql, user_pubkey, after, page_size + 1)
+            rows = []
+            if roles:
+                escrow_pubkeys = sorted({escrow_pubkey for escrow_pubkey, _ in roles[:page_size]})
+                sql.execute(db.PACKAGES_SELECT + """
+                WHERE packages.escrow_pubkey IN ({})""".format(', '.join(['%s'] * len(escrow_pubkeys))),
+                            escrow_pubkeys)
+                rows_by_escrow = {row['escrow_pubkey']: row for row in sql.fetchall()}
+                rows = [dict(rows_by_escrow[escrow_pubkey]) for escrow_pubkey, _ in roles[:page_size]]
+        else:
+            sql.execute(db.PACKAGES_SELECT + """
+            WHERE packages.escrow_pubkey > %s
+            ORDER BY packages.escrow_pubkey
+            LIMIT %s""", (after[0], page_size + 1))
+            rows = sql.fetchall()
+            roles = [(row['escrow_pubkey'], '') for row in rows]
+    next_cursor = encode_cursor(*roles[page_size - 1]) if len(roles) > page_size else None
+    return db.enrich_packages(
+        rows[:page_size], user_roles=[user_role or None for _, user_role in roles[:page_size]]), next_cursor
+
+
+@db.read_only
+def get_packages(user_pubkey=None):
+    """Get a list of all packages, page by page."""
+    packages, cursor = get_packages_page(user_pubkey, MAX_PAGE_SIZE)
+    while cursor:
+        page, cursor = get_packages_page(user_pubkey, MAX_PAGE_SIZE, cursor)
+        packages.extend(page)
+    return packages
@@ -0,0 +1,176 @@
+"""Content addressed storage of event photos and their thumbnails."""
+import concurrent.futures
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+
+try:
+    import PIL.Image
+    import PIL.ImageOps
+except ImportError:
+    PIL = None
+
+LOGGER = logging.getLogger('pkt.photos')
+STORE_TYPE = os.environ.get('PAKET_PHOTO_STORE', 'local')
+STORE_PATH = os.environ.get('PAKET_PHOTO_STORE_PATH', 'photo_store')
+THUMBNAIL_WORKERS = int(os.environ.get('PAKET_THUMBNAIL_WORKERS', 2))
+
+# Maximal width and height of thumbnails, by size name.
+THUMBNAIL_SIZES = {'small': 160, 'medium': 480}
+THUMBNAIL_CONTENT_TYPE = 'image/jpeg'
+THUMBNAIL_QUALITY = 80
+
+# Magic numbers of the image formats we expect.
+CONTENT_TYPE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'))
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+
+class UnknownPhoto(Exception):
+    """Photo is not in the store."""
+
+
+class InvalidPhotoSize(Exception):
+    """Unknown thumbnail size."""
+
+
+def get_content_hash(data):
+    """Get the hash under which a photo is stored."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_content_type(data):
+    """Guess the content type of a photo from its leading bytes."""
+    return next((
+        content_type for signature, content_type in CONTENT_TYPE_SIGNATURES if data.startswith(signature)),
+                DEFAULT_CONTENT_TYPE)
+
+
+class LocalPhotoStore:
+    """Store photos as files named by their content hash on the local filesystem."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_path(self, content_hash, variant=None):
+        """Get the path of a stored photo, fanning files out into subdirectories by hash prefix."""
+        filename = content_hash if variant is None else "{}.{}".format(content_hash, variant)
+        return os.path.join(self.root, content_hash[:2], content_hash[2:4], filename)
+
+    def write(self, path, data):
+        """Write a file atomically, so concurrent readers never see a partial photo."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(file_descriptor, 'wb') as photo_file:
+            photo_file.write(data)
+        os.replace(temporary_path, path)
+
+    def put(self, data):
+        """Store a photo and return its content hash."""
+        content_hash = get_content_hash(data)
+        path = self.get_path(content_hash)
+        if not os.path.exists(path):
+            self.write(path, data)
+            LOGGER.debug("photo %s stored", content_hash)
+        return content_hash
+
+    def put_variant(self, content_hash, variant, data):
+        """Store a variant (such as a thumbnail) of a stored photo."""
+        self.write(self.get_path(content_hash, variant), data)
+
+    def has(self, content_hash, variant=None):
+        """Check if a photo, or a variant of it, is stored."""
+        return os.path.exists(self.get_path(content_hash, variant))
+
+    def open(self, content_hash, variant=None):
+        """Open a stored photo, or a variant of it, for binary reading."""
+        try:
+            return open(self.get_path(content_hash, variant), 'rb')
+        except FileNotFoundError:
+            raise UnknownPhoto("photo {} is not stored".format(content_hash))
+
+    def get(self, content_hash, variant=None):
+        """Get the content of a stored photo, or of a variant of it."""
+        with self.open(content_hash, variant) as photo_file:
+            return photo_file.read()
+
+    def get_size(self, content_hash, variant=None):
+        """Get the size in bytes of a stored photo, or of a variant of it."""
+        try:
+            return os.path.getsize(self.get_path(content_hash, variant))
+        except FileNotFoundError:
+            raise UnknownPhoto("photo {} is not stored".format(content_hash))
+
+
+STORE_TYPES = {'local': LocalPhotoStore}
+STORE = STORE_TYPES[STORE_TYPE](STORE_PATH)
+THUMBNAIL_EXECUTOR = None
+THUMBNAIL_EXECUTOR_LOCK = threading.Lock()
+
+
+def render_thumbnails(data, sizes):
+    """Render JPEG thumbnails of a photo, keyed by size name. Runs in a worker process."""
+    thumbnails = {}
+    with PIL.Image.open(io.BytesIO(data)) as image:
+        image = PIL.ImageOps.exif_transpose(image).convert('RGB')
+        for size, max_dimension in sizes.items():
+            thumbnail = image.copy()
+            thumbnail.thumbnail((max_dimension, max_dimension))
+            output = io.BytesIO()
+            thumbnail.save(output, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+            thumbnails[size] = output.getvalue()
+    return thumbnails
+
+
+def store_thumbnails(content_hash, future):
+    """Store the thumbnails rendered for a photo."""
+    try:
+        thumbnails = future.result()
+    except Exception as exc:  # pylint: disable=broad-except
+        LOGGER.error("can not render thumbnails of photo %s: %s", content_hash, exc)
+        return
+    for size, thumbnail in thumbnails.items():
+        STORE.put_variant(content_hash, size, thumbnail)
+    LOGGER.debug("thumbnails of photo %s stored", content_hash)
+
+
+def reset_thumbnail_executor():
+    """Forget the thumbnail executor inherited by a forked child process, which belongs to its parent."""
+    global THUMBNAIL_EXECUTOR, THUMBNAIL_EXECUTOR_LOCK  # pylint: disable=global-statement
+    THUMBNAIL_EXECUTOR = None
+    THUMBNAIL_EXECUTOR_LOCK = threading.Lock()
+
+
+def generate_thumbnails(content_hash, data):
+    """Render the thumbnails of a stored photo in a worker process and store them when ready."""
+    global THUMBNAIL_EXECUTOR  # pylint: disable=global-statement
+    if PIL is None:
+        LOGGER.warning("Pillow is not installed, no thumbnails for photo %s", content_hash)
+        return
+    missing_sizes = {
+        size: max_dimension for size, max_dimension in THUMBNAIL_SIZES.items() if not STORE.has(content_hash, size)}
+    if not missing_sizes:
+        return
+    with THUMBNAIL_EXECUTOR_LOCK:
+        if THUMBNAIL_EXECUTOR is None:
+            THUMBNAIL_EXECUTOR = concurrent.futures.ProcessPoolExecutor(THUMBNAIL_WORKERS)
+        future = THUMBNAIL_EXECUTOR.submit(render_thumbnails, data, missing_sizes)
+    future.add_done_callback(lambda future: store_thumbnails(content_hash, future))
+
+
+def get_variant(content_hash, size):
+    """
+    Get the stored variant of a photo to serve for a requested size.
+    Returns None, meaning the original photo, if no size was requested or the thumbnail is not ready yet.
+    """
+    if size is None:
+        return None
+    if size not in THUMBNAIL_SIZES:
+        raise InvalidPhotoSize("size must be one of {}".format(', '.join(sorted(THUMBNAIL_SIZES))))
+    return size if STORE.has(content_hash, size) else None
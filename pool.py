@@ -0,0 +1,100 @@
+"""Bounded pool of database connections."""
+import logging
+import queue
+import threading
+import time
+
+LOGGER = logging.getLogger('pkt.pool')
+
+
+class PoolTimeout(Exception):
+    """No connection was available in time."""
+
+
+class ConnectionPool:
+    """
+    A bounded pool of database connections, opened lazily.
+    Connections idle for longer than ping_interval seconds are checked (and reconnected if needed) on checkout.
+    """
+
+    def __init__(self, connect, size, timeout, ping_interval):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.discarded = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def get(self):
+        """Check out a connection, waiting up to timeout seconds for one to be available."""
+        start = time.time()
+        with self.lock:
+            open_new = self.idle.empty() and self.opened < self.size
+            if open_new:
+                self.opened += 1
+        try:
+            if open_new:
+                connection = self.connect()
+            else:
+                connection, returned = self.idle.get(timeout=self.timeout)
+                if time.time() - returned > self.ping_interval:
+                    connection.ping(reconnect=True, attempts=1)
+        except queue.Empty:
+            with self.lock:
+                self.timeouts += 1
+            raise PoolTimeout("no database connection available within {} seconds".format(self.timeout))
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+            raise
+        wait = time.time() - start
+        with self.lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return connection
+
+    def put(self, connection, broken=False):
+        """Return a checked out connection to the pool, or close it if it is broken."""
+        with self.lock:
+            self.in_use -= 1
+            if broken:
+                self.opened -= 1
+                self.discarded += 1
+        if broken:
+            LOGGER.warning("discarding broken database connection")
+            try:
+                connection.close()
+            except Exception:  # pylint: disable=broad-except
+                pass
+        else:
+            self.idle.put((connection, time.time()))
+
+    def reset(self):
+        """Forget all connections, without closing them - for use in a forked child process."""
+        self.lock = threading.Lock()
+        self.idle = queue.LifoQueue()
+        self.opened = self.in_use = 0
+
+    def stats(self):
+        """Get pool metrics."""
+        with self.lock:
+            return {
+                'size': self.size,
+                'opened': self.opened,
+                'in_use': self.in_use,
+                'idle': self.idle.qsize(),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'discarded': self.discarded,
+                'total_wait': self.total_wait,
+                'max_wait': self.max_wait,
+                'average_wait': self.total_wait / self.checkouts if self.checkouts else 0.0}
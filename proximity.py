@@ -0,0 +1,27 @@
+"""Batched great circle distances between a point and arrays of coordinates."""
+import numpy
+
+# Mean earth radius, used by both distances and the bounding boxes pre-filtering them.
+EARTH_RADIUS_KM = 6371
+
+
+def get_distances(latitude, longitude, latitudes, longitudes):
+    """Get the haversine distances (in km) between a point and each of the given coordinates."""
+    latitude, longitude = numpy.radians(latitude), numpy.radians(longitude)
+    latitudes = numpy.radians(numpy.asarray(latitudes, dtype=float))
+    longitudes = numpy.radians(numpy.asarray(longitudes, dtype=float))
+    haversine = numpy.sin((latitudes - latitude) / 2) ** 2 + numpy.cos(latitude) * numpy.cos(
+        latitudes) * numpy.sin((longitudes - longitude) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.clip(haversine, 0, 1)))
+
+
+def get_nearby(latitude, longitude, latitudes, longitudes, radius):
+    """
+    Find the coordinates within radius (in km) of a point.
+    Returns a mask of the coordinates within radius, their indexes from nearest to farthest, and their distances.
+    """
+    distances = get_distances(latitude, longitude, latitudes, longitudes)
+    mask = distances <= radius
+    indexes = numpy.flatnonzero(mask)
+    order = indexes[numpy.argsort(distances[indexes], kind='mergesort')]
+    return mask, order, distances[order]
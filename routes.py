@@ -1,20 +1,59 @@
 """Routes for Routing Server API."""
+import base64
 import os
+import time
 
 import flasgger
 import flask
 
+import paket_stellar
 import util.logger
 import util.conversion
 import webserver.validation
 
+import compression
 import db
+import metrics
+import pagination
+import photos
+import serialization
 import swagger_specs
+import sync
 
 LOGGER = util.logger.logging.getLogger('pkt.router.routes')
 VERSION = swagger_specs.VERSION
 PORT = os.environ.get('PAKET_ROUTER_PORT', 8000)
 BLUEPRINT = flask.Blueprint('router', __name__)
+# Longest time (in seconds) a sync request is held waiting for new events.
+MAX_SYNC_WAIT = int(os.environ.get('PAKET_SYNC_MAX_WAIT', 30))
+# Remembers recent writes of a client, so its reads stick to the primary database across requests.
+STICKY_PRIMARY_COOKIE = 'paket_primary_until'
+# Photos are content addressed, so they never change and can be cached indefinitely.
+PHOTO_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def set_etag(response):
+    """Set the ETag set by the handler, if any."""
+    if flask.g.get('etag') is not None:
+        response.set_etag(flask.g.etag)
+    return response
+
+
+def restore_sticky_primary():
+    """Stick reads to the primary if the client wrote recently, in an earlier request."""
+    try:
+        db.stick_to_primary(float(flask.request.cookies.get(STICKY_PRIMARY_COOKIE, 0)))
+    except ValueError:
+        pass
+
+
+def save_sticky_primary(response):
+    """Let the client's next requests know if reads should stick to the primary."""
+    primary_until = db.get_primary_until()
+    if primary_until > time.time() and str(primary_until) != flask.request.cookies.get(STICKY_PRIMARY_COOKIE):
+        response.set_cookie(
+            STICKY_PRIMARY_COOKIE, str(primary_until), max_age=int(primary_until - time.time()) + 1, httponly=True)
+    return response
 
 
 # Input validators and fixers.
@@ -23,15 +62,35 @@ webserver.validation.KWARGS_CHECKERS_AND_FIXERS['_buls'] = webserver.validation.
 webserver.validation.KWARGS_CHECKERS_AND_FIXERS['_num'] = webserver.validation.check_and_fix_natural
 webserver.validation.KWARGS_CHECKERS_AND_FIXERS['_id'] = webserver.validation.check_and_fix_natural
 webserver.validation.CUSTOM_EXCEPTION_STATUSES[db.UnknownPackage] = 404
+webserver.validation.CUSTOM_EXCEPTION_STATUSES[pagination.InvalidCursor] = 400
+webserver.validation.CUSTOM_EXCEPTION_STATUSES[photos.UnknownPhoto] = 404
+webserver.validation.CUSTOM_EXCEPTION_STATUSES[photos.InvalidPhotoSize] = 400
 
 
 # Internal error codes
 webserver.validation.INTERNAL_ERROR_CODES[db.util.geodecoding.GeodecodingError] = 110
-webserver.validation.INTERNAL_ERROR_CODES[db.paket_stellar.NotOnTestnet] = 120
-webserver.validation.INTERNAL_ERROR_CODES[db.paket_stellar.StellarTransactionFailed] = 200
-webserver.validation.INTERNAL_ERROR_CODES[db.paket_stellar.TrustError] = 202
+webserver.validation.INTERNAL_ERROR_CODES[paket_stellar.NotOnTestnet] = 120
+webserver.validation.INTERNAL_ERROR_CODES[paket_stellar.StellarTransactionFailed] = 200
+webserver.validation.INTERNAL_ERROR_CODES[paket_stellar.TrustError] = 202
 webserver.validation.INTERNAL_ERROR_CODES[db.UnknownPackage] = 400
 
+# Responses are serialized by the router's own JSON encoder, and compressed if large enough.
+BLUEPRINT.record_once(serialization.install)
+# Registered first, so the recorded duration includes all other after_request functions.
+if metrics.ENABLED:
+    BLUEPRINT.before_request(metrics.start_request)
+    BLUEPRINT.after_request(metrics.finish_request)
+BLUEPRINT.after_request(compression.compress_response)
+# Handlers may set an ETag for their response in flask.g.
+# Registered after compression, so it runs first, and the ETag is weakened if the response is compressed.
+BLUEPRINT.after_request(set_etag)
+# With read replicas, clients which wrote recently read from the primary.
+if db.REPLICA_POOLS:
+    BLUEPRINT.before_request(restore_sticky_primary)
+    BLUEPRINT.after_request(save_sticky_primary)
+# Requests share pooled database connections, returned to their pools on teardown.
+BLUEPRINT.teardown_app_request(db.release_connection)
+
 
 # Package routes.
 
@@ -167,14 +226,21 @@ def request_relay_handler(user_pubkey, escrow_pubkey, location, kwargs=None, pho
 @BLUEPRINT.route("/v{}/my_packages".format(VERSION), methods=['POST'])
 @flasgger.swag_from(swagger_specs.MY_PACKAGES)
 @webserver.validation.call(require_auth=True)
-def my_packages_handler(user_pubkey):
+def my_packages_handler(user_pubkey, page_size_num=None, cursor=None):
     """
     Get list of packages concerning the user.
+    All packages are returned unless page_size_num or cursor is given, in which case packages are returned
+    a page at a time; pass the returned cursor to get the next page.
     ---
     :param user_pubkey:
+    :param page_size_num:
+    :param cursor:
     :return:
     """
-    return {'status': 200, 'packages': db.get_packages(user_pubkey)}
+    if page_size_num is None and cursor is None:
+        return {'status': 200, 'packages': pagination.get_packages(user_pubkey), 'cursor': None}
+    packages, next_cursor = pagination.get_packages_page(user_pubkey, page_size_num, cursor)
+    return {'status': 200, 'packages': packages, 'cursor': next_cursor}
 
 
 @BLUEPRINT.route("/v{}/package".format(VERSION), methods=['POST'])
@@ -183,38 +249,116 @@ def my_packages_handler(user_pubkey):
 def package_handler(escrow_pubkey, check_escrow=None):
     """
     Get a full info about a single package.
+    Responses carry an ETag, and requests with a matching If-None-Match header get an empty 304 response.
     ---
     :param escrow_pubkey:
     :param check_escrow:
     :return:
     """
+    flask.g.etag = db.get_package_etag(escrow_pubkey, bool(check_escrow))
+    if flask.g.etag is not None and flask.request.if_none_match.contains_weak(flask.g.etag):
+        return {'status': 304}
     return {'status': 200, 'package': db.get_package(escrow_pubkey, bool(check_escrow))}
 
 
+@BLUEPRINT.route("/v{}/package_by_short_id".format(VERSION), methods=['POST'])
+@flasgger.swag_from(swagger_specs.PACKAGE_BY_SHORT_ID)
+@webserver.validation.call(['short_package_id'])
+def package_by_short_id_handler(short_package_id):
+    """
+    Get packages by short package id.
+    Short package ids are not unique, so a list of packages is returned.
+    ---
+    :param short_package_id:
+    :return:
+    """
+    return {'status': 200, 'packages': db.get_packages_by_short_id(short_package_id)}
+
+
+def add_photo_content(photo, size=None):
+    """Add the base64 encoded content of a photo, or of its thumbnail, to its metadata."""
+    if photo is not None:
+        photo['photo'] = base64.b64encode(photos.STORE.get(
+            photo['content_hash'], photos.get_variant(photo['content_hash'], size))).decode()
+    return photo
+
+
+def send_photo(photo, size=None):
+    """Stream the raw content of a photo, or of its thumbnail, with cache headers and Range support."""
+    if photo is None:
+        flask.abort(404)
+    try:
+        variant = photos.get_variant(photo['content_hash'], size)
+    except photos.InvalidPhotoSize:
+        flask.abort(400)
+    try:
+        if variant is None:
+            content_type, content_length, etag = photo['content_type'], photo['size'], photo['content_hash']
+        else:
+            content_type = photos.THUMBNAIL_CONTENT_TYPE
+            content_length = photos.STORE.get_size(photo['content_hash'], variant)
+            etag = "{}-{}".format(photo['content_hash'], variant)
+        photo_file = photos.STORE.open(photo['content_hash'], variant)
+    except photos.UnknownPhoto:
+        LOGGER.warning("photo %s is missing from the photo store", photo['content_hash'])
+        flask.abort(404)
+    response = flask.send_file(photo_file, mimetype=content_type, add_etags=False)
+    response.set_etag(etag)
+    # A thumbnail which is not ready yet is temporarily replaced by the original photo, which must not be cached.
+    response.headers['Cache-Control'] = PHOTO_CACHE_CONTROL if variant == size else 'no-cache'
+    return response.make_conditional(flask.request, accept_ranges=True, complete_length=content_length)
+
+
 @BLUEPRINT.route("/v{}/package_photo".format(VERSION), methods=['POST'])
 @flasgger.swag_from(swagger_specs.PACKAGE_PHOTO)
 @webserver.validation.call(['escrow_pubkey'])
-def package_photo_handler(escrow_pubkey):
+def package_photo_handler(escrow_pubkey, size=None):
     """
     Get package photo.
     ---
     :param escrow_pubkey:
+    :param size:
+    :return:
+    """
+    return {'status': 200, 'package_photo': add_photo_content(db.get_package_photo(escrow_pubkey), size)}
+
+
+@BLUEPRINT.route("/v{}/package_photo/<escrow_pubkey>".format(VERSION), methods=['GET'])
+@flasgger.swag_from(swagger_specs.RAW_PACKAGE_PHOTO)
+def raw_package_photo_handler(escrow_pubkey):
+    """
+    Get the raw content of package photo.
+    ---
+    :param escrow_pubkey:
     :return:
     """
-    return {'status': 200, 'package_photo': db.get_package_photo(escrow_pubkey)}
+    return send_photo(db.get_package_photo(escrow_pubkey), flask.request.args.get('size'))
 
 
 @BLUEPRINT.route("/v{}/event_photo".format(VERSION), methods=['POST'])
 @flasgger.swag_from(swagger_specs.EVENT_PHOTO)
 @webserver.validation.call
-def event_photo_handler(photo_id):
+def event_photo_handler(photo_id, size=None):
     """
     Get event photo by photo id.
     ---
     :param photo_id:
+    :param size:
     :return:
     """
-    return {'status': 200, 'event_photo': db.get_event_photo_by_id(photo_id)}
+    return {'status': 200, 'event_photo': add_photo_content(db.get_event_photo_by_id(photo_id), size)}
+
+
+@BLUEPRINT.route("/v{}/event_photo/<int:photo_id>".format(VERSION), methods=['GET'])
+@flasgger.swag_from(swagger_specs.RAW_EVENT_PHOTO)
+def raw_event_photo_handler(photo_id):
+    """
+    Get the raw content of event photo by photo id.
+    ---
+    :param photo_id:
+    :return:
+    """
+    return send_photo(db.get_event_photo_by_id(photo_id), flask.request.args.get('size'))
 
 
 @BLUEPRINT.route("/v{}/add_event".format(VERSION), methods=['POST'])
@@ -254,6 +398,23 @@ def changed_location_handler(user_pubkey, escrow_pubkey, location, kwargs=None,
     return {'status': 200}
 
 
+@BLUEPRINT.route("/v{}/sync_events".format(VERSION), methods=['POST'])
+@flasgger.swag_from(swagger_specs.SYNC_EVENTS)
+@webserver.validation.call
+def sync_events_handler(since_idx_num=0, limit_num=None, wait_num=0):
+    """
+    Get the events added since a known event, in the order they were added.
+    Pass the returned cursor as since_idx_num to get the following events.
+    ---
+    :param since_idx_num:
+    :param limit_num:
+    :param wait_num:
+    :return:
+    """
+    events = sync.wait_for_events_since(since_idx_num, limit_num, min(wait_num, MAX_SYNC_WAIT))
+    return {'status': 200, 'events': events, 'cursor': events[-1]['idx'] if events else since_idx_num}
+
+
 @BLUEPRINT.route("/v{}/set_notification_token".format(VERSION), methods=['POST'])
 @flasgger.swag_from(swagger_specs.SET_NOTIFICATION_TOKEN)
 @webserver.validation.call(['notification_token'], require_auth=True)
@@ -318,13 +479,20 @@ def create_mock_package_handler(
 @BLUEPRINT.route("/v{}/debug/packages".format(VERSION), methods=['POST'])
 @flasgger.swag_from(swagger_specs.PACKAGES)
 @webserver.validation.call
-def packages_handler():
+def packages_handler(page_size_num=None, cursor=None):
     """
     Get list of packages - for debug only.
+    All packages are returned unless page_size_num or cursor is given, in which case packages are returned
+    a page at a time; pass the returned cursor to get the next page.
     ---
+    :param page_size_num:
+    :param cursor:
     :return:
     """
-    return {'status': 200, 'packages': db.get_packages()}
+    if page_size_num is None and cursor is None:
+        return {'status': 200, 'packages': pagination.get_packages(), 'cursor': None}
+    packages, next_cursor = pagination.get_packages_page(page_size=page_size_num, cursor=cursor)
+    return {'status': 200, 'packages': packages, 'cursor': next_cursor}
 
 
 @BLUEPRINT.route("/v{}/events".format(VERSION), methods=['POST'])
@@ -368,3 +536,26 @@ def view_log_handler(lines_num=10):
     """
     with open(os.path.join(util.logger.LOG_DIR_NAME, util.logger.LOG_FILE_NAME)) as logfile:
         return {'status': 200, 'log': logfile.readlines()[:-1 - lines_num:-1]}
+
+
+@BLUEPRINT.route("/v{}/debug/pool".format(VERSION), methods=['POST'])
+@flasgger.swag_from(swagger_specs.POOL)
+@webserver.validation.call
+def pool_handler():
+    """
+    Get database connection pool, replica lag and read routing metrics - for debug only.
+    ---
+    :return:
+    """
+    return dict(db.get_routing_stats(), status=200)
+
+
+@BLUEPRINT.route("/v{}/metrics".format(VERSION), methods=['GET'])
+@flasgger.swag_from(swagger_specs.METRICS)
+def metrics_handler():
+    """
+    Get request latency, SQL, external call and database pool metrics, in the Prometheus text format.
+    ---
+    :return:
+    """
+    return flask.Response(metrics.render(db.get_routing_stats()), content_type=metrics.CONTENT_TYPE)
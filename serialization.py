@@ -0,0 +1,52 @@
+"""JSON serialization of responses, with orjson when available."""
+import base64
+import decimal
+import logging
+import os
+
+import flask.json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+LOGGER = logging.getLogger('pkt.serialization')
+# Set to 'json' to use the standard library serializer even if orjson is installed.
+SERIALIZER = os.environ.get('PAKET_JSON_SERIALIZER', 'orjson')
+USE_ORJSON = SERIALIZER == 'orjson' and orjson is not None
+
+
+class JSONEncoder(flask.json.JSONEncoder):
+    """
+    Flask JSON encoder handling Decimal and bytes values, and encoding with orjson if enabled.
+    Datetimes are left to flask, which formats them as HTTP dates.
+    """
+
+    def default(self, o):  # pylint: disable=method-hidden
+        """Convert values which are not natively serializable."""
+        if isinstance(o, decimal.Decimal):
+            return int(o) if o == o.to_integral_value() else float(o)
+        if isinstance(o, bytes):
+            try:
+                return o.decode('utf8')
+            except UnicodeDecodeError:
+                return base64.b64encode(o).decode()
+        return super().default(o)
+
+    def encode(self, o):
+        """Encode with orjson if enabled, otherwise with the standard library."""
+        if not USE_ORJSON:
+            return super().encode(o)
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if self.indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(o, default=self.default, option=option).decode()
+
+
+def install(state):
+    """Make the app serialize JSON with JSONEncoder - to be recorded on a blueprint."""
+    state.app.json_encoder = JSONEncoder
+    LOGGER.info("serializing JSON with %s", 'orjson' if USE_ORJSON else 'json')
@@ -0,0 +1,81 @@
+"""Production server of the PAKET router - gunicorn workers forked from a master with the app preloaded."""
+import logging
+import multiprocessing
+import os
+
+import gunicorn.app.base
+
+import balances
+import db
+import metrics
+import notifications
+import photos
+import routes
+
+LOGGER = logging.getLogger('pkt.server')
+WORKERS = int(os.environ.get('PAKET_ROUTER_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+THREADS = int(os.environ.get('PAKET_ROUTER_THREADS', 4))
+# Workers silent for longer than this (in seconds) are killed and replaced, so it must exceed the longest sync wait.
+TIMEOUT = int(os.environ.get('PAKET_ROUTER_TIMEOUT', max(60, routes.MAX_SYNC_WAIT * 2)))
+# On reload (SIGHUP) or shutdown, workers get this long (in seconds) to finish the requests they are handling.
+GRACEFUL_TIMEOUT = int(os.environ.get('PAKET_ROUTER_GRACEFUL_TIMEOUT', 30))
+KEEPALIVE = int(os.environ.get('PAKET_ROUTER_KEEPALIVE', 5))
+# Workers are replaced after this many requests (0 never), with some jitter so they are not replaced at once.
+MAX_REQUESTS = int(os.environ.get('PAKET_ROUTER_MAX_REQUESTS', 0))
+
+
+def post_fork(_, worker):
+    """Give a new worker its own connections and executors, instead of the ones inherited from the master."""
+    db.reset_connections()
+    balances.reset()
+    photos.reset_thumbnail_executor()
+    notifications.reset_app()
+    metrics.start_snapshots(db.get_routing_stats)
+    LOGGER.info("worker %s ready", worker.pid)
+
+
+def worker_exit(*_):
+    """Write the last metrics snapshot of an exiting worker."""
+    metrics.write_snapshot(db.get_routing_stats)
+
+
+def child_exit(_, worker):
+    """Keep the counters and histograms of an exited worker, so the merged ones do not go back."""
+    metrics.archive_worker(worker.pid)
+
+
+class Server(gunicorn.app.base.BaseApplication):
+    """Gunicorn server of an already loaded app."""
+
+    def __init__(self, app, options):
+        self.app = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        """Apply the options."""
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        """Get the app."""
+        return self.app
+
+
+def run(app, port=routes.PORT):
+    """Serve an app until stopped."""
+    metrics.setup_directory()
+    Server(app, {
+        'bind': "0.0.0.0:{}".format(port),
+        'workers': WORKERS,
+        'threads': THREADS,
+        'worker_class': 'gthread' if THREADS > 1 else 'sync',
+        'preload_app': True,
+        'timeout': TIMEOUT,
+        'graceful_timeout': GRACEFUL_TIMEOUT,
+        'keepalive': KEEPALIVE,
+        'max_requests': MAX_REQUESTS,
+        'max_requests_jitter': MAX_REQUESTS // 10,
+        'post_fork': post_fork,
+        'worker_exit': worker_exit,
+        'child_exit': child_exit}).run()
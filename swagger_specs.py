@@ -141,7 +141,10 @@ PACKAGE_PHOTO = {
     'parameters': [
         {
             'name': 'escrow_pubkey', 'description': 'escrow pubkey (the package ID)',
-            'in': 'formData', 'required': True, 'type': 'string'}],
+            'in': 'formData', 'required': True, 'type': 'string'},
+        {
+            'name': 'size', 'description': 'thumbnail size (small or medium), the original photo if omitted',
+            'in': 'formData', 'required': False, 'type': 'string'}],
     'responses': {
         '200': {
             'description': 'package photo'}}}
@@ -151,11 +154,50 @@ EVENT_PHOTO = {
     'parameters': [
         {
             'name': 'photo_id', 'description': 'unique photo id',
-            'in': 'formData', 'required': True, 'type': 'integer'}],
+            'in': 'formData', 'required': True, 'type': 'integer'},
+        {
+            'name': 'size', 'description': 'thumbnail size (small or medium), the original photo if omitted',
+            'in': 'formData', 'required': False, 'type': 'string'}],
     'responses': {
         '200': {
             'description': 'event photo'}}}
 
+RAW_PACKAGE_PHOTO = {
+    'tags': ['packages'],
+    'produces': ['image/jpeg', 'image/png', 'image/gif', 'application/octet-stream'],
+    'parameters': [
+        {
+            'name': 'escrow_pubkey', 'description': 'escrow pubkey (the package ID)',
+            'in': 'path', 'required': True, 'type': 'string'},
+        {
+            'name': 'size', 'description': 'thumbnail size (small or medium), the original photo if omitted',
+            'in': 'query', 'required': False, 'type': 'string'}],
+    'responses': {
+        '200': {
+            'description': 'package photo content'},
+        '206': {
+            'description': 'requested range of package photo content'},
+        '404': {
+            'description': 'package has no photo'}}}
+
+RAW_EVENT_PHOTO = {
+    'tags': ['packages'],
+    'produces': ['image/jpeg', 'image/png', 'image/gif', 'application/octet-stream'],
+    'parameters': [
+        {
+            'name': 'photo_id', 'description': 'unique photo id',
+            'in': 'path', 'required': True, 'type': 'integer'},
+        {
+            'name': 'size', 'description': 'thumbnail size (small or medium), the original photo if omitted',
+            'in': 'query', 'required': False, 'type': 'string'}],
+    'responses': {
+        '200': {
+            'description': 'event photo content'},
+        '206': {
+            'description': 'requested range of event photo content'},
+        '404': {
+            'description': 'no such photo'}}}
+
 ACCEPT_PACKAGE = {
     'tags': ['packages'],
     'parameters': [
@@ -240,7 +282,14 @@ MY_PACKAGES = {
     'parameters': [
         {'name': 'Pubkey', 'in': 'header', 'required': True, 'type': 'string'},
         {'name': 'Fingerprint', 'in': 'header', 'required': True, 'type': 'string'},
-        {'name': 'Signature', 'in': 'header', 'required': True, 'type': 'string'}],
+        {'name': 'Signature', 'in': 'header', 'required': True, 'type': 'string'},
+        {
+            'name': 'page_size_num',
+            'description': 'maximum number of packages to return, all packages if neither it nor cursor is given',
+            'in': 'formData', 'required': False, 'type': 'integer'},
+        {
+            'name': 'cursor', 'description': 'cursor returned with the previous page',
+            'in': 'formData', 'required': False, 'type': 'string'}],
     'responses': {
         '200': {
             'description': 'list of packages',
@@ -249,7 +298,11 @@ MY_PACKAGES = {
                     'packages': {
                         'type': 'array',
                         'items': {
-                            '$ref': '#/definitions/Package-info'}}}}}}}
+                            '$ref': '#/definitions/Package-info'}},
+                    'cursor': {
+                        'type': 'string',
+                        'description': 'cursor of the next page, null on the last page'}}}},
+        '400': {'description': 'invalid cursor'}}}
 
 REQUEST_RELAY = {
     'tags': ['packages'],
@@ -281,7 +334,10 @@ PACKAGE = {
             'in': 'formData', 'required': True, 'type': 'string'},
         {
             'name': 'check_escrow', 'description': 'include information about payment and collateral if specified',
-            'in': 'formData', 'required': False, 'type': 'integer'}],
+            'in': 'formData', 'required': False, 'type': 'integer'},
+        {
+            'name': 'If-None-Match', 'description': 'ETag of a previous response, to get a 304 if it is still valid',
+            'in': 'header', 'required': False, 'type': 'string'}],
     'definitions': {
         'Event': {
             'type': 'object',
@@ -323,7 +379,24 @@ PACKAGE = {
         '200': {
             'description': 'a single packages',
             'schema': {
-                '$ref': '#/definitions/Package-info'}}}}
+                '$ref': '#/definitions/Package-info'}},
+        '304': {'description': 'package did not change since the response with the If-None-Match ETag'}}}
+
+PACKAGE_BY_SHORT_ID = {
+    'tags': ['packages'],
+    'parameters': [
+        {
+            'name': 'short_package_id', 'description': 'short package id, as shown to users',
+            'in': 'formData', 'required': True, 'type': 'string'}],
+    'responses': {
+        '200': {
+            'description': 'packages with the short package id',
+            'schema': {
+                'properties': {
+                    'packages': {
+                        'type': 'array',
+                        'items': {
+                            '$ref': '#/definitions/Package-info'}}}}}}}
 
 ADD_EVENT = {
     'tags': ['packages'],
@@ -382,6 +455,26 @@ EVENTS = {
     'responses': {
         '200': {'description': 'a list of events'}}}
 
+SYNC_EVENTS = {
+    'tags': ['packages'],
+    'parameters': [
+        {
+            'name': 'since_idx_num', 'description': 'cursor returned by the previous sync, 0 to start from scratch',
+            'in': 'formData', 'required': False, 'type': 'integer'},
+        {
+            'name': 'limit_num', 'description': 'maximum number of events to return',
+            'in': 'formData', 'required': False, 'type': 'integer'},
+        {
+            'name': 'wait_num', 'description': 'seconds to wait for new events if there are none yet',
+            'in': 'formData', 'required': False, 'type': 'integer'}],
+    'responses': {
+        '200': {
+            'description': 'events added since the cursor, and the cursor to sync from next',
+            'schema': {
+                'properties': {
+                    'events': {'type': 'array', 'items': {'type': 'object'}},
+                    'cursor': {'type': 'integer'}}}}}}
+
 SET_NOTIFICATION_TOKEN = {
     'tags': ['notifications'],
     'parameters': [
@@ -455,8 +548,17 @@ CREATE_MOCK_PACKAGE = {
 
 PACKAGES = {
     'tags': ['debug'],
+    'parameters': [
+        {
+            'name': 'page_size_num',
+            'description': 'maximum number of packages to return, all packages if neither it nor cursor is given',
+            'in': 'formData', 'required': False, 'type': 'integer'},
+        {
+            'name': 'cursor', 'description': 'cursor returned with the previous page',
+            'in': 'formData', 'required': False, 'type': 'string'}],
     'responses': {
-        '200': {'description': 'a list of packages'}}}
+        '200': {'description': 'all packages, or a page of packages and the cursor of the next page'},
+        '400': {'description': 'invalid cursor'}}}
 
 LOG = {
     'tags': ['debug'],
@@ -471,3 +573,14 @@ LOG = {
     'responses': {
         '200': {
             'description': 'log lines'}}}
+
+POOL = {
+    'tags': ['debug'],
+    'responses': {
+        '200': {'description': 'database connection pool, replica lag and read routing metrics'}}}
+
+METRICS = {
+    'tags': ['debug'],
+    'produces': ['text/plain'],
+    'responses': {
+        '200': {'description': 'request latency, SQL, external call and database pool metrics'}}}
@@ -0,0 +1,57 @@
+"""Incremental sync of events."""
+import os
+import time
+
+import db
+
+# Default and maximal number of events returned in a single sync batch.
+SYNC_BATCH_SIZE = int(os.environ.get('PAKET_SYNC_BATCH_SIZE', 100))
+MAX_SYNC_BATCH_SIZE = int(os.environ.get('PAKET_SYNC_MAX_BATCH_SIZE', 1000))
+# Waiting syncs recheck the database at this interval (in seconds), to see events added by other processes.
+SYNC_POLL_INTERVAL = float(os.environ.get('PAKET_SYNC_POLL_INTERVAL', 1))
+# Longest time (in seconds) between inserting an event and committing it, see get_events_since.
+SYNC_COMMIT_WINDOW = float(os.environ.get('PAKET_SYNC_COMMIT_WINDOW', 2))
+
+
+@db.primary
+def get_events_since(since_idx, limit=SYNC_BATCH_SIZE):
+    """
+    Get the events following the event with idx since_idx, in idx order.
+    An event idx is assigned on insert but only visible on commit, so a gap in idx may be an event still in flight.
+    Events following a gap are held back until they are older than the commit window, so that syncing from the
+    last idx returned never skips an event committed later.
+    Events are read from the primary, as a lagging replica could show an event following a gap as settled before
+    the event in the gap replicates.
+    """
+    with db.SQL_CONNECTION() as sql:
+        sql.execute('''
+            SELECT *, timestamp < NOW(6) - INTERVAL %s MICROSECOND AS settled FROM events
+            WHERE idx > %s
+            ORDER BY idx ASC LIMIT %s''', (
+                int(SYNC_COMMIT_WINDOW * 1000000), since_idx,
+                max(1, min(limit or SYNC_BATCH_SIZE, MAX_SYNC_BATCH_SIZE))))
+        rows = sql.fetchall()
+    new_events, last_idx = [], since_idx
+    for event in rows:
+        if not event.pop('settled') and event['idx'] != last_idx + 1:
+            break
+        new_events.append(event)
+        last_idx = event['idx']
+    return new_events
+
+
+def wait_for_events_since(since_idx, limit=SYNC_BATCH_SIZE, timeout=0):
+    """
+    Get the events following the event with idx since_idx, waiting up to timeout seconds for new events.
+    Events added by this process wake the waiters immediately, others are found by polling.
+    """
+    deadline = time.time() + timeout
+    while True:
+        new_events = get_events_since(since_idx, limit)
+        remaining = deadline - time.time()
+        if new_events or remaining <= 0:
+            return new_events
+        # Do not hold on to a pooled connection while waiting.
+        db.release_connection()
+        with db.NEW_EVENTS:
+            db.NEW_EVENTS.wait(min(remaining, SYNC_POLL_INTERVAL))
@@ -0,0 +1,65 @@
+"""Tests for balances module"""
+import threading
+import unittest
+
+import balances
+
+
+class FakeStellar:
+    """Local stand-in for paket_stellar, counting the balance lookups made."""
+
+    class TrustError(Exception):
+        """Account does not trust BUL."""
+
+    class StellarAccountNotExists(Exception):
+        """Account does not exist."""
+
+    def __init__(self, accounts):
+        self.accounts = accounts
+        self.lookups = []
+        self.lock = threading.Lock()
+
+    def get_bul_account(self, pubkey):
+        """Get a fake account."""
+        with self.lock:
+            self.lookups.append(pubkey)
+        if pubkey not in self.accounts:
+            raise self.StellarAccountNotExists(pubkey)
+        return {'bul_balance': self.accounts[pubkey]}
+
+
+class BalancesTest(unittest.TestCase):
+    """Test balance lookups against a fake stellar module."""
+
+    def setUp(self):
+        """Replace paket_stellar with a fake."""
+        self.real_stellar = balances.paket_stellar
+        self.stellar = balances.paket_stellar = FakeStellar({'launcher': 100, 'escrow': 300})
+        balances.clear_cache()
+
+    def tearDown(self):
+        """Restore paket_stellar."""
+        balances.paket_stellar = self.real_stellar
+        balances.clear_cache()
+
+    def test_get_bul_balances(self):
+        """Test that each distinct account is looked up once."""
+        bul_balances = balances.get_bul_balances(['launcher', 'escrow', 'launcher', 'missing', 'launcher'])
+        self.assertEqual(bul_balances, {'launcher': 100, 'escrow': 300, 'missing': None})
+        self.assertEqual(sorted(self.stellar.lookups), ['escrow', 'launcher', 'missing'])
+
+    def test_cache(self):
+        """Test that repeated lookups are served from the cache until it is cleared."""
+        balances.get_bul_balances(['launcher', 'escrow'])
+        self.assertEqual(balances.get_bul_balance('launcher'), 100)
+        self.assertEqual(len(self.stellar.lookups), 2, 'cached balance was looked up again')
+        balances.clear_cache()
+        self.stellar.accounts['launcher'] = 50
+        self.assertEqual(balances.get_bul_balance('launcher'), 50)
+        self.assertEqual(len(self.stellar.lookups), 3, 'cleared balance was not looked up again')
+
+    def test_missing_account_not_an_error(self):
+        """Test that accounts without a balance are not counted as failed lookups."""
+        errors = balances.metrics.EXTERNAL_CALL_ERRORS.values.get(('stellar', 'get_bul_account'))
+        self.assertIsNone(balances.get_bul_balance('missing'))
+        self.assertEqual(balances.metrics.EXTERNAL_CALL_ERRORS.values.get(('stellar', 'get_bul_account')), errors)
@@ -0,0 +1,32 @@
+"""Tests for compression module"""
+import gzip
+import unittest
+
+import flask
+
+import compression
+
+
+class CompressionTest(unittest.TestCase):
+    """Test compression of responses of a minimal app."""
+
+    def setUp(self):
+        """Set up an app with a small and a large response."""
+        blueprint = flask.Blueprint('compressed', __name__)
+        blueprint.after_request(compression.compress_response)
+        blueprint.add_url_rule('/small', 'small', lambda: flask.jsonify(status=200))
+        blueprint.add_url_rule('/large', 'large', lambda: flask.jsonify(pubkeys=['G' * 56] * 100))
+        app = flask.Flask(__name__)
+        app.register_blueprint(blueprint)
+        self.client = app.test_client()
+
+    def test_negotiation(self):
+        """Large responses are compressed only for clients accepting a supported encoding."""
+        response = self.client.get('/large', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(gzip.decompress(response.data), self.client.get('/large').data)
+        self.assertIn('Accept-Encoding', response.headers.get('Vary'))
+        for path, accept_encoding in (('/large', 'identity'), ('/large', 'gzip;q=0'), ('/small', 'gzip')):
+            self.assertNotIn(
+                'Content-Encoding', self.client.get(path, headers={'Accept-Encoding': accept_encoding}).headers,
+                "{} compressed for client accepting {}".format(path, accept_encoding))
@@ -1,29 +1,40 @@
 """Test the PAKET API database."""
+import contextlib
+import threading
 import time
 import unittest
 
+import flask
 import paket_stellar
 import util.logger
 
 import db
+import migrations
+import pagination
+import sync
 
 LOGGER = util.logger.logging.getLogger('pkt.router.test')
 
 
 def create_tables():
     """Create tables if they does not exists"""
-    try:
-        LOGGER.info('creating tables...')
-        db.init_db()
-    except db.util.db.mysql.connector.ProgrammingError:
-        LOGGER.info('tables already exists')
+    LOGGER.info('creating tables...')
+    migrations.init_db()
 
 
 def clear_tables():
-    """Clear all tables in db"""
+    """Clear all tables in db, keeping the applied schema versions so migrations are not reapplied"""
     assert db.DB_NAME.startswith('test'), "refusing to test on db named {}".format(db.DB_NAME)
     LOGGER.info('clearing database')
+    with db.SQL_CONNECTION() as sql:
+        sql.execute('SELECT version, description, applied FROM schema_version')
+        versions = sql.fetchall()
     db.util.db.clear_tables(db.SQL_CONNECTION, db.DB_NAME)
+    with db.SQL_CONNECTION() as sql:
+        sql.executemany('''
+            INSERT INTO schema_version (version, description, applied) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE version = version''', [
+                (version['version'], version['description'], version['applied']) for version in versions])
 
 
 class DbBaseTest(unittest.TestCase):
@@ -68,7 +79,7 @@ class CreatePackageTest(DbBaseTest):
             '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
             '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
         events = db.get_package_events(package_members['escrow'][0])
-        packages = db.get_packages(package_members['launcher'][0])
+        packages = pagination.get_packages(package_members['launcher'][0])
         self.assertEqual(len(packages), 1,
                          "should be 1 created package, {} got instead".format(len(packages)))
         self.assertEqual(len(events), 1,
@@ -128,6 +139,43 @@ class GetPackageTest(DbBaseTest):
         with self.assertRaises(db.UnknownPackage, msg='UnknownPackage was not raised on invalid pubkey'):
             db.get_package('invalid pubkey')
 
+    def test_get_package_etag(self):
+        """Package ETag changes with every new event, and with country codes set without events."""
+        package_members = self.prepare_package_members()
+        self.assertIsNone(db.get_package_etag(package_members['escrow'][0]), "unknown package has an ETag")
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        etag = db.get_package_etag(package_members['escrow'][0])
+        self.assertEqual(etag, db.get_package_etag(package_members['escrow'][0]), "ETag changed without events")
+        db.changed_location(package_members['launcher'][0], '12.980686,77.595590', package_members['escrow'][0])
+        self.assertNotEqual(etag, db.get_package_etag(package_members['escrow'][0]), "ETag unchanged by new event")
+        etag = db.get_package_etag(package_members['escrow'][0])
+        with db.SQL_CONNECTION() as sql:
+            sql.execute('''
+                UPDATE packages SET country_code = 'ZZ', short_package_id = 'ZZ-ABC'
+                WHERE escrow_pubkey = %s''', (package_members['escrow'][0],))
+        self.assertNotEqual(
+            etag, db.get_package_etag(package_members['escrow'][0]), "ETag unchanged by a new country code")
+
+    def test_get_packages_by_short_id(self):
+        """Getting packages by stored and backfilled short package id."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        package = db.get_package(package_members['escrow'][0])
+        self.assertEqual(
+            [found['escrow_pubkey'] for found in db.get_packages_by_short_id(package['short_package_id'])],
+            [package_members['escrow'][0]], "package not found by its short id")
+        with db.SQL_CONNECTION() as sql:
+            sql.execute('UPDATE packages SET country_code = NULL, short_package_id = NULL')
+        self.assertEqual(
+            migrations.backfill_country_codes(), 1, "expected country code of a single package to be filled")
+        self.assertEqual(db.get_package(package_members['escrow'][0]), package, "backfilled package differs")
+
 
 class GetPackagesTest(DbBaseTest):
     """Getting packages test."""
@@ -141,7 +189,7 @@ class GetPackagesTest(DbBaseTest):
                 '+490857461783', '+4904597863891', i * 10 ** 7, i * 2 * 10 ** 7, time.time(),
                 'Package description', '12.970686,77.595590', '41.156193,-8.637541',
                 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
-        packages = db.get_packages()
+        packages = pagination.get_packages()
         self.assertEqual(len(packages), 5, "expected 5 packages, {} got instead".format(len(packages)))
 
     def test_get_user_packages(self):
@@ -168,7 +216,7 @@ class GetPackagesTest(DbBaseTest):
             'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
         db.add_event(user[0], 'couriered', '12.970686,77.595590', third_package_members['escrow'][0])
 
-        packages = db.get_packages(user[0])
+        packages = pagination.get_packages(user[0])
         self.assertEqual(len(packages), 3, "3 packages expected, {} got instead".format(len(packages)))
         package = next((
             package for package in packages if package['launcher_pubkey'] == user[0]), None)
@@ -191,6 +239,27 @@ class GetPackagesTest(DbBaseTest):
         self.assertEqual(package['custodian_pubkey'], user[0],
                          "{} expected as custodian, {} got instead".format(user[0], package['custodian_pubkey']))
 
+    def test_get_packages_page(self):
+        """Paging through packages returns each package once, in order."""
+        user = self.generate_keypair()
+        for _ in range(5):
+            package_members = self.prepare_package_members()
+            db.create_package(
+                package_members['escrow'][0], user[0], package_members['recipient'][0],
+                '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
+                '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto',
+                '12.970686,77.595590', None)
+        for user_pubkey in (user[0], None):
+            escrow_pubkeys, cursor = [], None
+            for _ in range(3):
+                packages, cursor = pagination.get_packages_page(user_pubkey, 2, cursor)
+                escrow_pubkeys.extend(package['escrow_pubkey'] for package in packages)
+            self.assertIsNone(cursor, "expected no cursor after the last page")
+            self.assertEqual(len(escrow_pubkeys), 5, "expected 5 packages, {} got instead".format(len(escrow_pubkeys)))
+            self.assertEqual(escrow_pubkeys, sorted(escrow_pubkeys), "packages are not ordered by escrow pubkey")
+        with self.assertRaises(pagination.InvalidCursor):
+            pagination.get_packages_page(user[0], 2, 'not a cursor')
+
 
 class AddEventTest(DbBaseTest):
     """Adding event test."""
@@ -259,3 +328,456 @@ class GetEventsTest(DbBaseTest):
             events = db.get_package_events(members['escrow'][0])
             self.assertEqual(len(events), index+1, "{} event expected for escrow: {}, but {} got instead".format(
                 index + 1, members['escrow'][0], len(events)))
+
+    def test_get_packages_events(self):
+        """Getting events of several packages at once test."""
+        packages_members = [self.prepare_package_members() for _ in range(3)]
+        for index, members in enumerate(packages_members):
+            db.create_package(members['escrow'][0], members['launcher'][0], members['recipient'][0],
+                              '+490857461783', '+4904597863891', 50000000, 100000000, time.time(),
+                              'Package description', '12.970686,77.595590', '41.156193,-8.637541',
+                              'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+            for _ in range(index):
+                db.add_event(members['courier'][0], 'new event', '12.970686,77.595590', members['escrow'][0])
+        escrow_pubkeys = [members['escrow'][0] for members in packages_members]
+        events_by_package = db.get_packages_events(escrow_pubkeys + ['unknown pubkey'])
+        self.assertEqual(events_by_package['unknown pubkey'], [], "unknown package should have no events")
+        for escrow_pubkey in escrow_pubkeys:
+            self.assertEqual(
+                events_by_package[escrow_pubkey], db.get_package_events(escrow_pubkey),
+                "bulk events for escrow {} differ from single package events".format(escrow_pubkey))
+
+    def test_get_events_since(self):
+        """Syncing events by idx returns each event once, in order."""
+        members = self.prepare_package_members()
+        db.create_package(members['escrow'][0], members['launcher'][0], members['recipient'][0],
+                          '+490857461783', '+4904597863891', 50000000, 100000000, time.time(),
+                          'Package description', '12.970686,77.595590', '41.156193,-8.637541',
+                          'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        for _ in range(4):
+            db.add_event(members['courier'][0], 'new event', '12.970686,77.595590', members['escrow'][0])
+        # Start right before the first event, events following a gap in idx are held back for a while.
+        synced, cursor = [], db.get_package_events(members['escrow'][0])[0]['idx'] - 1
+        for _ in range(3):
+            synced.extend(sync.get_events_since(cursor, 2))
+            cursor = synced[-1]['idx']
+        self.assertEqual(
+            [event['idx'] for event in synced],
+            sorted(event['idx'] for event in db.get_package_events(members['escrow'][0])),
+            "synced events differ from package events")
+        start = time.time()
+        self.assertEqual(sync.wait_for_events_since(cursor, 2, 1), [], "expected no events after the last one")
+        self.assertGreaterEqual(time.time() - start, 1, "sync returned before its timeout")
+
+    @staticmethod
+    def get_last_idx():
+        """Get the idx of the last event."""
+        with db.SQL_CONNECTION() as sql:
+            sql.execute('SELECT MAX(idx) AS idx FROM events')
+            return sql.fetchall()[0]['idx']
+
+    def test_get_events_since_in_flight(self):
+        """Events committed while an earlier event is in flight are held back until it commits."""
+        user_pubkey = self.generate_keypair()[0]
+        db.add_event(user_pubkey, 'first event', '12.970686,77.595590')
+        cursor = self.get_last_idx()
+        insert = 'INSERT INTO events (user_pubkey, event_type, location) VALUES (%s, %s, %s)'
+        with db.UNPOOLED_SQL_CONNECTION() as first:
+            first.execute(insert, (user_pubkey, 'second event', '12.970686,77.595590'))
+            with db.UNPOOLED_SQL_CONNECTION() as second:
+                second.execute(insert, (user_pubkey, 'third event', '12.970686,77.595590'))
+            self.assertEqual(sync.get_events_since(cursor), [], "event returned before an earlier one committed")
+        self.assertEqual(
+            [event['event_type'] for event in sync.get_events_since(cursor)], ['second event', 'third event'],
+            "events not returned once committed")
+
+    def test_get_events_since_gap(self):
+        """Events following a rolled back event are returned once the commit window passes."""
+        user_pubkey = self.generate_keypair()[0]
+        db.add_event(user_pubkey, 'first event', '12.970686,77.595590')
+        cursor = self.get_last_idx()
+        insert = 'INSERT INTO events (user_pubkey, event_type, location) VALUES (%s, %s, %s)'
+        with db.UNPOOLED_SQL_CONNECTION() as sql:
+            sql.execute(insert, (user_pubkey, 'rolled back event', '12.970686,77.595590'))
+            sql.execute('ROLLBACK')
+        db.add_event(user_pubkey, 'second event', '12.970686,77.595590')
+        self.assertEqual(sync.get_events_since(cursor), [], "event following a gap returned right away")
+        commit_window, sync.SYNC_COMMIT_WINDOW = sync.SYNC_COMMIT_WINDOW, .1
+        try:
+            time.sleep(.2)
+            self.assertEqual(
+                [event['event_type'] for event in sync.get_events_since(cursor)], ['second event'],
+                "event following a gap not returned after the commit window")
+        finally:
+            sync.SYNC_COMMIT_WINDOW = commit_window
+
+
+class GetAvailablePackagesTest(DbBaseTest):
+    """Getting available packages test."""
+
+    def test_get_available_packages(self):
+        """Getting available packages near location test."""
+        nearby_members = self.prepare_package_members()
+        db.create_package(
+            nearby_members['escrow'][0], nearby_members['launcher'][0], nearby_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time() + 3600, 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        distant_members = self.prepare_package_members()
+        db.create_package(
+            distant_members['escrow'][0], distant_members['launcher'][0], distant_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time() + 3600, 'Package description',
+            '41.156193,-8.637541', '12.970686,77.595590', 'Spain Porto', 'India Bengaluru', '41.156193,-8.637541', None)
+        packages = db.get_available_packages('12.972,77.596', 5)
+        self.assertEqual(
+            [package['escrow_pubkey'] for package in packages], [nearby_members['escrow'][0]],
+            "expected only the package launched nearby")
+
+
+class PackageStateTest(DbBaseTest):
+    """Package state projection test."""
+
+    def test_package_state(self):
+        """Package state follows package events and survives a rebuild."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        package = db.get_package(package_members['escrow'][0])
+        self.assertEqual(package['status'], 'waiting pickup',
+                         "expected status 'waiting pickup', '{}' got instead".format(package['status']))
+        db.add_event(package_members['courier'][0], 'couriered', '12.970686,77.595590', package_members['escrow'][0])
+        db.changed_location(package_members['courier'][0], '12.980686,77.595590', package_members['escrow'][0])
+        package = db.get_package(package_members['escrow'][0])
+        self.assertEqual(package['status'], 'in transit',
+                         "expected status 'in transit', '{}' got instead".format(package['status']))
+        self.assertEqual(package['custodian_pubkey'], package_members['courier'][0],
+                         "{} expected as custodian, {} got instead".format(
+                             package_members['courier'][0], package['custodian_pubkey']))
+        migrations.rebuild_package_state()
+        self.assertEqual(package, db.get_package(package_members['escrow'][0]),
+                         "package changed after package state rebuild")
+
+    def test_rebuild_package_state(self):
+        """Rebuilding reproduces the package state projection from the events alone."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        db.add_event(package_members['courier'][0], 'couriered', '12.970686,77.595590', package_members['escrow'][0])
+        db.add_event(package_members['recipient'][0], 'received', '41.156193,-8.637541', package_members['escrow'][0])
+        with db.SQL_CONNECTION() as sql:
+            sql.execute('SELECT * FROM package_state ORDER BY escrow_pubkey')
+            projection = sql.fetchall()
+            sql.execute('DELETE FROM package_state')
+        migrations.rebuild_package_state()
+        with db.SQL_CONNECTION() as sql:
+            sql.execute('SELECT * FROM package_state ORDER BY escrow_pubkey')
+            self.assertEqual(sql.fetchall(), projection, "rebuilt package state differs from the projection")
+
+    def test_rebuild_during_add_event(self):
+        """Events committed while the state is rebuilt are kept in the state."""
+        package_members = self.prepare_package_members()
+        escrow_pubkey = package_members['escrow'][0]
+        db.create_package(
+            escrow_pubkey, package_members['launcher'][0], package_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        added = threading.Event()
+
+        def add_event():
+            """Add an event, committing it a while later."""
+            with db.SQL_CONNECTION():
+                db.add_event(package_members['courier'][0], 'couriered', '12.970686,77.595590', escrow_pubkey)
+                added.set()
+                time.sleep(.5)
+
+        thread = threading.Thread(target=add_event)
+        thread.start()
+        added.wait()
+        migrations.rebuild_package_state()
+        thread.join()
+        with db.SQL_CONNECTION() as sql:
+            sql.execute('SELECT last_event_type FROM package_state WHERE escrow_pubkey = %s', (escrow_pubkey,))
+            self.assertEqual(
+                sql.fetchall()[0]['last_event_type'], 'couriered', "event committed during the rebuild was lost")
+
+
+class PackageCacheTest(DbBaseTest):
+    """Request-scoped package cache test."""
+
+    def test_package_cache(self):
+        """Packages are loaded once per request, and kept up to date by the request's own events."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        queries = []
+        real_sql_connection = db.SQL_CONNECTION
+
+        @contextlib.contextmanager
+        def recording_sql_connection(*args, **kwargs):
+            """Connection recording all the queries executed through it."""
+            with real_sql_connection(*args, **kwargs) as sql:
+                yield RecordingCursor(sql, queries)
+
+        with flask.Flask(__name__).app_context():
+            package = db.get_package(package_members['escrow'][0])
+            package['description'] = 'modified by the caller'
+            db.SQL_CONNECTION = recording_sql_connection
+            try:
+                self.assertEqual(
+                    db.get_package(package_members['escrow'][0])['description'], 'Package description',
+                    "cached package was modified through a returned copy")
+                self.assertEqual(queries, [], "cached package was loaded again")
+                db.accept_package(package_members['courier'][0], package_members['escrow'][0], '12.970686,77.595590')
+            finally:
+                db.SQL_CONNECTION = real_sql_connection
+            cached_package = db.get_package(package_members['escrow'][0])
+            db.release_connection()
+        self.assertEqual(cached_package, db.get_package(package_members['escrow'][0]),
+                         "cached package differs from the stored package")
+        self.assertEqual(cached_package['status'], 'in transit',
+                         "expected status 'in transit', '{}' got instead".format(cached_package['status']))
+
+
+class NotificationOutboxTest(DbBaseTest):
+    """Notification outbox test."""
+
+    def test_notification_outbox(self):
+        """Notifiable events are queued, claimed once, and retried after failing."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        db.changed_location(package_members['launcher'][0], '12.980686,77.595590', package_members['escrow'][0])
+        jobs = db.claim_notification_jobs(10, 3, 60)
+        self.assertEqual(
+            [(job['event_type'], job['escrow_pubkey']) for job in jobs], [('launched', package_members['escrow'][0])],
+            "expected a single notification job for the launch")
+        self.assertEqual(db.claim_notification_jobs(10, 3, 60), [], "claimed job was claimed again")
+        db.fail_notification_job(jobs[0]['job_id'], 0, 'failure')
+        self.assertEqual(len(db.claim_notification_jobs(10, 3, 60)), 1, "failed job was not retried")
+        db.complete_notification_job(jobs[0]['job_id'])
+        db.fail_notification_job(jobs[0]['job_id'], 0, 'failure')
+        self.assertEqual(db.claim_notification_jobs(10, 3, 60), [], "completed job was claimed again")
+
+    def test_notification_lease_expiry(self):
+        """Jobs which lease expires are claimed again, until their attempts are exhausted."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        job_id = db.claim_notification_jobs(10, 2, 0)[0]['job_id']
+        self.assertEqual(
+            [job['job_id'] for job in db.claim_notification_jobs(10, 2, 0)], [job_id],
+            "job with an expired lease was not claimed again")
+        self.assertEqual(db.claim_notification_jobs(10, 2, 0), [], "exhausted job was claimed again")
+        with db.SQL_CONNECTION() as sql:
+            sql.execute('SELECT job_id FROM notification_outbox')
+            self.assertEqual(sql.fetchall(), [], "exhausted job left in the outbox")
+            sql.execute('SELECT job_id, attempts FROM notification_dead_letters')
+            self.assertEqual(
+                sql.fetchall(), [{'job_id': job_id, 'attempts': 2}], "exhausted job not moved to the dead letters")
+
+    def test_delivered_tokens(self):
+        """Tokens delivered by a job are kept until the job is completed."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        job_id = db.claim_notification_jobs(10, 3, 60)[0]['job_id']
+        db.add_delivered_tokens(job_id, ['first token', 'second token'])
+        db.add_delivered_tokens(job_id, ['second token'])
+        self.assertEqual(
+            db.get_delivered_tokens(job_id), {'first token', 'second token'}, "unexpected delivered tokens")
+        db.complete_notification_job(job_id)
+        self.assertEqual(db.get_delivered_tokens(job_id), set(), "delivered tokens kept after completion")
+
+    def test_bury_notification_job(self):
+        """Buried jobs are moved to the dead letters with their error."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        job_id = db.claim_notification_jobs(10, 3, 60)[0]['job_id']
+        db.bury_notification_job(job_id, 'failure')
+        with db.SQL_CONNECTION() as sql:
+            sql.execute('SELECT job_id, last_error FROM notification_dead_letters')
+            self.assertEqual(
+                sql.fetchall(), [{'job_id': job_id, 'last_error': 'failure'}], "job not moved to the dead letters")
+        db.fail_notification_job(job_id, 0, 'failure')
+        self.assertEqual(db.claim_notification_jobs(10, 3, 60), [], "buried job was claimed again")
+
+
+class NotificationTokensTest(DbBaseTest):
+    """Notification tokens test."""
+
+    def test_notification_tokens(self):
+        """Tokens are toggled in place and legacy history is folded into the current state."""
+        user_pubkey = self.generate_keypair()[0]
+        db.set_notification_token(user_pubkey, 'first token')
+        db.set_notification_token(user_pubkey, 'first token')
+        db.set_notification_token(user_pubkey, 'second token')
+        db.remove_notification_token(user_pubkey, 'first token')
+        self.assertEqual(db.get_active_tokens(user_pubkey), ['second token'], "unexpected active tokens")
+        with db.SQL_CONNECTION() as sql:
+            sql.executemany('''
+                INSERT INTO notification_tokens (user_pubkey, token, active, timestamp)
+                VALUES (%s, %s, %s, %s)''', [
+                    (user_pubkey, 'third token', True, '2018-01-01 00:00:00'),
+                    (user_pubkey, 'third token', False, '2018-01-02 00:00:00'),
+                    (user_pubkey, 'third token', True, '2018-01-03 00:00:00'),
+                    (user_pubkey, 'second token', False, '2018-01-01 00:00:00')])
+        with db.SQL_CONNECTION() as sql:
+            migrations.fold_notification_tokens(sql)
+            sql.execute('''
+                SELECT COUNT(*) AS rows_count FROM notification_tokens
+                WHERE user_pubkey = %s AND token = %s''', (user_pubkey, 'third token'))
+            self.assertEqual(sql.fetchall()[0]['rows_count'], 3, "folding deleted the history")
+        self.assertEqual(
+            sorted(db.get_active_tokens(user_pubkey)), ['second token', 'third token'],
+            "history was not folded into the current state, or older history overrode it")
+        migrations.compact_notification_tokens()
+        with db.SQL_CONNECTION() as sql:
+            sql.execute('''
+                SELECT COUNT(*) AS rows_count FROM notification_tokens
+                WHERE user_pubkey = %s AND token = %s''', (user_pubkey, 'third token'))
+            self.assertEqual(
+                sql.fetchall()[0]['rows_count'], 3 if db.TOKEN_HISTORY else 0, "compaction kept the wrong history")
+        self.assertEqual(
+            sorted(db.get_active_tokens(user_pubkey)), ['second token', 'third token'], "compaction changed tokens")
+
+
+class RecordingCursor:
+    """Cursor wrapper recording the queries executed."""
+
+    def __init__(self, cursor, queries):
+        self.cursor = cursor
+        self.queries = queries
+
+    def execute(self, query, params=()):
+        """Record and execute a query."""
+        self.queries.append((query, params))
+        return self.cursor.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class ReplicaRoutingTest(DbBaseTest):
+    """Read replica routing test."""
+
+    def setUp(self):
+        """Use a second pool of the test database as a replica, which reports no replication lag."""
+        super().setUp()
+        self.replica_pool = db.pool.ConnectionPool(db.POOL.connect, 2, 10, 30)
+        db.REPLICA_POOLS.append(self.replica_pool)
+
+    def tearDown(self):
+        """Remove the replica."""
+        db.REPLICA_POOLS.remove(self.replica_pool)
+        db.REPLICA_LAGS.pop(self.replica_pool, None)
+        db.THREAD_CONNECTION.sql_primary_until = 0
+
+    def lag_replica(self):
+        """Make the replica report the longest replication lag at which it is still read from."""
+        with db.ROUTING_LOCK:
+            db.REPLICA_LAGS[self.replica_pool] = time.time(), db.DB_REPLICA_MAX_LAG
+
+    def test_routing(self):
+        """Reads go to the replica, unless they follow a recent write."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        routing = dict(db.get_routing_stats()['routing'])
+        db.get_package(package_members['escrow'][0])
+        self.assertEqual(db.get_routing_stats()['routing']['sticky'], routing['sticky'] + 2,
+                         "reads following a write did not stick to the primary")
+        db.THREAD_CONNECTION.sql_primary_until = 0
+        db.get_package(package_members['escrow'][0])
+        self.assertEqual(db.get_routing_stats()['routing']['replica'], routing['replica'] + 2,
+                         "reads were not routed to the replica")
+        self.assertEqual(self.replica_pool.stats()['in_use'], 0, "replica connection was not released")
+
+    def test_sync_on_primary(self):
+        """Syncs never read from a lagging replica, on which events following a gap could settle too early."""
+        db.add_event(self.generate_keypair()[0], 'event', '12.970686,77.595590')
+        self.lag_replica()
+        db.THREAD_CONNECTION.sql_primary_until = 0
+        checkouts = self.replica_pool.stats()['checkouts']
+        self.assertTrue(sync.get_events_since(0), "no events synced")
+        self.assertEqual(self.replica_pool.stats()['checkouts'], checkouts, "sync read from the replica")
+
+    def test_write_validation_on_primary(self):
+        """Packages are validated on the primary before writes, even by clients which did not write recently."""
+        package_members = self.prepare_package_members()
+        escrow_pubkey = package_members['escrow'][0]
+        db.create_package(
+            escrow_pubkey, package_members['launcher'][0], package_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time(), 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        self.lag_replica()
+        checkouts = self.replica_pool.stats()['checkouts']
+        for write in (
+                lambda: db.accept_package(package_members['courier'][0], escrow_pubkey, '12.970686,77.595590'),
+                lambda: db.request_relay(package_members['courier'][0], escrow_pubkey, '12.970686,77.595590', None),
+                lambda: db.assign_xdrs(
+                    escrow_pubkey, package_members['launcher'][0], '12.970686,77.595590', '{"escrow_xdrs": "xdrs"}')):
+            db.THREAD_CONNECTION.sql_primary_until = 0
+            write()
+        self.assertEqual(self.replica_pool.stats()['checkouts'], checkouts, "write validated on the replica")
+
+
+class QueryPlansTest(DbBaseTest):
+    """Query plans test."""
+
+    def test_migrations(self):
+        """Migrating an up to date database changes nothing."""
+        self.assertEqual(
+            migrations.migrate_db(), len(migrations.MIGRATIONS), "database is not at the latest schema version")
+
+    def test_query_plans(self):
+        """Hot queries never need a full table scan."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            '+490857461783', '+4904597863891', 50000000, 100000000, time.time() + 3600, 'Package description',
+            '12.970686,77.595590', '41.156193,-8.637541', 'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        db.set_notification_token(package_members['recipient'][0], 'notification token')
+
+        queries = []
+        real_sql_connection = db.SQL_CONNECTION
+
+        @contextlib.contextmanager
+        def recording_sql_connection(*args, **kwargs):
+            """Connection recording all the queries executed through it."""
+            with real_sql_connection(*args, **kwargs) as sql:
+                yield RecordingCursor(sql, queries)
+
+        db.SQL_CONNECTION = recording_sql_connection
+        try:
+            db.get_package(package_members['escrow'][0])
+            pagination.get_packages(package_members['launcher'][0])
+            db.get_available_packages('12.970686,77.595590')
+            db.get_events(None, None)
+            db.get_package_photo(package_members['escrow'][0])
+            db.get_active_tokens(package_members['recipient'][0])
+            db.changed_location(package_members['courier'][0], '12.970686,77.595590', package_members['escrow'][0])
+        finally:
+            db.SQL_CONNECTION = real_sql_connection
+
+        with db.SQL_CONNECTION() as sql:
+            for query, params in queries:
+                if query.lstrip().upper().startswith('SELECT'):
+                    self.assertEqual(
+                        migrations.find_full_scans(sql, query, params), [],
+                        "full table scan in query: {}".format(query))
@@ -0,0 +1,76 @@
+"""Tests for dispatcher module"""
+import unittest
+
+import dispatcher
+
+
+class StubDb:
+    """Local stub of the outbox functions of the db module, recording what happened to each job."""
+
+    def __init__(self, jobs, failing_escrows):
+        self.jobs = jobs
+        self.failing_escrows = failing_escrows
+        self.completed, self.failed, self.buried = [], [], []
+
+    def claim_notification_jobs(self, limit, max_attempts, lease):
+        """Claim all the jobs at once."""
+        assert (limit, max_attempts, lease) == (dispatcher.BATCH_SIZE, dispatcher.MAX_ATTEMPTS, dispatcher.LEASE)
+        jobs, self.jobs = self.jobs, []
+        return jobs
+
+    def send_notification(self, event_type, escrow_pubkey, job_id):
+        """Fail sending the notifications of failing escrows."""
+        assert isinstance(job_id, int), 'job progress not tracked'
+        if escrow_pubkey in self.failing_escrows:
+            raise RuntimeError("{} notification failed".format(event_type))
+
+    def complete_notification_job(self, job_id):
+        """Record a completed job."""
+        self.completed.append(job_id)
+
+    def fail_notification_job(self, job_id, retry_delay, error):
+        """Record a job scheduled for retry."""
+        self.failed.append((job_id, retry_delay, error))
+
+    def bury_notification_job(self, job_id, error):
+        """Record a job given up on."""
+        self.buried.append((job_id, error))
+
+
+def get_job(job_id, attempts, escrow_pubkey='escrow'):
+    """Get a claimed job, with attempts counting the earlier ones only."""
+    return {'job_id': job_id, 'event_type': 'launched', 'escrow_pubkey': escrow_pubkey, 'attempts': attempts}
+
+
+class DispatchPendingTest(unittest.TestCase):
+    """Test dispatching against a stub outbox."""
+
+    def setUp(self):
+        """Replace the db module with a stub."""
+        self.real_db = dispatcher.db
+
+    def tearDown(self):
+        """Restore the db module."""
+        dispatcher.db = self.real_db
+
+    def test_backoff(self):
+        """Test that the retry delay doubles with every attempt, up to the maximal backoff."""
+        self.assertEqual(
+            [dispatcher.get_backoff(attempts) for attempts in range(1, 5)],
+            [dispatcher.BASE_BACKOFF * factor for factor in (1, 2, 4, 8)])
+        self.assertEqual(dispatcher.get_backoff(100), dispatcher.MAX_BACKOFF)
+
+    def test_failed_jobs_retried(self):
+        """Test that sent jobs are completed and failed jobs are retried after their backoff."""
+        dispatcher.db = StubDb([get_job(1, 0), get_job(2, 2, 'failing')], {'failing'})
+        self.assertEqual(dispatcher.dispatch_pending(), 2)
+        self.assertEqual(dispatcher.db.completed, [1])
+        self.assertEqual(dispatcher.db.failed, [(2, dispatcher.get_backoff(3), 'launched notification failed')])
+        self.assertEqual(dispatcher.db.buried, [])
+
+    def test_give_up(self):
+        """Test that jobs failing their last attempt are buried instead of retried."""
+        dispatcher.db = StubDb([get_job(1, dispatcher.MAX_ATTEMPTS - 1, 'failing')], {'failing'})
+        self.assertEqual(dispatcher.dispatch_pending(), 1)
+        self.assertEqual(dispatcher.db.failed, [])
+        self.assertEqual(dispatcher.db.buried, [(1, 'launched notification failed')])
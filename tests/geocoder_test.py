@@ -0,0 +1,88 @@
+"""Tests for geocoder module"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import geocoder
+
+
+def square(min_lon, min_lat, max_lon, max_lat):
+    """Get a closed square ring."""
+    return [[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]]
+
+
+COUNTRIES = {
+    'type': 'FeatureCollection',
+    'features': [
+        # A country with a hole, filled by an enclave.
+        {'type': 'Feature', 'properties': {'ISO_A2': 'AA'},
+         'geometry': {'type': 'Polygon', 'coordinates': [square(0, 0, 10, 10), square(4.2, 4.2, 5.8, 5.8)]}},
+        {'type': 'Feature', 'properties': {'ISO_A2': 'BB'},
+         'geometry': {'type': 'Polygon', 'coordinates': [square(4.2, 4.2, 5.8, 5.8)]}},
+        # A country of two islands, the second one along a diagonal.
+        {'type': 'Feature', 'properties': {'ISO_A2': 'CC'},
+         'geometry': {'type': 'MultiPolygon', 'coordinates': [
+             [square(-20.5, -20.5, -15.5, -15.5)],
+             [[[170, -50], [180, -50], [170, -40], [170, -50]]]]}},
+        {'type': 'Feature', 'properties': {'ISO_A2': '-99'},
+         'geometry': {'type': 'Polygon', 'coordinates': [square(50, 50, 60, 60)]}},
+        # A country with its code only in the fallback property, as France in Natural Earth.
+        {'type': 'Feature', 'properties': {'ISO_A2': '-99', 'ISO_A2_EH': 'DD'},
+         'geometry': {'type': 'Polygon', 'coordinates': [square(30, 30, 40, 40)]}}]}
+
+
+class GeocoderTest(unittest.TestCase):
+    """Test lookups against a synthetic set of countries."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Load the synthetic countries."""
+        with tempfile.NamedTemporaryFile('w', suffix='.geojson', delete=False) as countries_file:
+            json.dump(COUNTRIES, countries_file)
+        cls.index = geocoder.load(countries_file.name)
+        os.remove(countries_file.name)
+
+    def test_lookup(self):
+        """Points resolve to the country containing them."""
+        for latitude, longitude, country_code in (
+                (1, 1, 'AA'), (9.9, 0.1, 'AA'), (4.1, 5, 'AA'), (5, 5, 'BB'), (4.3, 5.7, 'BB'),
+                (-18, -18, 'CC'), (35, 35, 'DD'), (-15.6, -20.4, 'CC'), (-49, 178, 'CC'), (-42, 171, 'CC'),
+                (-41, 179, None), (-15.4, -18, None), (10.1, 5, None), (55, 55, None), (-90, -180, None),
+                (90, 180, None)):
+            self.assertEqual(
+                self.index.lookup(latitude, longitude), country_code,
+                "expected {} at {},{}".format(country_code, latitude, longitude))
+
+
+class CountriesFileTest(unittest.TestCase):
+    """Test fetching the countries file, and lookups without it."""
+
+    def setUp(self):
+        """Keep the configured countries file and its index."""
+        self.directory = tempfile.mkdtemp()
+        self.configured = geocoder.COUNTRIES_PATH, geocoder.INDEX, geocoder.INDEX_MISSING
+        geocoder.INDEX, geocoder.INDEX_MISSING = None, False
+
+    def tearDown(self):
+        """Restore the configured countries file and its index."""
+        geocoder.COUNTRIES_PATH, geocoder.INDEX, geocoder.INDEX_MISSING = self.configured
+        shutil.rmtree(self.directory)
+
+    def test_fetch(self):
+        """Fetched countries are saved to the countries path and used for lookups."""
+        source_path = os.path.join(self.directory, 'source.geojson')
+        with open(source_path, 'w') as source_file:
+            json.dump(COUNTRIES, source_file)
+        geocoder.COUNTRIES_PATH = os.path.join(self.directory, 'data', 'countries.geojson')
+        geocoder.fetch('file://' + source_path)
+        self.assertEqual(geocoder.lookup(5, 5), 'BB')
+
+    def test_missing(self):
+        """A missing countries file is reported once, and leaves all locations unresolved."""
+        geocoder.COUNTRIES_PATH = os.path.join(self.directory, 'missing.geojson')
+        with self.assertLogs(geocoder.LOGGER, 'ERROR') as logs:
+            self.assertIsNone(geocoder.lookup(5, 5))
+            self.assertIsNone(geocoder.lookup(5, 5))
+        self.assertEqual(len(logs.records), 1)
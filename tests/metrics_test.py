@@ -0,0 +1,129 @@
+"""Tests for metrics module"""
+import os
+import tempfile
+import unittest
+
+import flask
+
+import metrics
+
+APP = flask.Flask(__name__)
+
+
+class HistogramTest(unittest.TestCase):
+    """Test histograms and their rendering."""
+
+    def test_render(self):
+        """Buckets are cumulative, and count and sum cover all observations."""
+        histogram = metrics.Histogram('test_seconds', 'Test.', ('route',), (.1, 1))
+        for value in (.05, .5, .5, 5):
+            histogram.observe(value, '/a')
+        lines = list(metrics.render_families({histogram.name: histogram.collect()}))
+        self.assertEqual(lines[:2], ['# HELP test_seconds Test.', '# TYPE test_seconds histogram'])
+        samples = [line.split('{')[0] + ' ' + line.split()[-1] for line in lines[2:]]
+        self.assertEqual(samples, [
+            'test_seconds_bucket 1', 'test_seconds_bucket 3', 'test_seconds_bucket 4', 'test_seconds_sum 6.05',
+            'test_seconds_count 4'])
+        self.assertIn('route="/a",le="+Inf"', lines[4])
+
+    def test_label_escaping(self):
+        """Label values are escaped."""
+        self.assertEqual(metrics.format_labels(('a', 'b'), ('x"y', 'x\\y\n')), r'a="x\"y",b="x\\y\n"')
+
+
+class TimedCallTest(unittest.TestCase):
+    """Test timing of external calls."""
+
+    def test_timed_call(self):
+        """Calls are timed, and the ones which raise are counted."""
+        with metrics.timed_call('test', 'succeed'):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.timed_call('test', 'fail'):
+                raise ValueError
+        self.assertEqual(sum(metrics.EXTERNAL_CALL_DURATION.series[('test', 'succeed')][0]), 1)
+        self.assertEqual(metrics.EXTERNAL_CALL_ERRORS.values.get(('test', 'fail')), 1)
+        self.assertIsNone(metrics.EXTERNAL_CALL_ERRORS.values.get(('test', 'succeed')))
+
+    def test_expected_exceptions(self):
+        """Expected exceptions are timed, but not counted as errors."""
+        with self.assertRaises(KeyError):
+            with metrics.timed_call('test', 'expected', (KeyError,)):
+                raise KeyError
+        self.assertEqual(sum(metrics.EXTERNAL_CALL_DURATION.series[('test', 'expected')][0]), 1)
+        self.assertIsNone(metrics.EXTERNAL_CALL_ERRORS.values.get(('test', 'expected')))
+
+
+class RequestMetricsTest(unittest.TestCase):
+    """Test request and query metrics."""
+
+    def test_request(self):
+        """Queries are attributed to their calling function and to the request."""
+        def query_packages():
+            """Make a query."""
+            metrics.observe_query(.5, depth=1)
+        with APP.test_request_context('/'):
+            metrics.start_request()
+            query_packages()
+            query_packages()
+            metrics.finish_request(flask.Response())
+        self.assertEqual(metrics.QUERY_DURATION.series[('query_packages',)][1], 1)
+        self.assertEqual(metrics.REQUEST_QUERIES.series[('unmatched',)][1], 2)
+        self.assertEqual(metrics.REQUEST_SQL_DURATION.series[('unmatched',)][1], 1)
+        self.assertIn(('unmatched', 'GET', 200), metrics.REQUEST_DURATION.series)
+
+    def test_render_routing(self):
+        """Pool and routing stats are rendered for the primary and each replica."""
+        pool_stats = {'opened': 2, 'in_use': 1, 'idle': 1, 'checkouts': 5, 'timeouts': 0, 'discarded': 0}
+        text = '\n'.join(metrics.render_families(metrics.collect_routing({
+            'pool': pool_stats, 'replicas': [dict(pool_stats, host='replica:3306', lag=None)],
+            'routing': {'primary': 3, 'replica': 2}})))
+        self.assertIn('pool="primary"} 2', text)
+        self.assertIn('pkt_db_replica_lag_seconds{', text)
+        self.assertIn('pool="replica:3306"} NaN', text)
+        self.assertIn('# TYPE pkt_db_pool_checkouts_total counter', text)
+        self.assertIn('decision="replica"} 2', text)
+
+
+class MultiprocessTest(unittest.TestCase):
+    """Test merging the metrics of several workers."""
+
+    def setUp(self):
+        """Use a temporary snapshot directory."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.multiprocess_dir, metrics.MULTIPROCESS_DIR = metrics.MULTIPROCESS_DIR, self.directory.name
+
+    def tearDown(self):
+        """Restore the snapshot directory."""
+        metrics.MULTIPROCESS_DIR = self.multiprocess_dir
+        self.directory.cleanup()
+
+    @staticmethod
+    def get_snapshot(errors, opened, lag):
+        """Get a worker snapshot with an error counter, a pool gauge and a replica lag."""
+        return {
+            'pkt_external_call_errors_total': metrics.get_family('counter', 'Errors.', {'errors{a="b"}': errors}),
+            'pkt_db_pool_opened': metrics.get_family('gauge', 'Opened.', {'opened{pool="primary"}': opened}),
+            'pkt_db_replica_lag_seconds': metrics.get_family('gauge', 'Lag.', {'lag{pool="replica"}': lag})}
+
+    def test_merge(self):
+        """Values are summed across workers, except replica lags of which the highest is taken."""
+        merged = metrics.merge([self.get_snapshot(1, 2, None), self.get_snapshot(3, 4, .5)])
+        self.assertEqual(merged['pkt_external_call_errors_total']['samples'], {'errors{a="b"}': 4})
+        self.assertEqual(merged['pkt_db_pool_opened']['samples'], {'opened{pool="primary"}': 6})
+        self.assertEqual(merged['pkt_db_replica_lag_seconds']['samples'], {'lag{pool="replica"}': .5})
+
+    def test_archive(self):
+        """Counters of exited workers are kept, and their gauges dropped."""
+        metrics.write_json(metrics.get_snapshot_path(1), self.get_snapshot(1, 2, .1))
+        metrics.write_json(metrics.get_snapshot_path(2), self.get_snapshot(3, 4, .2))
+        metrics.archive_worker(1)
+        metrics.archive_worker(2)
+        self.assertEqual(sorted(os.listdir(self.directory.name)), [metrics.ARCHIVE_NAME, metrics.LOCK_NAME])
+        metrics.write_json(metrics.get_snapshot_path(3), self.get_snapshot(5, 6, .3))
+        text = metrics.render()
+        self.assertIn('errors{a="b"} 9', text)
+        self.assertIn('opened{pool="primary"} 6', text)
+        self.assertIn('lag{pool="replica"} 0.3', text)
+        self.assertIn(metrics.get_snapshot_path(), [
+            os.path.join(self.directory.name, file_name) for file_name in os.listdir(self.directory.name)])
@@ -0,0 +1,104 @@
+"""Tests for notifications module"""
+import unittest
+
+import notifications
+
+
+class StubMessaging:
+    """Local stub of the firebase messaging API, recording the batches sent."""
+
+    class ApiCallError(Exception):
+        """Messaging API error."""
+
+        def __init__(self, code, message):
+            super().__init__(message)
+            self.code = code
+
+    class Notification:
+        """Notification stub."""
+
+        def __init__(self, title, body):
+            self.title, self.body = title, body
+
+    class MulticastMessage:
+        """Multicast message stub."""
+
+        def __init__(self, tokens, data, notification):
+            self.tokens, self.data, self.notification = tokens, data, notification
+
+    class SendResponse:
+        """Single message response stub."""
+
+        def __init__(self, exception=None):
+            self.success = exception is None
+            self.exception = exception
+
+    class BatchResponse:
+        """Batch response stub."""
+
+        def __init__(self, responses):
+            self.responses = responses
+            self.success_count = len([response for response in responses if response.success])
+
+    def __init__(self, dead_tokens, unavailable_tokens=()):
+        self.dead_tokens = dead_tokens
+        self.unavailable_tokens = unavailable_tokens
+        self.batches = []
+
+    def get_error(self, token):
+        """Get the error of a message sent to a token, None if it is sent."""
+        if token in self.dead_tokens:
+            return self.ApiCallError('registration-token-not-registered', 'not registered')
+        if token in self.unavailable_tokens:
+            return self.ApiCallError('server-unavailable', 'unavailable')
+        return None
+
+    def send_multicast(self, multicast_message, app=None):
+        """Record the batch and fail the messages sent to dead and unavailable tokens."""
+        assert app is notifications.FIREBASE_APP, 'wrong firebase app used'
+        self.batches.append(multicast_message)
+        return self.BatchResponse([self.SendResponse(self.get_error(token)) for token in multicast_message.tokens])
+
+
+class SendNotificationsTest(unittest.TestCase):
+    """Test batched notifications against a stub messaging API."""
+
+    def setUp(self):
+        """Replace firebase messaging with a stub."""
+        self.real_messaging = notifications.messaging
+
+    def tearDown(self):
+        """Restore firebase messaging."""
+        notifications.messaging = self.real_messaging
+
+    def test_send_notifications(self):
+        """Test that tokens are sent in limited batches and dead tokens are reported."""
+        tokens = ["token{}".format(idx) for idx in range(notifications.MAX_BATCH_SIZE * 2 + 1)]
+        notifications.messaging = StubMessaging(dead_tokens={'token3', tokens[-1]})
+        dead_tokens, retry_tokens = notifications.send_notifications(tokens, 'title', 'body', 100, 'XX-ABC')
+        self.assertEqual(
+            [len(batch.tokens) for batch in notifications.messaging.batches],
+            [notifications.MAX_BATCH_SIZE, notifications.MAX_BATCH_SIZE, 1])
+        self.assertEqual(notifications.messaging.batches[0].data, {
+            'notification_code': '100', 'short_package_id': 'XX-ABC'})
+        self.assertEqual(dead_tokens, ['token3', tokens[-1]])
+        self.assertEqual(retry_tokens, [])
+
+    def test_batch_progress(self):
+        """Test that each batch is reported once sent, and tokens failing temporarily are left to retry."""
+        tokens = ["token{}".format(idx) for idx in range(notifications.MAX_BATCH_SIZE + 2)]
+        notifications.messaging = StubMessaging(dead_tokens={'token1'}, unavailable_tokens={'token2', tokens[-1]})
+        batches = []
+        dead_tokens, retry_tokens = notifications.send_notifications(
+            tokens, 'title', 'body', 100, 'XX-ABC', on_batch=lambda *batch: batches.append(batch))
+        self.assertEqual(batches, [
+            ([token for token in tokens[:notifications.MAX_BATCH_SIZE] if token != 'token2'], ['token1']),
+            ([tokens[-2]], [])])
+        self.assertEqual(dead_tokens, ['token1'])
+        self.assertEqual(retry_tokens, ['token2', tokens[-1]])
+
+    def test_no_tokens(self):
+        """Test that nothing is sent when there are no tokens."""
+        notifications.messaging = StubMessaging(dead_tokens=set())
+        self.assertEqual(notifications.send_notifications([], 'title', 'body', 100, 'XX-ABC'), ([], []))
+        self.assertEqual(notifications.messaging.batches, [])
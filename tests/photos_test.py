@@ -0,0 +1,51 @@
+"""Tests for photos module"""
+import io
+import shutil
+import tempfile
+import unittest
+
+import photos
+
+
+class LocalPhotoStoreTest(unittest.TestCase):
+    """Test the local filesystem photo store."""
+
+    def setUp(self):
+        """Create a store in a temporary directory."""
+        self.root = tempfile.mkdtemp()
+        self.store = photos.LocalPhotoStore(self.root)
+
+    def tearDown(self):
+        """Remove the temporary store."""
+        shutil.rmtree(self.root)
+
+    def test_put_and_get(self):
+        """Test storing and retrieving photos by content hash."""
+        photo = b'\x89PNG\r\n\x1a\n' + b'photo content'
+        content_hash = self.store.put(photo)
+        self.assertEqual(content_hash, photos.get_content_hash(photo))
+        self.assertEqual(self.store.put(photo), content_hash, 'same content stored under a different hash')
+        self.assertEqual(self.store.get(content_hash), photo)
+        self.assertEqual(self.store.get_size(content_hash), len(photo))
+        self.assertEqual(photos.get_content_type(photo), 'image/png')
+
+    def test_unknown_photo(self):
+        """Test getting a photo which is not stored."""
+        with self.assertRaises(photos.UnknownPhoto, msg='UnknownPhoto was not raised on unknown hash'):
+            self.store.get(photos.get_content_hash(b'missing'))
+
+
+@unittest.skipIf(photos.PIL is None, 'Pillow is not installed')
+class ThumbnailsTest(unittest.TestCase):
+    """Test thumbnails rendering."""
+
+    def test_render_thumbnails(self):
+        """Test that thumbnails fit their sizes and keep the photo aspect ratio."""
+        photo = io.BytesIO()
+        photos.PIL.Image.new('RGB', (1000, 500)).save(photo, 'PNG')
+        thumbnails = photos.render_thumbnails(photo.getvalue(), photos.THUMBNAIL_SIZES)
+        self.assertEqual(set(thumbnails), set(photos.THUMBNAIL_SIZES))
+        for size, max_dimension in photos.THUMBNAIL_SIZES.items():
+            self.assertEqual(photos.get_content_type(thumbnails[size]), photos.THUMBNAIL_CONTENT_TYPE)
+            with photos.PIL.Image.open(io.BytesIO(thumbnails[size])) as thumbnail:
+                self.assertEqual(thumbnail.size, (max_dimension, max_dimension // 2))
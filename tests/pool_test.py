@@ -0,0 +1,52 @@
+"""Tests for pool module"""
+import threading
+import unittest
+
+import pool
+
+
+class FakeConnection:
+    """Connection stand-in, recording pings and closes."""
+
+    def __init__(self):
+        self.pings = 0
+        self.closed = False
+
+    def ping(self, reconnect, attempts):
+        """Count pings."""
+        assert reconnect and attempts
+        self.pings += 1
+
+    def close(self):
+        """Mark as closed."""
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """Test the connection pool with fake connections."""
+
+    def test_reuse(self):
+        """Returned connections are reused, and broken ones replaced."""
+        connection_pool = pool.ConnectionPool(FakeConnection, 2, 1, 0)
+        first = connection_pool.get()
+        connection_pool.put(first)
+        self.assertIs(connection_pool.get(), first, "idle connection was not reused")
+        self.assertEqual(first.pings, 1, "connection idle past the ping interval was not pinged")
+        connection_pool.put(first, broken=True)
+        self.assertTrue(first.closed, "broken connection was not closed")
+        self.assertIsNot(connection_pool.get(), first, "broken connection was reused")
+        stats = connection_pool.stats()
+        self.assertEqual((stats['opened'], stats['in_use'], stats['checkouts'], stats['discarded']), (1, 1, 3, 1))
+
+    def test_bounded(self):
+        """Checkouts wait for a connection to be returned, and time out if none is."""
+        connection_pool = pool.ConnectionPool(FakeConnection, 1, 0.1, 60)
+        connection = connection_pool.get()
+        with self.assertRaises(pool.PoolTimeout):
+            connection_pool.get()
+        connection_pool.timeout = 5
+        threading.Timer(0.1, connection_pool.put, (connection,)).start()
+        self.assertIs(connection_pool.get(), connection, "waiting checkout did not get the returned connection")
+        stats = connection_pool.stats()
+        self.assertEqual((stats['opened'], stats['timeouts']), (1, 1))
+        self.assertGreater(stats['max_wait'], 0.05, "wait time was not recorded")
@@ -0,0 +1,39 @@
+"""Tests for proximity module"""
+import math
+import random
+import unittest
+
+import proximity
+
+
+def haversine(latitude, longitude, other_latitude, other_longitude):
+    """Get the distance between two points, one at a time."""
+    latitude, longitude, other_latitude, other_longitude = map(
+        math.radians, (latitude, longitude, other_latitude, other_longitude))
+    haversine_value = math.sin((other_latitude - latitude) / 2) ** 2 + math.cos(latitude) * math.cos(
+        other_latitude) * math.sin((other_longitude - longitude) / 2) ** 2
+    return 2 * proximity.EARTH_RADIUS_KM * math.asin(math.sqrt(haversine_value))
+
+
+class ProximityTest(unittest.TestCase):
+    """Test batched distances against one at a time distances."""
+
+    def test_get_nearby(self):
+        """Nearby coordinates are found, nearest first."""
+        generator = random.Random(0)
+        latitudes = [generator.uniform(-90, 90) for _ in range(1000)]
+        longitudes = [generator.uniform(-180, 180) for _ in range(1000)]
+        mask, order, distances = proximity.get_nearby(12.97, 77.59, latitudes, longitudes, 5000)
+        expected = [haversine(12.97, 77.59, latitude, longitude) for latitude, longitude in zip(latitudes, longitudes)]
+        self.assertEqual(
+            list(mask), [distance <= 5000 for distance in expected], "mask differs from one at a time distances")
+        self.assertEqual(
+            list(order), sorted((index for index, distance in enumerate(expected) if distance <= 5000),
+                                key=expected.__getitem__), "nearby coordinates are not ordered by distance")
+        for index, distance in zip(order, distances):
+            self.assertAlmostEqual(distance, expected[index], places=6)
+
+    def test_empty(self):
+        """No candidates, nothing nearby."""
+        mask, order, distances = proximity.get_nearby(0, 0, [], [], 5)
+        self.assertEqual((len(mask), len(order), len(distances)), (0, 0, 0))
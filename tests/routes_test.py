@@ -1,5 +1,6 @@
 """Tests for routes module"""
 import json
+import os
 import time
 import unittest
 
@@ -8,6 +9,7 @@ import stellar_base.keypair
 import util.logger
 import webserver.validation
 
+import migrations
 import routes
 
 LOGGER = util.logger.logging.getLogger('pkt.router.test')
@@ -36,10 +38,7 @@ class RouterBaseTest(unittest.TestCase):
 
     def setUp(self):
         """Setting up the test fixture before exercising it."""
-        try:
-            routes.db.init_db()
-        except util.db.mysql.connector.ProgrammingError:
-            LOGGER.info('tables already exists')
+        migrations.init_db()
 
     @staticmethod
     def sign_transaction(transaction, seed):
@@ -169,6 +168,29 @@ class MyPackagesTest(RouterBaseTest):
         self.assertEqual(packages[0]['collateral'], collateral)
         self.assertEqual(packages[0]['payment'], payment)
 
+    def test_my_packages_unpaged(self):
+        """Test that all user packages are returned when no page is asked for, and a page otherwise."""
+        launcher, recipient = create_account(), create_account()
+        for _ in range(2):
+            routes.db.create_package(
+                create_account()[0], launcher[0], recipient[0], '+490857461783', '+4904597863891', 50000000,
+                100000000, time.time(), 'Package description', '12.970686,77.595590', '41.156193,-8.637541',
+                'India Bengaluru', 'Spain Porto', '12.970686,77.595590', None)
+        max_page_size, routes.pagination.MAX_PAGE_SIZE = routes.pagination.MAX_PAGE_SIZE, 1
+        try:
+            response = self.call(
+                path='my_packages', expected_code=200, fail_message='does not get ok status code on valid request',
+                seed=launcher[1], user_pubkey=launcher[0])
+            self.assertEqual(len(response['packages']), 2, 'expected all packages without paging params')
+            self.assertIsNone(response['cursor'])
+            response = self.call(
+                path='my_packages', expected_code=200, fail_message='does not get ok status code on valid request',
+                seed=launcher[1], user_pubkey=launcher[0], page_size_num=1)
+            self.assertEqual(len(response['packages']), 1, 'expected a single page')
+            self.assertIsNotNone(response['cursor'])
+        finally:
+            routes.pagination.MAX_PAGE_SIZE = max_page_size
+
 
 class PackageTest(RouterBaseTest):
     """Test for package endpoint."""
@@ -203,3 +225,56 @@ class AddEventTest(RouterBaseTest):
             path='add_event', expected_code=200,
             fail_message='could not add event', seed=package['launcher'][1],
             escrow_pubkey=package['escrow'][0], event_type='package launched', location='32.1245, 22.43153')
+
+
+class RawPhotoTest(RouterBaseTest):
+    """Test for raw photo endpoints."""
+
+    @staticmethod
+    def create_photo_package(photo):
+        """Create a package with a photo, and get the path of its raw photo."""
+        escrow_pubkey = create_account()[0]
+        routes.db.create_package(
+            escrow_pubkey, create_account()[0], create_account()[0], '+490857461783', '+4904597863891', 50000000,
+            100000000, time.time(), 'Package description', '12.970686,77.595590', '41.156193,-8.637541',
+            'India Bengaluru', 'Spain Porto', '12.970686,77.595590', photo)
+        return "/v{}/package_photo/{}".format(routes.VERSION, escrow_pubkey)
+
+    def test_raw_photo(self):
+        """Test cache headers, conditional and Range requests of a raw photo."""
+        photo = b'\x89PNG\r\n\x1a\n' + bytes(range(256))
+        path = self.create_photo_package(photo)
+        response = self.app.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, photo)
+        self.assertEqual(response.content_type, 'image/png')
+        self.assertEqual(response.headers['Cache-Control'], routes.PHOTO_CACHE_CONTROL)
+        response = self.app.get(path, headers={'Range': 'bytes=8-15'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, photo[8:16])
+        self.assertEqual(response.headers['Content-Range'], "bytes 8-15/{}".format(len(photo)))
+        response = self.app.get(path, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_missing_photo(self):
+        """Test getting a raw photo missing from the photo store."""
+        photo = b'\x89PNG\r\n\x1a\n' + b'missing photo'
+        path = self.create_photo_package(photo)
+        os.remove(routes.photos.STORE.get_path(routes.photos.get_content_hash(photo)))
+        self.assertEqual(self.app.get(path).status_code, 404)
+
+
+class MetricsTest(RouterBaseTest):
+    """Test for metrics endpoint."""
+
+    def test_metrics(self):
+        """Test scraping metrics, which include the earlier scrapes."""
+        path = "/v{}/metrics".format(routes.VERSION)
+        self.app.get(path)
+        response = self.app.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, routes.metrics.CONTENT_TYPE)
+        text = response.data.decode()
+        self.assertIn('# TYPE pkt_request_duration_seconds histogram', text)
+        self.assertIn("route=\"{}\",method=\"GET\",status=\"200\"".format(path), text)
+        self.assertIn('pkt_db_pool_opened{pool="primary"}', text)
@@ -0,0 +1,34 @@
+"""Tests for serialization module"""
+import datetime
+import decimal
+import json
+import unittest
+
+import flask
+
+import serialization
+
+
+class SerializationTest(unittest.TestCase):
+    """Test that the orjson and standard library encoders agree."""
+
+    @unittest.skipIf(serialization.orjson is None, 'orjson is not installed')
+    def test_encoders_agree(self):
+        """Both encoders handle datetimes, decimals and bytes the same way."""
+        app = flask.Flask(__name__)
+        app.json_encoder = serialization.JSONEncoder
+        data = {'events': [{
+            'timestamp': datetime.datetime(2019, 1, 2, 3, 4, 5), 'payment': decimal.Decimal('50000000'),
+            'ratio': decimal.Decimal('1.5'), 'location': b'12.970686,77.595590', 'raw': b'\xff'}]}
+        use_orjson = serialization.USE_ORJSON
+        try:
+            with app.app_context():
+                encoded = []
+                for serialization.USE_ORJSON in (True, False):
+                    encoded.append(json.loads(flask.json.dumps(data)))
+        finally:
+            serialization.USE_ORJSON = use_orjson
+        self.assertEqual(encoded[0], encoded[1], "encoders disagree")
+        self.assertEqual(encoded[0]['events'][0], {
+            'timestamp': 'Wed, 02 Jan 2019 03:04:05 GMT', 'payment': 50000000, 'ratio': 1.5,
+            'location': '12.970686,77.595590', 'raw': '/w=='})
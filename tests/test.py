@@ -1,5 +1,15 @@
 """Run all tests."""
 # pylint: disable=wildcard-import
 # pylint: disable=unused-wildcard-import
+from tests.balances_test import *
+from tests.compression_test import *
 from tests.db_tests import *
+from tests.dispatcher_test import *
+from tests.geocoder_test import *
+from tests.metrics_test import *
+from tests.notifications_test import *
+from tests.photos_test import *
+from tests.pool_test import *
+from tests.proximity_test import *
 from tests.routes_test import *
+from tests.serialization_test import *